@@ -1,3 +1,4 @@
+import asyncio
 import time
 import os
 import queue
@@ -15,6 +16,7 @@ from sqlalchemy.orm import Session
 
 from sql import crud, models, schemas
 from sql.database import engine, SessionLocal
+from sql.persistence import ChatPersistenceBuffer
 from routes import router
 from utils.authentication import create_access_token
 from utils.cookies import validate_admin_cookies, validate_cookies
@@ -28,6 +30,7 @@ from openvoicechat.tts.tts_piper import Mouth_piper
 
 
 from openvoicechat.llm.llm_EC2 import Chatbot_LLM as Chatbot
+from openvoicechat.llm.session import SessionManager
 
 # Add these imports at the top of your app.py file
 from datetime import datetime, timedelta
@@ -35,10 +38,15 @@ from sqlalchemy import func, text
 
 #from openvoicechat.stt.stt_hf import Ear_hf as Ear
 from openvoicechat.stt.stt_deepgram import Ear_deepgram as Ear
+from openvoicechat.stt.vad import VoiceActivityDetection
+from openvoicechat.sidecar import OVC_SIDECAR_ADDRESS, RemoteMouth, RemoteVAD
 
 # from openvoicechat.stt.stt_faster_whisper import Ear_faster_whisper as Ear
 
-from openvoicechat.utils import run_chat, Listener_ws, Player_ws,run_chat_langchain
+from openvoicechat.utils import run_chat, Listener_ws, Player_ws
+from openvoicechat.engine import ConversationEngine
+from openvoicechat import protocol
+from openvoicechat.protocol import MessageType, SampleFormat
 
 
 from pydantic import BaseModel
@@ -47,17 +55,7 @@ import subprocess
 import openai
 from openai import OpenAI
 import re
-
-def get_context(self):
-    return self.messages
-
-
-def set_context(self, context):
-    self.messages = context
-
-
-Chatbot.get_context = get_context
-Chatbot.set_context = set_context
+import uuid
 
 
 SESSION_MIDDLEWARE_SECRET_KEY = os.getenv("SESSION_MIDDLEWARE_SECRET_KEY", "SECRET")
@@ -77,8 +75,37 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 app.include_router(router, prefix="/api")
 
 load_dotenv()
-#chatbot = Chatbot(Model=CHATBOT_MODEL)
-chatbot = Chatbot()
+# Every call gets its own conversation state; all of them share one pooled OpenAI client
+session_manager = SessionManager(chatbot_class=Chatbot)
+# Live chats are written to the database at turn boundaries instead of on every audio frame
+chat_persistence = ChatPersistenceBuffer()
+
+
+# Load the shared TTS voice and VAD once per worker so a call only creates lightweight session handles
+@app.on_event("startup")
+def preload_models():
+    if OVC_SIDECAR_ADDRESS:
+        print_info(f"Using the model sidecar at {OVC_SIDECAR_ADDRESS}")
+        return
+    start = time.time()
+    try:
+        Mouth_piper.preload(device=DEVICE)
+        VoiceActivityDetection.preload()
+    except Exception as e:
+        print_warning(f"Model preload failed, models will load on first call: {e}")
+    end = time.time()
+    log_response_time("Model Pool Preload Time", round(end - start, 3))
+
+
+@app.on_event("startup")
+async def start_chat_persistence():
+    app.state.chat_persistence_task = asyncio.create_task(chat_persistence.run())
+
+
+@app.on_event("shutdown")
+async def stop_chat_persistence():
+    app.state.chat_persistence_task.cancel()
+    chat_persistence.flush()
 
 
 # Database Dependency Function to Manage Database Sessions
@@ -1044,23 +1071,38 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
     existing_chat = crud.get_chat_history_by_organization_team_agent(
         db, organization.id, team.id, agent.id
     )
+    context = None
     if existing_chat:
         print_info("Setting Chatbot context")
         print(existing_chat.chat_data)
-        chatbot.set_context(existing_chat.chat_data)
-        
-    # Configure the chatbot to produce shorter responses
-    if hasattr(chatbot, 'max_tokens'):
-        chatbot.max_tokens = 75  # Set lower token limit for all agents
-        
-    # Increase the temperature slightly for more focused responses
-    if hasattr(chatbot, 'temperature'):
-        chatbot.temperature = 0.7
-        
+        context = existing_chat.chat_data
+
+    product_names = []
+    product_descriptions = []
+    product_features = []
+
+    for product in organization.products:
+        product_names.append(product["name"])
+        product_descriptions.append(product["description"])
+        product_features.append(product["feature"])
+
+    minibot_args = {
+        "agent_name": agent.name,
+        "organization_name": organization.name,
+        "total_products": len(organization.products),
+        "product_names": product_names,
+        "product_descriptions": product_descriptions,
+        "product_features": product_features,
+    }
+
+    session_id = str(uuid.uuid4())
+    chat_session = session_manager.create_session(session_id, context=context, minibot_args=minibot_args)
+    chatbot = chat_session.chatbot
+
     input_queue = queue.Queue()
-    output_queue = queue.Queue()
-    listener = Listener_ws(input_queue)
-    player = Player_ws(output_queue)
+    output_queue = asyncio.Queue()
+    player = Player_ws(output_queue, loop=asyncio.get_running_loop())
+    listener = Listener_ws(input_queue, on_close=player.end_of_utterance)
 
     voice_id = agent.voice_id
     print(f"Current Voice ID: {voice_id}")
@@ -1073,7 +1115,10 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
         log_response_time("TTS Model (chatterbox) Loading Time", round(end - start, 3))
     elif voice_id == "None" or voice_id == None:  # Use piper
         start = time.time()
-        mouth = Mouth_piper(player=player, device=DEVICE)
+        if OVC_SIDECAR_ADDRESS:
+            mouth = RemoteMouth("piper", player=player, device=DEVICE)
+        else:
+            mouth = Mouth_piper(player=player, device=DEVICE)
         end = time.time()
         log_response_time("TTS Model (Piper) Loading Time", round(end - start, 3))
 
@@ -1082,6 +1127,9 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
         api_key=DEEPGRAM_API_KEY,
         silence_seconds=2.0,
         listener=listener,
+        vad=RemoteVAD() if OVC_SIDECAR_ADDRESS else None,
+        # callers dictating details pause mid-answer, so information agents wait longer
+        endpointing="patient" if agent.agent_function.lower() == "information" else None,
     )
 
 #     ear = Ear(
@@ -1097,51 +1145,28 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
     log_response_time(f"STT Model Loading Time", round(end - start, 3))
 
 
-    metrics = {
-    "recording_times": [],
-    "stt_times": [],
-    "llm_times": [],
-    "tts_times": [],
-    "total_cycle_times": []
-    }
+    if existing_chat:
+        chat_persistence.register(session_id, existing_chat.id, chatbot.get_context)
 
     # Create a custom callback to track timing metrics
     def timing_callback(phase, start_time, end_time):
         duration = round(end_time - start_time, 3)
+        chat_persistence.record_timing(session_id, phase, duration)
         if phase == "stt":
-            metrics["stt_times"].append(duration)
             log_response_time("STT Processing Time", duration)
         elif phase == "llm":
-            metrics["llm_times"].append(duration)
             log_response_time("LLM Response Time", duration)
         elif phase == "tts":
-            metrics["tts_times"].append(duration)
             log_response_time("TTS Processing Time", duration)
         elif phase == "total_cycle":
-            metrics["total_cycle_times"].append(duration)
             log_response_time("Total Cycle Time", duration)
 
 
-    product_names = []
-    product_descriptions = []
-    product_features = []
-
-    for product in organization.products:
-        product_names.append(product["name"])
-        product_descriptions.append(product["description"])
-        product_features.append(product["feature"])
-
-    minibot_args = {
-        "agent_name": agent.name,
-        "organization_name": organization.name,
-        "total_products": len(organization.products),
-        "product_names": product_names,
-        "product_descriptions": product_descriptions,
-        "product_features": product_features,
-    }
-
     # Check if this is an information collection agent
     is_info_agent = agent.agent_function.lower() == "information"
+    engine = None
+    agent_thread = None
+    stop_agent = threading.Event()
 
     if is_info_agent:
         # Import the information collection module
@@ -1154,10 +1179,10 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
         # Use information collection prompt
         from utils.prompts import get_agent_information_prompt
         info_prompt = get_agent_information_prompt(organization, team, agent)
-        chatbot.messages = [{"role": "system", "content": info_prompt}]
+        chatbot.set_context([{"role": "system", "content": info_prompt}])
         
-        # Start the information collection agent thread
-        threading.Thread(
+        # Start the information collection agent thread; stop_agent ends it when the call does
+        agent_thread = threading.Thread(
             target=run_chat_agent,
             args=(
                 mouth, 
@@ -1169,52 +1194,80 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
                 True,  # starting_message
                 "chat_log.txt",  # logging_path
                 save_path,  # save_path for collected information
-                timing_callback  # Pass the timing callback
-            )
-        ).start()
+                timing_callback,  # Pass the timing callback
+                stop_agent,
+            ),
+            daemon=True,
+        )
+        agent_thread.start()
     else:
-        # Use regular chat for non-information agents
-        threading.Thread(
-            target=run_chat_langchain, 
-            args=(mouth, ear, chatbot, minibot_args, True)
-        ).start()
+        # Regular agents run as coroutines on the event loop instead of a thread per call
+        engine = ConversationEngine(
+            mouth,
+            ear,
+            chatbot,
+            minibot_args,
+            verbose=True,
+            timing_callback=timing_callback,
+        )
 
-    try:
+    # Receiving microphone audio and sending bot audio run independently, so bot audio goes out
+    # as soon as it is synthesized instead of waiting for the next microphone frame
+    async def receive_audio():
         while True:
             data = await websocket.receive_bytes()
-            if listener.listening:
-                input_queue.put(data)
-            if not output_queue.empty():
-                response_data = output_queue.get_nowait()
-            else:
-                response_data = "none".encode()
-            await websocket.send_bytes(response_data)
             try:
-                existing_chat.chat_data = chatbot.get_context()
-
-                if metrics["total_cycle_times"]:
-                    latency_data = {
-                        "avg_stt_time": sum(metrics["stt_times"]) / len(metrics["stt_times"]) if metrics["stt_times"] else 0,
-                        "avg_llm_time": sum(metrics["llm_times"]) / len(metrics["llm_times"]) if metrics["llm_times"] else 0,
-                        "avg_tts_time": sum(metrics["tts_times"]) / len(metrics["tts_times"]) if metrics["tts_times"] else 0,
-                        "avg_total_time": sum(metrics["total_cycle_times"]) / len(metrics["total_cycle_times"]) if metrics["total_cycle_times"] else 0,
-                    }
-
-                    existing_chat.response_time = latency_data["avg_total_time"]
-                    existing_chat.metrics = latency_data  # You'll need to add this field to your model
-                
-                db.commit()
-                db.refresh(existing_chat)
-            except:
-                ...
+                frame = protocol.decode(data)
+            except ValueError as e:
+                print_warning(f"Dropping websocket message: {e}")
+                continue
+            if frame.type == MessageType.AUDIO:
+                if engine is not None:
+                    engine.feed(data)
+                elif listener.listening:
+                    input_queue.put(data)
+            elif frame.type == MessageType.PLAYBACK_ACK:
+                player.ack(frame.seq)
+            elif frame.type == MessageType.HELLO:
+                # Prefer int16 at the TTS engine's native rate; float32 clients get their own rate
+                hello = protocol.decode_hello(frame)
+                if "int16" in hello.get("formats", []):
+                    player.configure(SampleFormat.INT16)
+                    output_queue.put_nowait(protocol.encode_hello(format="int16"))
+                else:
+                    player.configure(SampleFormat.FLOAT32, hello.get("sample_rate"))
+                    output_queue.put_nowait(protocol.encode_hello(format="float32"))
+
+    async def send_audio():
+        while True:
+            response_data = await output_queue.get()
+            await websocket.send_bytes(response_data)
+
+    tasks = [asyncio.create_task(receive_audio()), asyncio.create_task(send_audio())]
+    if engine is not None:
+        tasks.append(asyncio.create_task(engine.run()))
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            task.result()
     except WebSocketDisconnect:
         print("WebSocket Disconnected.")
-        del mouth
-        del ear
-        torch.cuda.empty_cache()
     finally:
+        if agent_thread is not None:
+            # wake the agent if it waits for audio, and let it finish before its models are returned
+            stop_agent.set()
+            listener.shutdown()
+            await asyncio.get_running_loop().run_in_executor(None, agent_thread.join, 10)
+            if agent_thread.is_alive():
+                print_warning("The information agent did not stop within 10 s")
+        await chat_persistence.unregister(session_id)
+        # Return the pooled models; the weights stay loaded for the next call
+        session_manager.close_session(session_id)
+        mouth.close()
+        ear.close()
         await websocket.close()
-        torch.cuda.empty_cache()
 
 
 # Endpoint to Get Chat History of an Agent
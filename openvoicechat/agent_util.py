@@ -248,11 +248,16 @@ def run_chat_agent(
     starting_message=True,
     logging_path="chat_log.txt",
     save_path="user_info.csv",
-    timing_callback=None
+    timing_callback=None,
+    stop_event=None,
 ):
     """
     Enhanced chat function that uses LangChain agent to collect user information.
     Now with parallel sentence processing for faster responses.
+
+    :param stop_event: A threading.Event that ends the conversation once set, e.g. when the
+        call's websocket disconnects. The ear's listener must stop blocking too, see
+        Listener_ws.shutdown().
     """
     print("Running INFO AGENT")
     
@@ -325,13 +330,15 @@ def run_chat_agent(
         
         # Main conversation loop
         pre_interruption_text = ""
-        while True:
+        while stop_event is None or not stop_event.is_set():
             # Start timing the total cycle
             total_cycle_start = time.time()
             
             # Time STT
             stt_start = time.time()
             user_input = pre_interruption_text + " " + ear.listen()
+            if stop_event is not None and stop_event.is_set():
+                break
             stt_end = time.time()
             if timing_callback:
                 timing_callback("stt", stt_start, stt_end)
@@ -399,6 +406,9 @@ def run_chat_agent(
                 # End the conversation after saving data
                 break
                 
+    except EOFError:
+        # the call ended while listening
+        pass
     except Exception as e:
         print(f"Error in LangChain agent: {e}")
         print("Falling back to standard agent...")
\ No newline at end of file
@@ -0,0 +1,497 @@
+import asyncio
+import inspect
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+import numpy as np
+
+from .stt.vad import StreamingVAD, VoiceActivityDetection, get_vad_scheduler
+from .tts.base import remove_words_in_brackets_and_spaces
+from .utils import Listener_ws, clean_text_for_tts, random_greeting
+
+# CPU work (VAD, local STT and TTS) runs on a small pool sized to the machine; blocking network
+# calls (LLM token streams, cloud STT/TTS) wait on a larger one
+ENGINE_CPU_WORKERS = int(os.environ.get("ENGINE_CPU_WORKERS", os.cpu_count() or 4))
+ENGINE_IO_WORKERS = int(os.environ.get("ENGINE_IO_WORKERS", 32))
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(kind="cpu") -> ThreadPoolExecutor:
+    """
+    :param kind: "cpu" or "io"
+    :return: The process-wide executor of that kind, shared by all conversations
+    """
+    with _executors_lock:
+        if kind not in _executors:
+            workers = ENGINE_CPU_WORKERS if kind == "cpu" else ENGINE_IO_WORKERS
+            _executors[kind] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"engine-{kind}")
+        return _executors[kind]
+
+
+def _put_latest(q: asyncio.Queue, item):
+    # drop the oldest item instead of blocking the websocket reader
+    if q.full():
+        q.get_nowait()
+    q.put_nowait(item)
+
+
+def _drain(q: asyncio.Queue):
+    while not q.empty():
+        q.get_nowait()
+
+
+class ConversationEngine:
+    def __init__(
+        self,
+        mouth,
+        ear,
+        chatbot,
+        minibot_args=None,
+        verbose=True,
+        starting_message=True,
+        timing_callback=None,
+        lookahead=0.5,
+        max_queued_frames=256,
+        transcript_callback=None,
+    ):
+        """
+        Runs one call as a pipeline of coroutines on the event loop:
+
+            listen -> transcribe -> generate -> synthesize -> send
+
+        connected by bounded asyncio queues. VAD, STT and TTS run on the shared CPU executor and
+        the blocking LLM stream on the shared IO executor, so an idle call costs no OS thread.
+
+        :param mouth: A BaseMouth whose player is a Player_ws
+        :param ear: A BaseEar, used for its VAD, endpointer, transcribe() and interruption detector
+        :param chatbot: The session's chatbot
+        :param minibot_args: Minibot args passed to the chatbot every turn
+        :param verbose: Print the user's and the bot's turns
+        :param starting_message: Greet the caller when the call starts
+        :param timing_callback: Called with (phase, start_time, end_time) for "stt", "llm", "tts"
+            and "total_cycle"
+        :param lookahead: Seconds of audio sent ahead of the client's playback. Less means less
+            audio to drop on barge-in.
+        :param max_queued_frames: Websocket frames buffered before the oldest are dropped
+        :param transcript_callback: Called on the event loop with each TranscriptEvent of the
+            user's speech while it is spoken, for ears with partial_results, e.g. to start
+            retrieval before the turn ends
+        """
+        self.mouth = mouth
+        self.ear = ear
+        self.player = mouth.player
+        self.chatbot = chatbot
+        self.minibot_args = minibot_args if minibot_args is not None else {}
+        self.verbose = verbose
+        self.starting_message = starting_message
+        self.timing_callback = timing_callback
+        self.lookahead = lookahead
+        self.transcript_callback = transcript_callback
+
+        self.decoder = Listener_ws(None)
+        self.cpu = get_executor("cpu")
+        self.io = get_executor("io")
+        self.stt = self.io if ear.stream else self.cpu
+
+        self._frames = asyncio.Queue(max_queued_frames)
+        self._utterances = asyncio.Queue(4)
+        self._transcripts = asyncio.Queue(4)
+        self._sentences = asyncio.Queue(4)
+        self._audio = asyncio.Queue(2)
+
+        self._turn_id = 0
+        self._turn_task = None
+        self._turn_cleanup = None  # future finishing the chatbot context of an interrupted turn
+        self._turn_start = {}
+        self._spoken = {}
+        self._utterance_count = 0
+        self._partial = None  # latest partial transcript, not yet given to the endpointer
+
+    def feed(self, data: bytes):
+        """
+        Hands an AUDIO frame from the websocket to the pipeline. Call from the event loop.
+        """
+        _put_latest(self._frames, data)
+
+    @property
+    def speaking(self) -> bool:
+        """
+        True while a response is being generated or its audio is still playing
+        """
+        generating = self._turn_task is not None and not self._turn_task.done()
+        return generating or self.player.playing
+
+    def barge_in(self):
+        """
+        Drops the current response: audio queued here and on the client, pending synthesis and
+        the LLM stream
+        """
+        self._turn_id += 1
+        if self._turn_task is not None:
+            self._turn_task.cancel()
+        _drain(self._sentences)
+        _drain(self._audio)
+        self.player.stop()
+
+    def _timing(self, phase, start, end):
+        if self.timing_callback is not None:
+            self.timing_callback(phase, start, end)
+
+    def _transcribe_sync(self, audio: np.ndarray) -> str:
+        if self.ear.stream:
+            return self.ear._sim_transcribe_stream(audio).strip()
+        return self.ear.transcribe(audio).strip()
+
+    async def _listen(self):
+        """
+        Cuts the incoming audio into utterances like record_user: an utterance ends after the
+        pause the ear's endpointer asks for, at most silence_seconds, and keeps up to
+        silence_seconds of audio before it started.
+        A local silero VAD is scored through the process-wide batch scheduler, together with the
+        frames of every other call. Ears with partial results transcribe each utterance while it
+        is spoken, and the partials feed the endpointer. Speech over the bot's audio is only
+        streamed once the interruption detector's energy tier takes it for a barge-in, so
+        backchannels and noise never reach a cloud ear.
+        """
+        loop = asyncio.get_running_loop()
+        scheduler = get_vad_scheduler() if isinstance(self.ear.vad, VoiceActivityDetection) else None
+        endpointer = self.ear.make_endpointer()
+        speech = StreamingVAD(
+            scheduler or self.ear.vad,
+            min_silence_ms=self.ear.silence_seconds * 1000,
+            endpointer=endpointer,
+        )
+        live = None  # the ear's LiveTranscription of the current utterance
+        live_streaming = getattr(self.ear, "partial_results", False) and hasattr(self.ear, "open_stream")
+        preroll_bytes = int(self.decoder.RATE * self.ear.silence_seconds) * 2
+        interrupt_samples = int(self.decoder.RATE * self.ear.interruption.interrupt_speech_ms / 1000)
+        barge_start = None  # where speech over the bot's audio started
+        audio = bytearray()
+        if scheduler is not None:
+            scheduler.open_stream()
+        try:
+            while True:
+                data = self.decoder.decode(await self._frames.get())
+                if self._partial is not None:
+                    # between frames, so the VAD never reads the endpointer while it changes
+                    endpointer.update_transcript(self._partial)
+                    self._partial = None
+                audio.extend(data)
+                if live is not None:
+                    live.feed(data)
+                if scheduler is not None:
+                    events = await speech.process_async(data)
+                else:
+                    events = await loop.run_in_executor(self.cpu, speech.process, data)
+                for event in events:
+                    if event.type == "start":
+                        barge_start = event.sample if self.speaking else None
+                        if live_streaming and barge_start is None:
+                            live = self.ear.open_stream(self._on_transcript_event(loop, endpointer))
+                            live.feed(bytes(audio))
+                    else:
+                        barge_start = None
+                        transcript = live.finish() if live is not None else None
+                        live = None
+                        utterance = np.frombuffer(bytes(audio), dtype=np.int16) / (1 << 15)
+                        audio = bytearray()
+                        self.player.end_of_utterance()
+                        await self._utterances.put((utterance.astype(np.float32), monotonic(), transcript))
+                if barge_start is not None and speech.position - barge_start >= interrupt_samples:
+                    # checked again as the speech goes on, pauses between words count against it
+                    speech_bytes = (speech.position - barge_start) * 2
+                    if self._check_interruption(bytes(audio[-speech_bytes:])):
+                        barge_start = None
+                        if live_streaming:
+                            live = self.ear.open_stream(self._on_transcript_event(loop, endpointer))
+                            live.feed(bytes(audio))
+                if not speech.triggered and len(audio) > preroll_bytes:
+                    del audio[:-preroll_bytes]
+        finally:
+            if scheduler is not None:
+                scheduler.close_stream()
+
+    def _on_transcript_event(self, loop, endpointer):
+        self._utterance_count += 1
+        utterance = self._utterance_count
+        self._partial = None
+
+        def set_partial(text):
+            if utterance == self._utterance_count:
+                self._partial = text
+
+        def on_event(event):
+            # called from the ear's thread, which may serve other calls too, so nothing is done
+            # here; late events of an earlier utterance are dropped
+            if utterance != self._utterance_count:
+                return
+            if endpointer is not None and event.type == "partial":
+                loop.call_soon_threadsafe(set_partial, event.text)
+            if self.transcript_callback is not None:
+                loop.call_soon_threadsafe(self.transcript_callback, event)
+
+        return on_event
+
+    def _check_interruption(self, data) -> bool:
+        """
+        Barges in without waiting for the end of the utterance once speech over the bot's audio
+        has been loud and long enough to pass the detector's energy tier
+
+        :return: Whether it barged in
+        """
+        audio = (np.frombuffer(data, dtype=np.int16) / (1 << 15)).astype(np.float32)
+        if self.speaking and self.ear.interruption.gate(audio) == "interruption":
+            self.barge_in()
+            return True
+        return False
+
+    async def _transcribe(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            audio, end_of_speech, transcript = await self._utterances.get()
+            start = monotonic()
+            if transcript is not None:
+                # transcribed while it was spoken, only the final results are left to wait for.
+                # Speech over the bot is only streamed once it barged in, see _listen.
+                text = (await asyncio.wrap_future(transcript)).strip()
+                if self.speaking:
+                    # the bot started speaking after the utterance did
+                    noise = self.ear.interruption.gate(audio) == "noise"
+                    if noise or not text or self.ear.interruption.is_backchannel(text):
+                        continue
+                    self.barge_in()
+            elif self.speaking:
+                # backchannels and noise are settled by the cheap tiers, without STT
+                decision = await loop.run_in_executor(self.stt, self.ear.interruption.decide, audio)
+                if not decision.interrupt:
+                    continue
+                self.barge_in()
+                text = decision.text.strip()
+                if not text:
+                    text = await loop.run_in_executor(self.stt, self._transcribe_sync, audio)
+            else:
+                text = await loop.run_in_executor(self.stt, self._transcribe_sync, audio)
+            self._timing("stt", start, monotonic())
+            if not text:
+                continue
+            if self.verbose:
+                print("USER: ", text)
+            await self._transcripts.put((text, end_of_speech))
+
+    async def _generate(self):
+        while True:
+            text, end_of_speech = await self._transcripts.get()
+            # a new response supersedes anything of the previous one still in the pipeline
+            self._turn_id += 1
+            turn = self._turn_id
+            self._turn_start[turn] = end_of_speech
+            self._turn_task = asyncio.create_task(self._respond(text, turn))
+            await asyncio.wait({self._turn_task})
+            if not self._turn_task.cancelled() and self._turn_task.exception() is not None:
+                print(f"Error while generating a response: {self._turn_task.exception()}")
+
+    async def _respond(self, text, turn):
+        """
+        Streams the LLM response for one user turn and queues it sentence by sentence
+        """
+        if self._turn_cleanup is not None:
+            # the interrupted turn before this one must record its response first
+            await asyncio.wrap_future(self._turn_cleanup)
+            self._turn_cleanup = None
+        start = monotonic()
+        tokens = self.chatbot.run(text, self.minibot_args)
+        response = ""
+        pending = ""
+        first_sentence = True
+        future = None
+        try:
+            while True:
+                future = self.io.submit(next, tokens, None)
+                token = await asyncio.wrap_future(future)
+                if token is None:
+                    break
+                token = token.replace("Filler:", "")
+                response += token
+                pending += token
+                sentences = self.mouth.seg.segment(pending)
+                if len(sentences) > 1:
+                    if first_sentence:
+                        self._timing("llm", start, monotonic())
+                        first_sentence = False
+                    for sentence in sentences[:-1]:
+                        await self._sentences.put((turn, sentence))
+                    pending = sentences[-1]
+            if pending.strip():
+                if first_sentence:
+                    self._timing("llm", start, monotonic())
+                await self._sentences.put((turn, pending))
+        except asyncio.CancelledError:
+            self._turn_cleanup = self.io.submit(self._finish_interrupted, tokens, future, turn)
+            raise
+        self.chatbot.post_process(response)
+        if hasattr(self.ear, "expect_reply_to"):
+            # e.g. a yes/no question lets a routing ear keep the answer local
+            self.ear.expect_reply_to(response)
+        if self.verbose:
+            print("BOT: ", response)
+
+    def _finish_interrupted(self, tokens, future, turn):
+        # runs on the IO executor once the token pending at barge-in has arrived
+        if future is not None:
+            try:
+                future.result()
+            except BaseException:
+                pass
+        started = inspect.getgeneratorstate(tokens) != inspect.GEN_CREATED
+        tokens.close()
+        spoken = self._spoken.pop(turn, [])
+        self._turn_start.pop(turn, None)
+        if started:
+            self.chatbot.post_process(" ".join(spoken + ["..."]))
+
+    async def _synthesize(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            turn, sentence = await self._sentences.get()
+            text = remove_words_in_brackets_and_spaces(clean_text_for_tts(sentence))
+            if turn != self._turn_id or not text:
+                continue
+            start = monotonic()
+            audio = await loop.run_in_executor(self.cpu, self.mouth.run_tts, text)
+            if turn in self._turn_start and turn not in self._spoken:
+                self._timing("tts", start, monotonic())
+            if turn == self._turn_id:
+                await self._audio.put((turn, sentence, audio))
+
+    async def _send(self):
+        clock = self.player.clock
+        while True:
+            turn, sentence, audio = await self._audio.get()
+            # keep only lookahead seconds queued on the client, so a barge-in drops little audio
+            while clock.remaining > self.lookahead and turn == self._turn_id:
+                await asyncio.sleep(clock.remaining - self.lookahead)
+            if turn != self._turn_id:
+                continue
+            self.player.play(audio, self.mouth.sample_rate)
+            if turn not in self._spoken and turn in self._turn_start:
+                self._timing("total_cycle", self._turn_start.pop(turn), monotonic())
+            self._spoken.setdefault(turn, []).append(sentence)
+
+    async def run(self):
+        """
+        Runs the call until cancelled
+        """
+        stages = [
+            asyncio.create_task(stage())
+            for stage in (self._listen, self._transcribe, self._generate, self._synthesize, self._send)
+        ]
+        if self.starting_message:
+            await self._sentences.put((self._turn_id, random_greeting(self.minibot_args)))
+        try:
+            done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in stages:
+                task.cancel()
+            if self._turn_task is not None:
+                self._turn_task.cancel()
+
+
+if __name__ == "__main__":
+    # Scaling check: python -m openvoicechat.engine
+    # Runs a few hundred calls of silence plus one talking caller against stub models and reports
+    # the OS threads used.
+    import queue
+    import time
+    from types import SimpleNamespace
+
+    import pysbd
+
+    from .protocol import encode_audio
+    from .stt.interruption import InterruptionDetector
+    from .utils import Player_ws
+
+    N_CALLS = 300
+    RATE = 16000
+
+    class _StubVAD:
+        def predict(self, frames, state=None, context=None):
+            return (np.abs(frames).max(axis=1) > 0.03).astype(np.float32), state, context
+
+    class _StubEar:
+        stream = False
+        silence_seconds = 0.5
+        not_interrupt_words = ["yeah", "hmm"]
+        vad = _StubVAD()
+
+        def __init__(self):
+            self.interruption = InterruptionDetector(self.transcribe, self.not_interrupt_words)
+
+        def make_endpointer(self):
+            return None
+
+        def transcribe(self, audio):
+            time.sleep(0.02)
+            return "tell me about your products"
+
+    class _StubMouth:
+        sample_rate = 16000
+        seg = pysbd.Segmenter(language="en", clean=True)
+
+        def __init__(self, player):
+            self.player = player
+
+        def run_tts(self, text):
+            time.sleep(0.01)
+            return np.zeros(int(0.05 * len(text) * self.sample_rate), dtype=np.int16)
+
+    class _StubChatbot:
+        def __init__(self):
+            self.messages = []
+
+        def run(self, text, minibot_args=None):
+            self.messages.append({"role": "user", "content": text})
+            for word in "We sell voice agents. They answer calls. They never sleep.".split(" "):
+                time.sleep(0.005)
+                yield word + " "
+
+        def post_process(self, response):
+            self.messages.append({"role": "assistant", "content": response})
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        threads_before = threading.active_count()
+        engines, sent = [], []
+        for i in range(N_CALLS):
+            out = asyncio.Queue()
+            player = Player_ws(out, loop=loop)
+            engine = ConversationEngine(_StubMouth(player), _StubEar(), _StubChatbot(), verbose=False)
+            engines.append(engine)
+            sent.append(out)
+        tasks = [asyncio.create_task(engine.run()) for engine in engines]
+
+        silence = np.zeros(512, dtype=np.int16)
+        tone = (np.sin(np.arange(512) / 3) * 8000).astype(np.int16)
+        start = time.perf_counter()
+        for step in range(int(3 * RATE / 512)):
+            for i, engine in enumerate(engines):
+                speech = i == 0 and 16 <= step < 48
+                engine.feed(encode_audio(tone if speech else silence, RATE, 0))
+            await asyncio.sleep(512 / RATE)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(3)
+
+        print(f"{N_CALLS} calls, 3 s of audio each in {elapsed:.1f} s of wall time")
+        print(f"threads: {threads_before} before, {threading.active_count()} while running")
+        print(f"talking caller context: {engines[0].chatbot.messages}")
+        print(f"frames sent to the talking caller: {sent[0].qsize()}, to an idle caller: {sent[1].qsize()}")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(main())
@@ -49,20 +49,30 @@ class Chatbot_LLM(BaseChatbot):
         tool_choice=NOT_GIVEN,
         tool_utterances=None,
         functions=None,
+        client=None,
+        max_tokens=NOT_GIVEN,
+        temperature=NOT_GIVEN,
     ):
+        """
+        :param client: An existing OpenAI client to use. Sessions created by the SessionManager share
+            one client (and its connection pool) instead of creating their own.
+        """
         if tools is None:
             tools = NOT_GIVEN
         if tool_utterances is None:
             tool_utterances = {}
         if functions is None:
-            self.functions = {}
-        if api_key == "":
-            load_dotenv()
-            api_key = os.getenv("LLM_EC2_KEY")
-            
+            functions = {}
+        if client is None:
+            if api_key == "":
+                load_dotenv()
+                api_key = os.getenv("LLM_EC2_KEY")
+            client = OpenAI(api_key=api_key)
 
         self.MODEL = Model
-        self.client = OpenAI(api_key=api_key)
+        self.client = client
+        self.max_tokens = max_tokens
+        self.temperature = temperature
         #print("Client initialized:", self.client)  # Debugging line
         self.messages = []
         self.messages.append({"role": "system", "content": sys_prompt})
@@ -106,6 +116,8 @@ class Chatbot_LLM(BaseChatbot):
                 stream=True,
                 tools=self.tools,
                 tool_choice=self.tool_choice,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
             )
 
             for chunk in stream:
@@ -157,6 +169,12 @@ class Chatbot_LLM(BaseChatbot):
                 if finish_reason == "stop":
                     finished = True
 
+    def get_context(self):
+        return self.messages
+
+    def set_context(self, context):
+        self.messages = context
+
     def post_process(self, response):
         # Remove the tool utterances from the response
         # for tool in self.tool_utterances:
@@ -0,0 +1,138 @@
+import os
+import threading
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from .llm_EC2 import Chatbot_LLM
+
+
+class ChatSession:
+    """
+    Conversation state for a single call: the chatbot (messages, tools,
+    minibot) and the minibot args used for every turn.
+    """
+
+    def __init__(self, session_id, chatbot, minibot_args=None):
+        self.session_id = session_id
+        self.chatbot = chatbot
+        self.minibot_args = minibot_args if minibot_args is not None else {}
+
+    def get_context(self):
+        return self.chatbot.get_context()
+
+
+class SessionManager:
+    def __init__(self, chatbot_class=Chatbot_LLM, api_key="", client=None, **chatbot_kwargs):
+        """
+        Creates per-call chatbots that share one OpenAI client.
+
+        :param chatbot_class: The chatbot class instantiated for every session
+        :param api_key: API key for the shared client. Read from LLM_EC2_KEY when empty.
+        :param client: An existing client to share instead of creating one
+        :param chatbot_kwargs: Default keyword arguments for every chatbot
+        """
+        if client is None:
+            if api_key == "":
+                load_dotenv()
+                api_key = os.getenv("LLM_EC2_KEY")
+            client = OpenAI(api_key=api_key)
+        self.client = client
+        self.chatbot_class = chatbot_class
+        self.chatbot_kwargs = chatbot_kwargs
+        self._sessions: Dict[str, ChatSession] = {}
+        self._lock = threading.Lock()
+
+    def create_session(self, session_id, context=None, minibot_args=None, **chatbot_kwargs) -> ChatSession:
+        """
+        :param session_id: Unique id of the call
+        :param context: Messages to start the conversation from. They are copied so the
+            session never shares message objects with the caller or another session.
+        :param minibot_args: Minibot args for this call
+        :param chatbot_kwargs: Per-session overrides of the default chatbot arguments
+        """
+        kwargs = dict(self.chatbot_kwargs)
+        kwargs.update(chatbot_kwargs)
+        chatbot = self.chatbot_class(client=self.client, **kwargs)
+        if context:
+            chatbot.set_context([dict(message) for message in context])
+        session = ChatSession(session_id, chatbot, minibot_args)
+        with self._lock:
+            if session_id in self._sessions:
+                raise ValueError(f"Session {session_id} already exists")
+            self._sessions[session_id] = session
+        return session
+
+    def get_session(self, session_id) -> Optional[ChatSession]:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def close_session(self, session_id) -> Optional[ChatSession]:
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+if __name__ == "__main__":
+    # Concurrency check: python -m openvoicechat.llm.session
+    # Runs 50 interleaved sessions against a stubbed LLM and checks that transcripts never cross.
+    import random
+    import time
+    from types import SimpleNamespace
+
+    class _StubCompletions:
+        def create(self, model, messages, stream, **kwargs):
+            # Echo the last user message back word by word, yielding the GIL in between
+            reply = "echo " + messages[-1]["content"]
+            for word in reply.split(" "):
+                time.sleep(random.random() / 1000)
+                yield SimpleNamespace(
+                    choices=[
+                        SimpleNamespace(
+                            finish_reason=None,
+                            delta=SimpleNamespace(tool_calls=None, content=word + " "),
+                        )
+                    ]
+                )
+            yield SimpleNamespace(
+                choices=[
+                    SimpleNamespace(
+                        finish_reason="stop",
+                        delta=SimpleNamespace(tool_calls=None, content=None),
+                    )
+                ]
+            )
+
+    stub_client = SimpleNamespace(chat=SimpleNamespace(completions=_StubCompletions()))
+    manager = SessionManager(client=stub_client)
+    n_sessions, n_turns = 50, 10
+    errors = []
+
+    def simulate(i):
+        session = manager.create_session(
+            f"call-{i}",
+            context=[{"role": "system", "content": f"system call-{i}"}],
+            minibot_args={"agent_name": f"agent-{i}"},
+        )
+        for turn in range(n_turns):
+            time.sleep(random.random() / 100)
+            session.chatbot.generate_response(f"call-{i} turn-{turn}", session.minibot_args)
+        for message in session.get_context():
+            if f"call-{i}" not in message["content"].split():
+                errors.append((i, message))
+        if len(session.get_context()) != 1 + 2 * n_turns:
+            errors.append((i, len(session.get_context())))
+        manager.close_session(f"call-{i}")
+
+    threads = [threading.Thread(target=simulate, args=(i,)) for i in range(n_sessions)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors, errors[:5]
+    assert len(manager) == 0
+    print(f"{n_sessions} concurrent sessions x {n_turns} turns: transcripts isolated")
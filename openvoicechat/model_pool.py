@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MODEL_POOL_MEMORY_MB = int(os.environ.get("MODEL_POOL_MEMORY_MB", 0))
+MODEL_POOL_MAX_IDLE = int(os.environ.get("MODEL_POOL_MAX_IDLE", 4))
+
+
+class ModelHandle:
+    """
+    Lightweight per-session reference to a pooled model.
+    The model itself is shared and must be treated as read-only; any
+    per-session mutable state belongs on the object holding the handle.
+    """
+
+    def __init__(self, pool, key: Hashable, model: Any):
+        self._pool = pool
+        self.key = key
+        self.model = model
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self.key)
+
+    def __enter__(self):
+        return self.model
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+class _PoolEntry:
+    def __init__(self, model: Any, size_bytes: int, pinned: bool):
+        self.model = model
+        self.size_bytes = size_bytes
+        self.pinned = pinned
+        self.refcount = 0
+        self.last_used = time.monotonic()
+
+
+class ModelPool:
+    def __init__(self, memory_budget_mb=MODEL_POOL_MEMORY_MB, max_idle=MODEL_POOL_MAX_IDLE):
+        """
+        Process-wide registry of loaded models.
+
+        :param memory_budget_mb: Soft limit for the summed size of pooled models. Idle models are
+            evicted least-recently-used first when it is exceeded. 0 disables the budget.
+        :param max_idle: Maximum number of unpinned models kept loaded with no session using them.
+        """
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.max_idle = max_idle
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._loading = {}
+
+    def acquire(
+        self,
+        key: Hashable,
+        loader: Callable[[], Any],
+        size_bytes: int = 0,
+        pinned: bool = False,
+    ) -> ModelHandle:
+        """
+        Returns a handle to the model stored under key, calling loader() only
+        if the model is not loaded yet. Concurrent acquires of the same key
+        wait for a single load.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refcount += 1
+                    entry.last_used = time.monotonic()
+                    entry.pinned = entry.pinned or pinned
+                    self._entries.move_to_end(key)
+                    return ModelHandle(self, key, entry.model)
+                event = self._loading.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._loading[key] = event
+                    break
+            event.wait()
+
+        try:
+            model = loader()
+        except Exception:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+            raise
+
+        with self._lock:
+            entry = _PoolEntry(model, size_bytes, pinned)
+            entry.refcount = 1
+            self._entries[key] = entry
+            del self._loading[key]
+            self._evict()
+        event.set()
+        return ModelHandle(self, key, model)
+
+    def preload(self, key: Hashable, loader: Callable[[], Any], size_bytes: int = 0):
+        """
+        Loads a model at startup and pins it so it is never evicted.
+        """
+        self.acquire(key, loader, size_bytes=size_bytes, pinned=True).release()
+
+    def release(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refcount = max(0, entry.refcount - 1)
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        idle = [
+            key
+            for key, entry in self._entries.items()
+            if entry.refcount == 0 and not entry.pinned
+        ]
+        # OrderedDict keeps least recently used first
+        while idle and (
+            len(idle) > self.max_idle
+            or (self.memory_budget and self.total_bytes() > self.memory_budget)
+        ):
+            key = idle.pop(0)
+            del self._entries[key]
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(entry.size_bytes for entry in self._entries.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                str(key): {
+                    "refcount": entry.refcount,
+                    "pinned": entry.pinned,
+                    "size_mb": round(entry.size_bytes / (1024 * 1024), 1),
+                    "idle_seconds": round(time.monotonic() - entry.last_used, 1),
+                }
+                for key, entry in self._entries.items()
+            }
+
+
+_MODEL_POOL: Optional[ModelPool] = None
+_MODEL_POOL_LOCK = threading.Lock()
+
+
+def get_model_pool() -> ModelPool:
+    global _MODEL_POOL
+    with _MODEL_POOL_LOCK:
+        if _MODEL_POOL is None:
+            _MODEL_POOL = ModelPool()
+        return _MODEL_POOL
+
+
+def file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
@@ -0,0 +1,95 @@
+"""
+Binary framing for the chat websocket (see static/streaming_audio.js for the client side).
+
+Every message starts with a 12 byte little-endian header
+
+    version (uint8) | type (uint8) | sample format (uint8) | flags (uint8) | sequence (uint32) | sample rate (uint32)
+
+followed by the payload: PCM samples for AUDIO messages, UTF-8 JSON for HELLO and
+nothing for the other control messages.
+"""
+import json
+import struct
+from enum import IntEnum
+from typing import NamedTuple
+
+import numpy as np
+
+VERSION = 1
+HEADER = struct.Struct("<BBBBII")
+
+
+class MessageType(IntEnum):
+    AUDIO = 1
+    HELLO = 2  # format negotiation, JSON payload
+    BARGE_IN = 3  # server -> client: stop playback and drop queued audio
+    END_OF_UTTERANCE = 4  # server -> client: the user's turn has been captured
+    PLAYBACK_ACK = 5  # client -> server: the audio frame with this sequence number finished playing
+
+
+class SampleFormat(IntEnum):
+    NONE = 0
+    INT16 = 1
+    FLOAT32 = 2
+
+
+SAMPLE_DTYPES = {SampleFormat.INT16: np.int16, SampleFormat.FLOAT32: np.float32}
+
+
+class Frame(NamedTuple):
+    type: MessageType
+    seq: int
+    sample_rate: int
+    sample_format: SampleFormat
+    payload: bytes
+
+
+def encode(message_type, payload=b"", seq=0, sample_rate=0, sample_format=SampleFormat.NONE) -> bytes:
+    return HEADER.pack(VERSION, message_type, sample_format, 0, seq, sample_rate) + payload
+
+
+def decode(data: bytes) -> Frame:
+    """
+    :raises ValueError: if data is not a frame of a supported protocol version
+    """
+    if len(data) < HEADER.size:
+        raise ValueError(f"Frame of {len(data)} bytes is shorter than the header")
+    version, message_type, sample_format, _, seq, sample_rate = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f"Unsupported protocol version {version}")
+    return Frame(
+        MessageType(message_type),
+        seq,
+        sample_rate,
+        SampleFormat(sample_format),
+        data[HEADER.size:],
+    )
+
+
+def encode_audio(audio: np.ndarray, sample_rate: int, seq: int, sample_format=SampleFormat.INT16) -> bytes:
+    """
+    :param audio: int16 samples or float samples in [-1, 1]
+    """
+    if sample_format == SampleFormat.INT16:
+        if audio.dtype != np.int16:
+            audio = (np.clip(audio, -1.0, 1.0) * ((1 << 15) - 1)).astype(np.int16)
+    else:
+        if audio.dtype == np.int16:
+            audio = audio / (1 << 15)
+        audio = audio.astype(np.float32)
+    return encode(MessageType.AUDIO, audio.tobytes(), seq, sample_rate, sample_format)
+
+
+def decode_audio(frame: Frame) -> np.ndarray:
+    """
+    :return: the samples of an AUDIO frame in their wire dtype
+    """
+    return np.frombuffer(frame.payload, dtype=SAMPLE_DTYPES[frame.sample_format])
+
+
+def encode_hello(**fields) -> bytes:
+    return encode(MessageType.HELLO, json.dumps(fields).encode())
+
+
+def decode_hello(frame: Frame) -> dict:
+    return json.loads(frame.payload.decode())
@@ -0,0 +1,479 @@
+"""
+Model-serving sidecar shared by the web workers on one machine.
+
+Start it with
+
+    OVC_SIDECAR_ADDRESS=/tmp/ovc-sidecar.sock python -m openvoicechat.sidecar --preload vad piper
+
+and set the same OVC_SIDECAR_ADDRESS for app.py. The workers then use RemoteMouth, RemoteEar
+and RemoteVAD instead of loading Piper, Whisper and silero themselves.
+
+The socket is only open to the sidecar's user, and connections must know its authkey:
+OVC_SIDECAR_AUTHKEY, or else a random key the sidecar writes to <address>.key (mode 0600) at
+startup, where the workers read it.
+
+Requests and replies are small pickled tuples over a multiprocessing.connection socket. Audio
+goes through two shared-memory rings per connection instead of the socket: the client writes
+its input into the upload ring, and the server writes arrays it returns into the download ring.
+Requests for the same model from all workers queue on one thread per model. The thread
+collects them into micro-batches and calls a model's `<method>_batch` when it has one.
+"""
+import argparse
+import importlib
+import os
+import queue
+import secrets
+import threading
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError, resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+from time import monotonic
+
+import numpy as np
+
+if __name__ == "__main__":
+    from openvoicechat.stt.base import BaseEar
+    from openvoicechat.tts.base import BaseMouth
+else:
+    from .stt.base import BaseEar
+    from .tts.base import BaseMouth
+
+OVC_SIDECAR_ADDRESS = os.environ.get("OVC_SIDECAR_ADDRESS")
+OVC_SIDECAR_AUTHKEY = os.environ.get("OVC_SIDECAR_AUTHKEY")
+OVC_SIDECAR_RING_MB = int(os.environ.get("OVC_SIDECAR_RING_MB", 8))
+
+# Models the sidecar can host, by kind
+MODELS = {
+    "vad": ("openvoicechat.stt.vad", "VoiceActivityDetection"),
+    "piper": ("openvoicechat.tts.tts_piper", "Mouth_piper"),
+    "faster_whisper": ("openvoicechat.stt.stt_faster_whisper", "Ear_faster_whisper"),
+    "hf": ("openvoicechat.stt.stt_hf", "Ear_hf"),
+}
+
+
+def _key_path(address):
+    return address + ".key"
+
+
+def create_authkey(address) -> bytes:
+    """
+    :return: OVC_SIDECAR_AUTHKEY, or else a new random key, written to the address's key file
+    """
+    if OVC_SIDECAR_AUTHKEY:
+        return OVC_SIDECAR_AUTHKEY.encode()
+    key = secrets.token_hex(32)
+    path = _key_path(address)
+    if os.path.exists(path):
+        os.unlink(path)
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as f:
+        f.write(key)
+    return key.encode()
+
+
+def read_authkey(address) -> bytes:
+    """
+    :return: OVC_SIDECAR_AUTHKEY, or else the key the sidecar at address wrote at startup
+    """
+    if OVC_SIDECAR_AUTHKEY:
+        return OVC_SIDECAR_AUTHKEY.encode()
+    try:
+        with open(_key_path(address)) as f:
+            return f.read().strip().encode()
+    except FileNotFoundError:
+        raise ValueError(f"No sidecar authkey; set OVC_SIDECAR_AUTHKEY or start the sidecar at {address}")
+
+
+def model_spec(kind, **kwargs):
+    """
+    :return: A hashable description of a model: its kind and constructor arguments
+    """
+    if kind not in MODELS:
+        raise ValueError(f"Unknown sidecar model {kind}, expected one of {list(MODELS)}")
+    return kind, tuple(sorted(kwargs.items()))
+
+
+class SharedRingBuffer:
+    def __init__(self, name=None, size=OVC_SIDECAR_RING_MB << 20):
+        """
+        A shared-memory region written as a ring. Every request/reply on a connection is
+        finished before the next one starts, so a write only has to stay intact until the
+        other side has read it.
+
+        :param name: Attach to an existing ring. Creates a new one when None.
+        :param size: Size in bytes of a new ring
+        """
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # the creating process unlinks it; don't let this process's tracker unlink it as well
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.size = self.shm.size
+        self._head = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _reserve(self, n_bytes):
+        if n_bytes > self.size:
+            return None
+        if self._head + n_bytes > self.size:
+            self._head = 0
+        offset = self._head
+        self._head += (n_bytes + 63) & ~63  # keep every write cache-line aligned
+        return offset
+
+    def write(self, data):
+        """
+        :param data: An array, or a list of bytes chunks that are written back to back
+        :return: A reference for read(), or None if data does not fit in the ring
+        """
+        if isinstance(data, np.ndarray):
+            offset = self._reserve(data.nbytes)
+            if offset is None:
+                return None
+            np.ndarray(data.shape, data.dtype, buffer=self.shm.buf, offset=offset)[...] = data
+            return offset, data.dtype.str, data.shape, False
+        n_bytes = sum(len(chunk) for chunk in data)
+        offset = self._reserve(n_bytes)
+        if offset is None:
+            return None
+        position = offset
+        for chunk in data:
+            self.shm.buf[position : position + len(chunk)] = chunk
+            position += len(chunk)
+        return offset, "|u1", (n_bytes,), True
+
+    def read(self, ref, copy=True):
+        """
+        :param copy: Return a view into the ring instead of a copy. The view is only valid until
+            the ring is written again.
+        """
+        offset, dtype, shape, chunks = ref
+        array = np.ndarray(shape, np.dtype(dtype), buffer=self.shm.buf, offset=offset)
+        if copy:
+            array = array.copy()
+        return [array] if chunks else array
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class _ModelWorker:
+    def __init__(self, instance, max_batch, batch_window):
+        """
+        Runs every request for one hosted model on a single thread, in micro-batches
+        """
+        self.instance = instance
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.served = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, method, args, kwargs) -> Future:
+        future = Future()
+        self.requests.put((method, args, kwargs, future))
+        return future
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self._run_batch(self._collect())
+
+    def _run_batch(self, batch):
+        # the arguments may be views into a client's ring, so none of them outlive this call
+        self.batches += 1
+        self.served += len(batch)
+        by_method = {}
+        for request in batch:
+            by_method.setdefault(request[0], []).append(request)
+        for method, requests in by_method.items():
+            batch_method = getattr(self.instance, method + "_batch", None)
+            if batch_method is not None and len(requests) > 1 and not any(r[2] for r in requests):
+                try:
+                    results = batch_method([r[1] for r in requests])
+                except Exception as e:
+                    for r in requests:
+                        r[3].set_exception(e)
+                    continue
+                for r, result in zip(requests, results):
+                    r[3].set_result(result)
+                continue
+            for _, args, kwargs, future in requests:
+                try:
+                    future.set_result(getattr(self.instance, method)(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+
+
+class SidecarServer:
+    def __init__(self, address=OVC_SIDECAR_ADDRESS, authkey=None, max_batch=16, batch_window=0.005):
+        """
+        :param address: Path of the unix socket to listen on
+        :param authkey: Shared secret of the socket, create_authkey() when None
+        :param max_batch: Most requests handed to a model at once
+        :param batch_window: Seconds a model waits for more requests after the first one
+        """
+        self.address = address
+        self.authkey = authkey
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self._workers = {}
+        self._lock = threading.Lock()
+
+    def worker(self, spec) -> _ModelWorker:
+        with self._lock:
+            if spec not in self._workers:
+                kind, kwargs = spec
+                module, name = MODELS[kind]
+                cls = getattr(importlib.import_module(module), name)
+                self._workers[spec] = _ModelWorker(cls(**dict(kwargs)), self.max_batch, self.batch_window)
+            return self._workers[spec]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                spec: {"batches": w.batches, "requests": w.served, "queued": w.requests.qsize()}
+                for spec, w in self._workers.items()
+            }
+
+    def _describe(self, spec):
+        instance = self.worker(spec).instance
+        return {"sample_rate": getattr(instance, "sample_rate", None)}
+
+    def _handle(self, conn):
+        upload = download = None
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+                op = request[0]
+                try:
+                    if op == "hello":
+                        upload, download = SharedRingBuffer(request[1]), SharedRingBuffer(request[2])
+                        conn.send(("ok", None, None))
+                    elif op == "load":
+                        conn.send(("ok", self._describe(request[1]), None))
+                    elif op == "stats":
+                        conn.send(("ok", self.stats(), None))
+                    elif op == "call":
+                        _, spec, method, args, kwargs, ref, inline = request
+                        if ref is not None:
+                            args = (upload.read(ref, copy=False),) + tuple(args)
+                        elif inline is not None:
+                            args = (inline,) + tuple(args)
+                        result = self.worker(spec).submit(method, args, kwargs).result()
+                        del args
+                        out_ref = None
+                        if isinstance(result, np.ndarray):
+                            out_ref = download.write(result)
+                            if out_ref is not None:
+                                result = None
+                        conn.send(("ok", result, out_ref))
+                    else:
+                        conn.send(("error", f"Unknown request {op}", None))
+                except Exception as e:
+                    conn.send(("error", f"{type(e).__name__}: {e}", None))
+        finally:
+            conn.close()
+            for ring in (upload, download):
+                if ring is not None:
+                    ring.close()
+
+    def serve_forever(self, preload=()):
+        for kind in preload:
+            self.worker(model_spec(kind))
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        authkey = self.authkey or create_authkey(self.address)
+        # requests are unpickled, so only the sidecar's user may connect
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, family="AF_UNIX", authkey=authkey)
+        finally:
+            os.umask(umask)
+        os.chmod(self.address, 0o600)
+        with listener:
+            print(f"Sidecar listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError, OSError) as e:
+                    print(f"Sidecar refused a connection: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+
+class SidecarClient:
+    def __init__(self, address=OVC_SIDECAR_ADDRESS, authkey=None):
+        """
+        Opens one connection and pair of rings per calling thread, so requests from concurrent
+        calls can be batched together in the sidecar
+
+        :param authkey: Shared secret of the socket, read_authkey() when None. The key file is
+            read again for every new connection, so a restarted sidecar's new key is picked up.
+        """
+        if not address:
+            raise ValueError("No sidecar address; set OVC_SIDECAR_ADDRESS")
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            conn = Client(self.address, family="AF_UNIX", authkey=self.authkey or read_authkey(self.address))
+            upload, download = SharedRingBuffer(), SharedRingBuffer()
+            connection = (conn, upload, download)
+            self._request(connection, ("hello", upload.name, download.name))
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @staticmethod
+    def _request(connection, request):
+        conn, _, download = connection
+        conn.send(request)
+        status, result, out_ref = conn.recv()
+        if status == "error":
+            raise RuntimeError(f"Sidecar error: {result}")
+        if out_ref is not None:
+            result = download.read(out_ref)
+        return result
+
+    def load(self, spec) -> dict:
+        """
+        Loads a model in the sidecar if needed and returns its description
+        """
+        return self._request(self._connection(), ("load", spec))
+
+    def stats(self) -> dict:
+        return self._request(self._connection(), ("stats",))
+
+    def call(self, spec, method, payload=None, *args, **kwargs):
+        """
+        Calls method on the hosted model. payload, an array or a list of bytes chunks, travels
+        through shared memory and is passed as the first argument.
+        """
+        connection = self._connection()
+        ref = inline = None
+        if payload is not None:
+            ref = connection[1].write(payload)
+            if ref is None:
+                inline = payload  # larger than the ring
+        return self._request(connection, ("call", spec, method, args, kwargs, ref, inline))
+
+    def close(self):
+        with self._lock:
+            for conn, upload, download in self._connections:
+                conn.close()
+                upload.close()
+                download.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_sidecar_client() -> SidecarClient:
+    """
+    :return: The process-wide client for the sidecar at OVC_SIDECAR_ADDRESS
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = SidecarClient()
+        return _client
+
+
+class RemoteVAD:
+    def __init__(self, client=None):
+        """
+        Drop-in for VoiceActivityDetection that runs silero in the sidecar
+        """
+        self.client = client if client is not None else get_sidecar_client()
+        self.spec = model_spec("vad")
+        self.client.load(self.spec)
+
+    def contains_speech(self, audio):
+        return self.client.call(self.spec, "contains_speech", list(audio))
+
+    def predict(self, frames, state=None, context=None):
+        return self.client.call(self.spec, "predict", np.asarray(frames, dtype=np.float32), state, context)
+
+    def close(self):
+        pass
+
+
+class RemoteMouth(BaseMouth):
+    def __init__(self, kind="piper", player=None, client=None, **model_kwargs):
+        """
+        :param kind: The sidecar model, e.g. "piper"
+        :param model_kwargs: Constructor arguments of the hosted mouth, e.g. device
+        """
+        self.client = client if client is not None else get_sidecar_client()
+        self.spec = model_spec(kind, **model_kwargs)
+        info = self.client.load(self.spec)
+        super().__init__(sample_rate=info["sample_rate"], player=player)
+
+    def run_tts(self, text):
+        return self.client.call(self.spec, "run_tts", None, text)
+
+
+class RemoteEar(BaseEar):
+    def __init__(self, kind="faster_whisper", silence_seconds=2, listener=None, player=None, client=None, **model_kwargs):
+        """
+        :param kind: The sidecar model, e.g. "faster_whisper"
+        :param model_kwargs: Constructor arguments of the hosted ear, e.g. model_size
+        """
+        client = client if client is not None else get_sidecar_client()
+        super().__init__(
+            silence_seconds=silence_seconds,
+            listener=listener,
+            stream=False,
+            player=player,
+            vad=RemoteVAD(client),
+        )
+        self.client = client
+        self.spec = model_spec(kind, **model_kwargs)
+        self.client.load(self.spec)
+
+    def transcribe(self, input_audio):
+        return self.client.call(self.spec, "transcribe", np.asarray(input_audio, dtype=np.float32))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve openvoicechat models to local web workers")
+    parser.add_argument("--address", default=OVC_SIDECAR_ADDRESS or "/tmp/ovc-sidecar.sock")
+    parser.add_argument("--preload", nargs="*", default=[], choices=list(MODELS))
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--batch-window-ms", type=float, default=5.0)
+    args = parser.parse_args()
+    SidecarServer(args.address, max_batch=args.max_batch, batch_window=args.batch_window_ms / 1000).serve_forever(
+        args.preload
+    )
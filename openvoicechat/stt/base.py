@@ -1,7 +1,10 @@
-from .utils import record_user, record_interruption, record_user_stream
+from .utils import RATE, AudioRingBuffer, record_user, record_interruption, record_user_stream
 from .vad import VoiceActivityDetection
+from .interruption import InterruptionDetector
+from .streaming import merge_overlap
 import re
 from time import monotonic
+from typing import NamedTuple
 import numpy as np
 from threading import Thread
 from queue import Queue
@@ -13,9 +16,22 @@ load_dotenv()
 
 TIMING = int(os.environ.get("TIMING", 0))
 TIMING_PATH = os.environ.get("TIMING_PATH", "times.csv")
+# transcribe only the audio recorded since the last pause instead of the whole utterance again
+STT_INCREMENTAL = int(os.environ.get("STT_INCREMENTAL", 1))
+INCREMENTAL_OVERLAP_SECONDS = float(os.environ.get("INCREMENTAL_OVERLAP_SECONDS", 0.5))
+
+
+class TranscriptEvent(NamedTuple):
+    # "partial": a hypothesis that may still change, text is everything heard so far
+    # "speech_end": the recognizer heard the speaker stop, text is everything settled so far
+    type: str
+    text: str
 
 
 class BaseEar:
+    # whether transcribe_stream takes an on_event callback for partial results
+    partial_results = False
+
     def __init__(
         self,
         silence_seconds=2,
@@ -24,7 +40,18 @@ class BaseEar:
         stream=False,
         timing_path=TIMING_PATH,
         player=None,
+        vad=None,
+        endpointing=None,
+        incremental=STT_INCREMENTAL,
     ):
+        """
+        :param silence_seconds: The longest pause before a turn ends
+        :param endpointing: An endpointing profile name or EndpointProfile that ends turns
+            sooner when they look finished, "off" to always wait silence_seconds.
+            Defaults to the ENDPOINT_PROFILE env var.
+        :param incremental: When a pause did not finish the sentence, transcribe only the
+            audio after it (with a short overlap) rather than the whole utterance again
+        """
         if not_interrupt_words is None:
             not_interrupt_words = [
                 "you",
@@ -34,17 +61,68 @@ class BaseEar:
             ]  # "you" because whisper says "you" in silence
         self.silence_seconds = silence_seconds
         self.not_interrupt_words = not_interrupt_words
-        self.vad = VoiceActivityDetection()
+        self.vad = vad if vad is not None else VoiceActivityDetection()
         self.listener = listener
         self.stream = stream
         self.timing_path = timing_path
         self.player = player
+        self.endpointing = endpointing
+        self.incremental = incremental
+        self._segmenter = None
+        self.audio_buffer = AudioRingBuffer()
+        self.interruption = InterruptionDetector(self._transcribe_interruption, not_interrupt_words)
         if TIMING:
             if not os.path.exists(self.timing_path):
                 columns = ["Model", "Time Taken"]
                 df = pd.DataFrame(columns=columns)
                 df.to_csv(self.timing_path, index=False)
 
+    def close(self):
+        """
+        Releases the pooled models held by this ear
+        """
+        self.vad.close()
+        self.interruption.close()
+
+    def make_endpointer(self):
+        """
+        :return: A new Endpointer for one audio stream, None when endpointing is off
+        """
+        from .endpointing import ENDPOINT_PROFILE, Endpointer
+
+        profile = self.endpointing or ENDPOINT_PROFILE
+        if profile == "off":
+            return None
+        return Endpointer(profile, max_silence_ms=self.silence_seconds * 1000)
+
+    @property
+    def segmenter(self):
+        if self._segmenter is None:
+            import pysbd
+
+            self._segmenter = pysbd.Segmenter(language="en", clean=False)
+        return self._segmenter
+
+    def transcribe_incremental(self, audio, segments, total=None) -> str:
+        """
+        Transcribes the audio recorded since the previous call, starting
+        INCREMENTAL_OVERLAP_SECONDS early so a word cut at the pause is heard whole, and
+        appends it to the utterance's committed segments.
+
+        :param audio: float32 audio of the utterance so far
+        :param segments: (samples, text) committed for this utterance, extended in place
+        :param total: Samples recorded for the utterance, when the buffer dropped its start
+        :return: The whole transcription so far
+        """
+        total = len(audio) if total is None else total
+        committed = " ".join(text for _, text in segments if text)
+        new = total - (segments[-1][0] if segments else 0)
+        if segments:
+            new += int(INCREMENTAL_OVERLAP_SECONDS * RATE)
+        text = self.transcribe(audio[-new:] if new < len(audio) else audio)
+        segments.append((total, merge_overlap(committed, text) if committed else text.strip()))
+        return " ".join(text for _, text in segments if text)
+
     def transcribe(self, input_audio: np.ndarray) -> str:
         """
         :param input_audio:
@@ -56,6 +134,8 @@ class BaseEar:
         """
         :param audio_queue: Queue containing audio chunks from pyaudio stream
         :param transcription_queue: Queue to put transcriptions
+        Ears with partial_results also take on_event, called with "partial" and "speech_end"
+        TranscriptEvents while the audio streams.
         """
         raise NotImplementedError("This method should be implemented by the subclass")
 
@@ -89,30 +169,36 @@ class BaseEar:
         :return: transcription
         records audio using record_user and returns its transcription
         """
-        import pysbd
-
         sentence_finished = False
         first = True
-        audio = np.zeros(0, dtype=np.float32)
+        segments = []
         while not sentence_finished:
-            new_audio = record_user(
-                self.silence_seconds, self.vad, self.listener, started=not first
+            # the buffer keeps the earlier recordings, so audio is everything said so far
+            audio = record_user(
+                self.silence_seconds,
+                self.vad,
+                self.listener,
+                started=not first,
+                buffer=self.audio_buffer,
+                endpointer=self.make_endpointer(),
             )
-            audio = np.concatenate((audio, new_audio), 0)
+            if self.incremental:
+                transcribe = lambda: self.transcribe_incremental(audio, segments, self.audio_buffer.cursor)
+            else:
+                transcribe = lambda: self.transcribe(audio)
             if TIMING and first:
                 start_time = monotonic()
 
-                text = self.transcribe(audio)
+                text = transcribe()
 
                 stop_time = monotonic()
                 time_diff = stop_time - start_time
                 new_row_df = pd.DataFrame([{"Model": "STT", "Time Taken": time_diff}])
                 new_row_df.to_csv(self.timing_path, mode="a", header=False, index=False)
             else:
-                text = self.transcribe(audio)
+                text = transcribe()
             first = False
-            seg = pysbd.Segmenter(language="en", clean=False)
-            if len(seg.segment(text + " .")) > 1:
+            if len(self.segmenter.segment(text + " .")) > 1:
                 sentence_finished = True
         return text
 
@@ -127,7 +213,14 @@ class BaseEar:
 
         audio_thread = Thread(
             target=record_user_stream,
-            args=(self.silence_seconds, self.vad, audio_queue, self.listener,self.player),
+            args=(
+                self.silence_seconds,
+                self.vad,
+                audio_queue,
+                self.listener,
+                self.player,
+                self.make_endpointer(),
+            ),
         )
         transcription_thread = Thread(
             target=self.transcribe_stream, args=(audio_queue, transcription_queue)
@@ -173,34 +266,40 @@ class BaseEar:
         else:
             return self._listen()
 
+    def _transcribe_interruption(self, audio: np.ndarray) -> str:
+        if self.stream:
+            return self._sim_transcribe_stream(audio)
+        return self.transcribe(audio)
+
     def interrupt_listen(self, record_seconds=100) -> str:
         """
-        Records audio with interruption. Transcribes audio if
-        voice activity detected and returns True if transcription indicates
-        interruption.
+        Records audio with interruption. Speech is passed through the interruption detector,
+        which only transcribes it when the energy and keyword tiers cannot tell a backchannel
+        from an interruption.
 
         :param record_seconds: Max seconds to record for
-        :return: boolean indicating the if an interruption occured
+        :return: The interruption's transcription, empty if there was none
         """
         while record_seconds > 0:
             interruption_audio = record_interruption(
-                self.vad, record_seconds, streamer=self.listener
+                self.vad,
+                record_seconds,
+                streamer=self.listener,
+                buffer=self.audio_buffer,
+                max_speech_ms=self.interruption.interrupt_speech_ms,
             )
             # duration of interruption audio
             if interruption_audio is None:
                 return ""
-            else:
-                duration = len(interruption_audio) / 16_000
-                if self.stream:
-                    text = self._sim_transcribe_stream(interruption_audio)
-                else:
-                    text = self.transcribe(interruption_audio)
-                # remove any punctuation using re
-                text = re.sub(r"[^\w\s]", "", text)
-                text = text.lower()
-                text = text.strip()
-                if text in self.not_interrupt_words:
-                    record_seconds -= duration
-                else:
-                    return text
+            duration = len(interruption_audio) / 16_000
+            decision = self.interruption.decide(interruption_audio)
+            if not decision.interrupt:
+                record_seconds -= duration
+                continue
+            text = decision.text or self._transcribe_interruption(interruption_audio)
+            # remove any punctuation using re
+            text = re.sub(r"[^\w\s]", "", text)
+            text = text.lower()
+            text = text.strip()
+            return text
     
\ No newline at end of file
@@ -0,0 +1,547 @@
+"""
+Benchmarks for the listening side of a call.
+
+    python -m openvoicechat.stt.benchmark
+    python -m openvoicechat.stt.benchmark --stt vosk --stt-model models/vosk-model-en-us-0.22 --wav turn.wav
+    python -m openvoicechat.stt.benchmark --hf-backends pipeline int8 onnx --stt-model openai/whisper-medium --wav a.wav b.wav
+    python -m openvoicechat.stt.benchmark --suite refs/ --engines vosk faster_whisper deepgram --output run.json
+    python -m openvoicechat.stt.benchmark --compare before.json after.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from queue import Queue
+
+import numpy as np
+
+from .vad import FRAME_SAMPLES, StreamingVAD, VADBatchScheduler, VoiceActivityDetection
+
+RATE = 16000
+FRAME_SECONDS = FRAME_SAMPLES / RATE
+
+
+def synthetic_call(seconds, seed=0):
+    """
+    :return: int16 bytes of noise with louder voiced bursts, close enough to a call for VAD cost
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * RATE)) / RATE
+    audio = 0.01 * rng.standard_normal(len(t))
+    voiced = (np.sin(2 * np.pi * 0.5 * t) > 0) * np.sin(2 * np.pi * 180 * t) * 0.3
+    audio = np.clip(audio + voiced * (1 + 0.5 * np.sin(2 * np.pi * 4 * t)), -1, 1)
+    return (audio * 32767).astype(np.int16).tobytes()
+
+
+def run_vad_calls(vad, calls, seconds, scheduler=None):
+    """
+    Streams `calls` concurrent calls through StreamingVAD in real time, one thread per call,
+    with frame arrivals spread over the frame period like independent clients.
+
+    :return: (process CPU seconds, worst frame latency in seconds)
+    """
+    audio = synthetic_call(seconds)
+    frame_bytes = FRAME_SAMPLES * 2
+    n_frames = len(audio) // frame_bytes
+    latency = [0.0] * calls
+    start = time.monotonic() + 0.2
+
+    def call(i):
+        speech = StreamingVAD(scheduler or vad, min_silence_ms=1000)
+        if scheduler is not None:
+            scheduler.open_stream()
+        offset = start + FRAME_SECONDS * i / calls
+        for k in range(n_frames):
+            due = offset + k * FRAME_SECONDS
+            time.sleep(max(0.0, due - time.monotonic()))
+            speech.process(audio[k * frame_bytes : (k + 1) * frame_bytes])
+            latency[i] = max(latency[i], time.monotonic() - due)
+        if scheduler is not None:
+            scheduler.close_stream()
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(calls)]
+    cpu = time.process_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.process_time() - cpu, max(latency)
+
+
+def vad_parity(audio=None, window_seconds=2.0, max_difference=1e-3, min_agreement=0.99):
+    """
+    Checks that the onnx and torch VAD backends agree: frame probabilities on the same stream,
+    which frames are speech, and contains_speech() on sliding windows like the interruption
+    check uses. Raises AssertionError when they do not.
+
+    :param audio: int16 16 kHz bytes to compare on, 10 s of synthetic_call() by default
+    :param max_difference: Largest allowed difference of a frame's speech probability
+    :param min_agreement: Smallest allowed share of speech frames and windows both backends agree on
+    """
+    if audio is None:
+        audio = synthetic_call(10.0, seed=1)
+    backends = {}
+    for backend in ("torch", "onnx"):
+        start = time.perf_counter()
+        backends[backend] = VoiceActivityDetection(backend=backend)
+        print(f"{backend:>5} backend loaded in {time.perf_counter() - start:.2f} s")
+
+    frames = np.frombuffer(audio, dtype=np.int16).astype(np.float32) / (1 << 15)
+    frames = frames[: len(frames) // FRAME_SAMPLES * FRAME_SAMPLES].reshape(-1, 1, FRAME_SAMPLES)
+    probabilities = {}
+    for backend, vad in backends.items():
+        state = context = None
+        probabilities[backend] = []
+        for frame in frames:
+            probability, state, context = vad.predict(frame, state, context)
+            probabilities[backend].append(float(probability[0]))
+    difference = np.abs(np.subtract(probabilities["torch"], probabilities["onnx"]))
+    print(f"frame probabilities: max difference {difference.max():.2e}, mean {difference.mean():.2e}")
+    speech = {backend: np.array(p) >= 0.5 for backend, p in probabilities.items()}
+    frame_agreement = float(np.mean(speech["torch"] == speech["onnx"]))
+    print(f"speech frames: {frame_agreement:.1%} agree, {speech['torch'].sum()} of {len(frames)} are speech")
+
+    window = int(window_seconds * RATE) * 2
+    step = FRAME_SAMPLES * 2 * 8
+    agree = total = 0
+    for start in range(0, len(audio) - window, step):
+        chunk = [audio[start : start + window]]
+        agree += backends["torch"].contains_speech(chunk) == backends["onnx"].contains_speech(chunk)
+        total += 1
+    print(f"contains_speech: {agree}/{total} windows agree")
+    for vad in backends.values():
+        vad.close()
+    window_agreement = agree / max(total, 1)
+    assert difference.max() <= max_difference, f"frame probabilities differ by up to {difference.max():.2e}"
+    assert frame_agreement >= min_agreement, f"backends agree on {frame_agreement:.1%} of speech frames"
+    assert window_agreement >= min_agreement, f"backends agree on {window_agreement:.1%} of contains_speech windows"
+    return difference.max(), frame_agreement, window_agreement
+
+
+def word_error_rate(reference, hypothesis) -> float:
+    """
+    :return: Word-level edit distance over the number of reference words
+    """
+    ref, hyp = reference.lower().split(), hypothesis.lower().split()
+    distance = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        previous, distance[0] = distance[0], i
+        for j, h in enumerate(hyp, 1):
+            previous, distance[j] = distance[j], min(distance[j] + 1, distance[j - 1] + 1, previous + (r != h))
+    return distance[-1] / max(len(ref), 1)
+
+
+def bench_incremental(ear, audio, lengths=(5, 10, 20, 30), pause_seconds=3.0):
+    """
+    Replays utterances the way BaseEar._listen records them, with a pause that does not end the
+    sentence every pause_seconds, and compares re-transcribing the whole utterance after each
+    pause against transcribe_incremental(). WER is of the incremental transcript against the
+    full one.
+
+    :param audio: float32 speech, repeated to the longest length
+    """
+    longest = int(max(lengths) * RATE)
+    audio = np.tile(audio, longest // len(audio) + 1)[:longest]
+    print(f"{'seconds':>7} {'full stt s':>11} {'incremental stt s':>18} {'speedup':>8} {'wer':>6}")
+    for seconds in lengths:
+        utterance = audio[: int(seconds * RATE)]
+        pauses = list(range(int(pause_seconds * RATE), len(utterance), int(pause_seconds * RATE)))
+        pauses.append(len(utterance))
+
+        start = time.perf_counter()
+        for end in pauses:
+            full = ear.transcribe(utterance[:end])
+        full_seconds = time.perf_counter() - start
+
+        segments = []
+        start = time.perf_counter()
+        for end in pauses:
+            incremental = ear.transcribe_incremental(utterance[:end], segments)
+        incremental_seconds = time.perf_counter() - start
+
+        print(
+            f"{seconds:>7} {full_seconds:>11.2f} {incremental_seconds:>18.2f} "
+            f"{full_seconds / max(incremental_seconds, 1e-9):>7.1f}x {word_error_rate(full, incremental):>6.1%}"
+        )
+
+
+def compare_hf_backends(model_id, utterances, backends=("pipeline", "int8", "onnx")):
+    """
+    Transcribes the same utterances with each Ear_hf backend. The first backend is the
+    reference: the others report their speed-up over it and their WER against its transcripts.
+    The int8 and onnx backends are built in a fresh cache and then loaded again from it; a
+    cached load must transcribe exactly like the build.
+
+    :param utterances: float32 16 kHz audio arrays
+    :return: The backends whose cached load transcribed differently from their first load
+    """
+    import shutil
+    import tempfile
+
+    import torch
+
+    from . import stt_hf
+
+    audio_seconds = sum(len(u) for u in utterances) / RATE
+    reference = None
+    mismatched = []
+    cache = stt_hf.EAR_HF_CACHE
+    stt_hf.EAR_HF_CACHE = tempfile.mkdtemp(prefix="ear-hf-")
+    print(f"{'backend':>16} {'load s':>7} {'stt s':>7} {'rtf':>6} {'speedup':>8} {'wer drift':>10}")
+    try:
+        for backend in backends:
+            built = None
+            for load in ("build", "cached") if backend != "pipeline" else ("",):
+                start = time.perf_counter()
+                pipe = stt_hf.load_pipeline(model_id, "cpu", backend)
+                load_seconds = time.perf_counter() - start
+                pipe(utterances[0])  # warm up
+                start = time.perf_counter()
+                with torch.no_grad():
+                    texts = [pipe(u)["text"].strip() for u in utterances]
+                seconds = time.perf_counter() - start
+                if reference is None:
+                    reference = (texts, seconds)
+                drift = np.mean([word_error_rate(r, t) for r, t in zip(reference[0], texts)])
+                name = f"{backend} ({load})" if load else backend
+                print(
+                    f"{name:>16} {load_seconds:>7.1f} {seconds:>7.2f} {seconds / audio_seconds:>6.2f} "
+                    f"{reference[1] / seconds:>7.1f}x {drift:>10.1%}"
+                )
+                if built is None:
+                    built = texts
+                elif texts != built:
+                    print(f"{backend}: the cached load transcribes differently from the first load")
+                    mismatched.append(backend)
+    finally:
+        shutil.rmtree(stt_hf.EAR_HF_CACHE, ignore_errors=True)
+        stt_hf.EAR_HF_CACHE = cache
+    return mismatched
+
+
+# engine name: (module, class, default constructor kwargs); --model replaces the first kwarg
+ENGINES = {
+    "hf": ("stt_hf", "Ear_hf", {"model_id": "openai/whisper-base.en"}),
+    "vosk": ("stt_vosk", "Ear_vosk", {"model_path": "models/vosk-model-en-us-0.22"}),
+    "faster_whisper": (
+        "stt_faster_whisper",
+        "Ear_faster_whisper",
+        {"model_size": "base.en", "device": "cpu", "compute_type": "int8"},
+    ),
+    "deepgram": ("stt_deepgram", "Ear_deepgram", {"api_key": ""}),
+}
+CLIENT_FRAME_MS = 20  # audio per frame the replayed client sends
+
+
+def load_references(directory):
+    """
+    :return: (name, float32 audio, reference transcript) for every <name>.wav in directory
+        that has a <name>.ref.txt next to it
+    """
+    from .endpointing import _read_wav
+
+    references = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.wav"))):
+        transcript = os.path.splitext(path)[0] + ".ref.txt"
+        if not os.path.exists(transcript):
+            print(f"{path}: no {os.path.basename(transcript)}, skipped")
+            continue
+        with open(transcript) as f:
+            references.append((os.path.basename(path), _read_wav(path, RATE), f.read().strip()))
+    return references
+
+
+def replay_listener(audio):
+    """
+    :return: A Listener_ws fed by a fake client that sends the audio as AUDIO frames in real time
+    """
+    from ..protocol import encode_audio
+    from ..utils import Listener_ws
+
+    frames = Queue()
+    frame = RATE * CLIENT_FRAME_MS // 1000
+    samples = (np.clip(audio, -1, 1) * ((1 << 15) - 1)).astype(np.int16)
+
+    def client():
+        start = time.monotonic()
+        for seq, i in enumerate(range(0, len(samples), frame)):
+            time.sleep(max(0.0, start + i / RATE - time.monotonic()))
+            frames.put(encode_audio(samples[i : i + frame], RATE, seq))
+
+    threading.Thread(target=client, daemon=True).start()
+    return Listener_ws(frames)
+
+
+def _normalize_text(text):
+    import re
+
+    return re.sub(r"[^\w' ]", " ", text.lower())
+
+
+def run_utterance(ear, audio, reference):
+    """
+    Streams one utterance into the ear as it arrives from the fake client, the way the engine
+    does: live streams for ears with partial results, transcribe_stream for streaming ears,
+    transcribe() on the whole utterance otherwise.
+
+    :return: dict of word errors, CPU seconds, time to the first partial and from the end of
+        the audio to the final transcript
+    """
+    listener = replay_listener(audio)
+    # the listener hands out whole chunks only
+    n_chunks = len(audio) // listener.CHUNK
+    first_partial = []
+    start = time.monotonic()
+
+    def on_event(event):
+        if event.type == "partial" and not first_partial:
+            first_partial.append(time.monotonic())
+
+    cpu = time.process_time()
+    if ear.partial_results and hasattr(ear, "open_stream"):
+        live = ear.open_stream(on_event)
+        feed, finish = live.feed, lambda: live.finish().result()
+    elif ear.stream:
+        audio_queue, transcription_queue = Queue(), Queue()
+        thread = threading.Thread(target=ear.transcribe_stream, args=(audio_queue, transcription_queue))
+        thread.start()
+
+        def finish():
+            audio_queue.put(None)
+            texts = []
+            while True:
+                text = transcription_queue.get()
+                if text is None:
+                    break
+                texts.append(text)
+            thread.join()
+            return " ".join(texts)
+
+        feed = audio_queue.put
+    else:
+        chunks = []
+        feed = chunks.append
+
+        def finish():
+            return ear.transcribe(np.frombuffer(b"".join(chunks), dtype=np.int16).astype(np.float32) / (1 << 15))
+
+    for _ in range(n_chunks):
+        feed(listener.read(listener.CHUNK))
+    end_of_speech = time.monotonic()
+    text = finish()
+    final = time.monotonic()
+    cpu = time.process_time() - cpu
+
+    words = len(reference.split())
+    return {
+        "text": text,
+        "errors": word_error_rate(_normalize_text(reference), _normalize_text(text)) * words,
+        "words": words,
+        "audio_seconds": n_chunks * listener.CHUNK / RATE,
+        "cpu_seconds": cpu,
+        "first_partial_ms": (first_partial[0] - start) * 1000 if first_partial else None,
+        "final_ms": (final - end_of_speech) * 1000,
+    }
+
+
+def _run_engine(name, kwargs, directory, deepgram_latency_ms):
+    """
+    Runs in a child process of its own, so peak RSS is the engine's alone
+    """
+    import importlib
+    import resource
+
+    module, cls, _ = ENGINES[name]
+    references = load_references(directory)
+    standin = None
+    if name == "deepgram" and not kwargs.get("api_key"):
+        from .deepgram_standin import DeepgramStandIn
+
+        standin = DeepgramStandIn(port=0, latency_ms=deepgram_latency_ms)
+        kwargs = dict(kwargs, api_key="standin", url=standin.start_in_thread())
+    start = time.perf_counter()
+    ear = getattr(importlib.import_module(f"{__package__}.{module}"), cls)(**kwargs)
+    load_seconds = time.perf_counter() - start
+
+    files = []
+    for path, audio, reference in references:
+        if standin is not None:
+            # the stand-in only measures the streaming path, its text is the reference
+            standin.transcribe = lambda samples, reference=reference: reference
+        result = run_utterance(ear, audio, reference)
+        files.append(dict(result, file=path))
+        print(f"{name:>15} {path}: {result['text'][:60]!r}")
+    ear.close()
+    return {
+        "model": kwargs,
+        "standin": standin is not None,
+        "load_seconds": load_seconds,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "files": files,
+    }
+
+
+def summarize(result) -> dict:
+    files = result["files"]
+    partials = [f["first_partial_ms"] for f in files if f["first_partial_ms"] is not None]
+    finals = [f["final_ms"] for f in files]
+    return {
+        "wer": sum(f["errors"] for f in files) / max(sum(f["words"] for f in files), 1),
+        "rtf": sum(f["cpu_seconds"] for f in files) / max(sum(f["audio_seconds"] for f in files), 1e-9),
+        "first_partial_ms": float(np.median(partials)) if partials else None,
+        "final_ms_p50": float(np.percentile(finals, 50)) if finals else None,
+        "final_ms_p95": float(np.percentile(finals, 95)) if finals else None,
+        "peak_rss_mb": result["peak_rss_mb"],
+        "load_seconds": result["load_seconds"],
+    }
+
+
+SUMMARY_COLUMNS = ("wer", "rtf", "first_partial_ms", "final_ms_p50", "final_ms_p95", "peak_rss_mb", "load_seconds")
+
+
+def _print_summaries(summaries):
+    print(f"{'engine':>15} " + " ".join(f"{column:>16}" for column in SUMMARY_COLUMNS))
+    for name, summary in summaries.items():
+        cells = [
+            "-" if summary[column] is None else f"{summary[column]:.3f}" if column in ("wer", "rtf") else f"{summary[column]:.0f}"
+            for column in SUMMARY_COLUMNS
+        ]
+        print(f"{name:>15} " + " ".join(f"{cell:>16}" for cell in cells))
+
+
+def run_suite(directory, engines=tuple(ENGINES), models=None, deepgram_latency_ms=100, output=None) -> dict:
+    """
+    Plays every reference wav of directory through each engine in real time and reports WER,
+    real-time factor (process CPU seconds per audio second), time to the first partial, end of
+    audio to final transcript latency and peak RSS. Each engine runs in a fresh process.
+
+    Ear_deepgram talks to a local stand-in with deepgram_latency_ms of added latency unless a
+    real api_key is given in models. The stand-in returns the reference text, so its WER is 0
+    and only its latencies mean anything.
+
+    :param models: engine name -> constructor kwargs overriding ENGINES' defaults
+    :param output: Path of a JSON file for the results, for comparing runs with compare_runs()
+    """
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    run = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "dataset": os.path.abspath(directory),
+        "deepgram_latency_ms": deepgram_latency_ms,
+        "engines": {},
+    }
+    for name in engines:
+        kwargs = dict(ENGINES[name][2], **(models or {}).get(name, {}))
+        with context.Pool(1) as pool:
+            try:
+                result = pool.apply(_run_engine, (name, kwargs, directory, deepgram_latency_ms))
+            except Exception as e:
+                print(f"{name}: failed, {e}")
+                continue
+        result["summary"] = summarize(result)
+        run["engines"][name] = result
+    _print_summaries({name: result["summary"] for name, result in run["engines"].items()})
+    if output:
+        with open(output, "w") as f:
+            json.dump(run, f, indent=2, default=str)
+        print(f"results written to {output}")
+    return run
+
+
+def compare_runs(before_path, after_path):
+    """
+    Prints each summary metric of two run_suite() outputs side by side, per engine
+    """
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before_path} ({before['created']}) -> {after_path} ({after['created']})")
+    for name in sorted(set(before["engines"]) | set(after["engines"])):
+        old = before["engines"].get(name, {}).get("summary", {})
+        new = after["engines"].get(name, {}).get("summary", {})
+        print(name)
+        for column in SUMMARY_COLUMNS:
+            a, b = old.get(column), new.get(column)
+            change = f"{b - a:+.3f}" if a is not None and b is not None else ""
+            print(f"    {column:>16} {str(a if a is None else round(a, 3)):>10} -> {str(b if b is None else round(b, 3)):>10} {change:>10}")
+
+
+def bench_vad(concurrency=(1, 10, 50, 100, 200), seconds=3.0):
+    """
+    VAD CPU per second of call audio, per-call inference against the batch scheduler
+    """
+    vad = VoiceActivityDetection()
+    scheduler = VADBatchScheduler(vad)
+    print(f"{'calls':>5} {'mode':>10} {'cpu ms/call-s':>14} {'worst latency ms':>17} {'frames/batch':>13}")
+    for calls in concurrency:
+        for mode in ("per-call", "batched"):
+            batches, frames = scheduler.batches, scheduler.frames
+            cpu, latency = run_vad_calls(vad, calls, seconds, scheduler if mode == "batched" else None)
+            per_batch = (scheduler.frames - frames) / max(scheduler.batches - batches, 1)
+            print(
+                f"{calls:>5} {mode:>10} {cpu * 1000 / (calls * seconds):>14.2f} "
+                f"{latency * 1000:>17.1f} {per_batch if mode == 'batched' else 1:>13.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, nargs="+", default=[1, 10, 50, 100, 200])
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--parity", action="store_true", help="compare the onnx and torch VAD backends")
+    parser.add_argument("--stt", choices=["hf", "vosk"], help="benchmark incremental transcription with this ear")
+    parser.add_argument("--stt-model", help="the ear's model id or path")
+    parser.add_argument("--wav", nargs="+", help="speech for the STT benchmarks, synthetic audio by default")
+    parser.add_argument("--hf-backends", nargs="+", help="compare Ear_hf backends, e.g. pipeline int8 onnx")
+    parser.add_argument("--lengths", type=float, nargs="+", default=[5, 10, 20, 30])
+    parser.add_argument("--suite", metavar="DIR", help="run every engine over DIR's <name>.wav / <name>.ref.txt pairs")
+    parser.add_argument("--engines", nargs="+", choices=sorted(ENGINES), default=sorted(ENGINES))
+    parser.add_argument(
+        "--model", action="append", default=[], metavar="ENGINE=MODEL", help="e.g. vosk=models/vosk-model-small-en-us-0.15"
+    )
+    parser.add_argument("--deepgram-key", help="use the real Deepgram API instead of the stand-in")
+    parser.add_argument("--deepgram-latency-ms", type=float, default=100)
+    parser.add_argument("--output", help="JSON file for the suite results")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two suite result files")
+    args = parser.parse_args()
+    if args.wav:
+        from .endpointing import _read_wav
+
+        speech = [_read_wav(path, RATE) for path in args.wav]
+    else:
+        speech = [np.frombuffer(synthetic_call(30), dtype=np.int16).astype(np.float32) / (1 << 15)]
+    if args.compare:
+        compare_runs(*args.compare)
+    elif args.suite:
+        models = {}
+        for spec in args.model:
+            name, _, model = spec.partition("=")
+            models[name] = {next(iter(ENGINES[name][2])): model}
+        if args.deepgram_key:
+            models["deepgram"] = {"api_key": args.deepgram_key}
+        run_suite(args.suite, args.engines, models, args.deepgram_latency_ms, args.output)
+    elif args.parity:
+        # real speech when given, the synthetic call has no frames silero scores as speech
+        audio = b"".join((np.clip(s, -1, 1) * 32767).astype(np.int16).tobytes() for s in speech)
+        vad_parity(audio if args.wav else None)
+    elif args.hf_backends:
+        if compare_hf_backends(args.stt_model or "openai/whisper-base.en", speech, args.hf_backends):
+            raise SystemExit(1)
+    elif args.stt:
+        if args.stt == "hf":
+            from .stt_hf import Ear_hf
+
+            ear = Ear_hf(args.stt_model) if args.stt_model else Ear_hf()
+        else:
+            from .stt_vosk import Ear_vosk
+
+            ear = Ear_vosk(args.stt_model) if args.stt_model else Ear_vosk()
+        bench_incremental(ear, np.concatenate(speech), args.lengths)
+    else:
+        bench_vad(args.calls, args.seconds)
@@ -0,0 +1,253 @@
+"""
+A local stand-in for Deepgram's streaming listen API, for testing Ear_deepgram without the
+cloud. It speaks the same messages: binary linear16 audio, KeepAlive, Finalize and CloseStream
+in; Metadata, Results (is_final, speech_final, from_finalize, start, duration) and, when asked
+for with interim_results and utterance_end_ms, interim Results and UtteranceEnd out.
+
+    python -m openvoicechat.stt.deepgram_standin --port 8765
+    DEEPGRAM_URL=ws://localhost:8765/v1/listen python app.py
+    python -m openvoicechat.stt.deepgram_standin --check
+"""
+
+import asyncio
+import json
+import re
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import websockets
+
+BYTES_PER_SECOND = 16000 * 2
+SPEECH_RMS = 0.01 * (1 << 15)  # louder chunks count as speech for UtteranceEnd
+
+
+def describe_audio(audio: np.ndarray) -> str:
+    """
+    Default transcriber: a deterministic stand-in text for the audio
+    """
+    return f"audio of {len(audio) / 16000:.2f} seconds"
+
+
+class DeepgramStandIn:
+    def __init__(
+        self,
+        host="localhost",
+        port=8765,
+        transcribe=describe_audio,
+        final_every_seconds=5.0,
+        interim_every_seconds=0.5,
+        idle_timeout=10.0,
+        drop_after_bytes=None,
+        latency_ms=0,
+    ):
+        """
+        :param transcribe: Turns float32 16 kHz audio into text
+        :param final_every_seconds: Emit a final result (without from_finalize) after this much
+            audio, like Deepgram does on long speech
+        :param interim_every_seconds: Emit an interim result after this much new audio
+        :param idle_timeout: Close connections that get no audio or KeepAlive for this long
+        :param drop_after_bytes: Drop the first connection that receives this many audio bytes,
+            to test reconnection
+        :param latency_ms: Delay of every Results and UtteranceEnd message, like a network round trip
+        """
+        self.host = host
+        self.port = port
+        self.transcribe = transcribe
+        self.final_every_seconds = final_every_seconds
+        self.interim_every_seconds = interim_every_seconds
+        self.idle_timeout = idle_timeout
+        self.drop_after_bytes = drop_after_bytes
+        self.latency_ms = latency_ms
+        self.connections = 0
+        self.keepalives = 0
+        self.finalizes = 0
+        self._server = None
+
+    @property
+    def url(self):
+        return f"ws://{self.host}:{self.port}/v1/listen"
+
+    async def _send(self, ws, message):
+        if not self.latency_ms:
+            await ws.send(message)
+            return
+
+        async def send_later():
+            await asyncio.sleep(self.latency_ms / 1000)
+            try:
+                await ws.send(message)
+            except websockets.ConnectionClosed:
+                pass
+
+        asyncio.create_task(send_later())
+
+    async def _results(self, ws, audio, start, from_finalize, is_final=True):
+        samples = np.frombuffer(bytes(audio), dtype=np.int16).astype(np.float32) / (1 << 15)
+        transcript = self.transcribe(samples) if len(samples) else ""
+        await self._send(
+            ws,
+            json.dumps(
+                {
+                    "type": "Results",
+                    "channel": {"alternatives": [{"transcript": transcript, "confidence": 1.0}]},
+                    "start": start,
+                    "duration": len(audio) / BYTES_PER_SECOND,
+                    "is_final": is_final,
+                    "speech_final": from_finalize,
+                    "from_finalize": from_finalize,
+                }
+            )
+        )
+
+    async def _handle(self, ws):
+        if not ws.request_headers.get("Authorization", "").startswith("token "):
+            await ws.close(1008, "missing token")
+            return
+        self.connections += 1
+        params = parse_qs(urlparse(ws.path).query)
+        interim = params.get("interim_results", ["false"])[0] == "true"
+        utterance_end_ms = int(params["utterance_end_ms"][0]) if "utterance_end_ms" in params else None
+        request_id = str(uuid.uuid4())
+        audio = bytearray()  # audio not transcribed yet
+        start = 0.0  # stream time of the start of audio
+        received = 0
+        interim_at = 0  # len(audio) at the last interim result
+        heard_speech = False
+        silence = 0  # bytes of quiet audio since the last speech
+        try:
+            while True:
+                try:
+                    msg = await asyncio.wait_for(ws.recv(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    await ws.close(1011, "did not receive audio data or a text message within the timeout window")
+                    return
+                if isinstance(msg, bytes):
+                    audio.extend(msg)
+                    received += len(msg)
+                    if self.drop_after_bytes is not None and received >= self.drop_after_bytes:
+                        self.drop_after_bytes = None
+                        await ws.close(1011, "dropped by the stand-in")
+                        return
+                    if len(audio) >= self.final_every_seconds * BYTES_PER_SECOND:
+                        await self._results(ws, audio, start, from_finalize=False)
+                        start += len(audio) / BYTES_PER_SECOND
+                        audio = bytearray()
+                        interim_at = 0
+                    elif interim and len(audio) - interim_at >= self.interim_every_seconds * BYTES_PER_SECOND:
+                        await self._results(ws, audio, start, from_finalize=False, is_final=False)
+                        interim_at = len(audio)
+                    if utterance_end_ms is not None:
+                        chunk = np.frombuffer(msg, dtype=np.int16).astype(np.float32)
+                        if len(chunk) and np.sqrt(np.mean(chunk**2)) > SPEECH_RMS:
+                            heard_speech, silence = True, 0
+                        else:
+                            silence += len(msg)
+                        if heard_speech and silence >= utterance_end_ms * BYTES_PER_SECOND / 1000:
+                            heard_speech = False
+                            last_word_end = start + (len(audio) - silence) / BYTES_PER_SECOND
+                            await self._send(ws, json.dumps({"type": "UtteranceEnd", "channel": [0, 1], "last_word_end": last_word_end}))
+                    continue
+                kind = json.loads(msg).get("type")
+                if kind == "KeepAlive":
+                    self.keepalives += 1
+                elif kind == "Finalize":
+                    self.finalizes += 1
+                    await self._results(ws, audio, start, from_finalize=True)
+                    start += len(audio) / BYTES_PER_SECOND
+                    audio = bytearray()
+                    interim_at = 0
+                elif kind == "CloseStream":
+                    if audio:
+                        await self._results(ws, audio, start, from_finalize=False)
+                        start += len(audio) / BYTES_PER_SECOND
+                    await ws.send(json.dumps({"type": "Metadata", "request_id": request_id, "duration": start}))
+                    await ws.close()
+                    return
+        except websockets.ConnectionClosed:
+            pass
+
+    async def serve(self):
+        self._server = await websockets.serve(self._handle, self.host, self.port)
+        if self.port == 0:
+            self.port = self._server.sockets[0].getsockname()[1]
+        return self._server
+
+    def start_in_thread(self) -> str:
+        """
+        Serves on a daemon thread
+
+        :return: The listen URL
+        """
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.serve(), loop).result()
+        return self.url
+
+
+def check_connection():
+    """
+    Runs a DeepgramConnection against the stand-in: a dropped connection is reopened and the
+    audio without a final transcript is sent again, KeepAlive holds the connection open between
+    utterances, and Finalize closes each utterance. Raises AssertionError on the first failure.
+    """
+    from .stt_deepgram import DeepgramConnection
+
+    seconds = 7  # a final result at 5 s, then the connection drops at 6 s
+    standin = DeepgramStandIn(port=0, drop_after_bytes=6 * BYTES_PER_SECOND)
+    connection = DeepgramConnection("standin", url=standin.start_in_thread(), keepalive_seconds=0.2)
+
+    def utterance(seconds):
+        t = np.arange(int(seconds * 16000)) / 16000
+        audio = (0.3 * np.sin(2 * np.pi * 220 * t) * ((1 << 15) - 1)).astype(np.int16).tobytes()
+        live = connection.open()
+        for i in range(0, len(audio), 3200):
+            live.feed(audio[i : i + 3200])
+        return live.finish().result(timeout=10)
+
+    def heard(text):
+        return sum(float(s) for s in re.findall(r"audio of ([\d.]+) seconds", text))
+
+    try:
+        text = utterance(seconds)
+        assert connection.connects == 2 and standin.connections == 2, (
+            f"expected one reconnect, got {connection.connects} connects"
+        )
+        # the 5 s final before the drop is not resent, the rest is
+        assert abs(heard(text) - seconds) < 0.01, f"transcript covers {heard(text):.2f} of {seconds} s: {text!r}"
+        time.sleep(1)
+        assert standin.keepalives > 0, "no KeepAlive while idle"
+        text = utterance(1)
+        assert abs(heard(text) - 1) < 0.01, f"second utterance: {text!r}"
+        assert standin.finalizes == 2, f"expected a Finalize per utterance, got {standin.finalizes}"
+    finally:
+        connection.close()
+    print(
+        f"reconnected and resent: {connection.connects} connections, {standin.keepalives} KeepAlives, "
+        f"{standin.finalizes} Finalizes"
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local stand-in for Deepgram's streaming API")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--idle-timeout", type=float, default=10.0)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--check", action="store_true", help="check DeepgramConnection against the stand-in")
+    args = parser.parse_args()
+    if args.check:
+        check_connection()
+        raise SystemExit
+
+    async def main():
+        standin = DeepgramStandIn(args.host, args.port, idle_timeout=args.idle_timeout, latency_ms=args.latency_ms)
+        await standin.serve()
+        print(f"Deepgram stand-in listening on {standin.url}")
+        await asyncio.Future()
+
+    asyncio.run(main())
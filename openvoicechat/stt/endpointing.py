@@ -0,0 +1,235 @@
+"""
+End-of-turn detection. Instead of waiting a fixed silence after every utterance, the required
+pause depends on how finished the turn looks: the partial transcript (terminal punctuation,
+a complete sentence, a trailing "and"/"um") and the VAD probability during the pause
+(a speaker who is hesitating keeps scoring above zero).
+
+Offline evaluation over recorded turns:
+
+    python -m openvoicechat.stt.endpointing turns/*.wav --profile default
+"""
+
+import os
+import re
+from typing import NamedTuple
+
+import numpy as np
+
+ENDPOINT_PROFILE = os.environ.get("ENDPOINT_PROFILE", "default")
+
+
+class EndpointProfile(NamedTuple):
+    complete_ms: int  # pause that ends a turn which looks finished
+    neutral_ms: int  # pause when there is no transcript to judge by
+    incomplete_ms: int  # pause when the turn looks unfinished or the speaker is hesitating
+    hesitation_probability: float  # mean VAD probability over a pause above which it is hesitation
+
+
+PROFILES = {
+    "default": EndpointProfile(
+        complete_ms=500, neutral_ms=1000, incomplete_ms=2000, hesitation_probability=0.15
+    ),
+    # short answers, e.g. yes/no confirmations
+    "fast": EndpointProfile(
+        complete_ms=300, neutral_ms=700, incomplete_ms=1500, hesitation_probability=0.2
+    ),
+    # dictation of names, numbers and addresses, e.g. information collection agents
+    "patient": EndpointProfile(
+        complete_ms=800, neutral_ms=1500, incomplete_ms=3000, hesitation_probability=0.1
+    ),
+}
+
+# a turn ending in one of these is very likely to continue
+CONTINUATION_WORDS = {
+    "and", "but", "or", "so", "because", "if", "then", "that", "which", "who", "when", "where",
+    "the", "a", "an", "to", "of", "for", "with", "in", "on", "at", "my", "your", "our", "is", "are",
+    "was", "i", "i'm", "um", "uh", "erm", "like", "also", "about", "from", "than",
+}
+
+
+def get_profile(profile=None) -> EndpointProfile:
+    """
+    :param profile: A profile name, an EndpointProfile, or None for ENDPOINT_PROFILE
+    """
+    if isinstance(profile, EndpointProfile):
+        return profile
+    return PROFILES[profile or ENDPOINT_PROFILE]
+
+
+class Endpointer:
+    def __init__(self, profile=None, max_silence_ms=None, threshold=0.5, language="en"):
+        """
+        Decides how much silence ends the current turn. Feed it every VAD probability
+        while the speaker holds the turn, and the latest partial transcript when there is one.
+
+        :param profile: A name from PROFILES or an EndpointProfile
+        :param max_silence_ms: Upper bound for every pause, e.g. the ear's silence_seconds
+        :param threshold: VAD probability at or above which a frame is speech
+        """
+        import pysbd
+
+        self.profile = get_profile(profile)
+        self.max_silence_ms = max_silence_ms
+        self.threshold = threshold
+        self.seg = pysbd.Segmenter(language=language, clean=False)
+        self.reset()
+
+    def reset(self):
+        self.transcript = ""
+        self._completeness = None
+        self._pause_frames = 0
+        self._pause_probability = 0.0
+
+    def update_transcript(self, text):
+        """
+        :param text: The transcript of the turn so far
+        """
+        text = text.strip()
+        if text != self.transcript:
+            self.transcript = text
+            self._completeness = self.completeness(text) if text else None
+
+    def completeness(self, text) -> str:
+        """
+        :return: "complete", "incomplete" or "neutral"
+        """
+        words = re.findall(r"[\w']+", text.lower())
+        if not words or text.endswith((",", "-", "...")) or words[-1] in CONTINUATION_WORDS:
+            return "incomplete"
+        if text.endswith((".", "?", "!")) or len(self.seg.segment(text + " .")) > 1:
+            return "complete"
+        return "neutral"
+
+    def observe(self, probability):
+        """
+        :param probability: VAD probability of the next frame of the turn
+        """
+        if probability >= self.threshold:
+            self._pause_frames = 0
+            self._pause_probability = 0.0
+        else:
+            self._pause_frames += 1
+            self._pause_probability += probability
+
+    @property
+    def hesitating(self) -> bool:
+        return (
+            self._pause_frames > 0
+            and self._pause_probability / self._pause_frames > self.profile.hesitation_probability
+        )
+
+    def silence_ms(self) -> int:
+        """
+        :return: The pause that ends the turn given what has been observed so far
+        """
+        if self.hesitating or self._completeness == "incomplete":
+            silence = self.profile.incomplete_ms
+        elif self._completeness == "complete":
+            silence = self.profile.complete_ms
+        else:
+            silence = self.profile.neutral_ms
+        if self.max_silence_ms is not None:
+            silence = min(silence, self.max_silence_ms)
+        return silence
+
+
+def _read_wav(path, rate=16000):
+    import wave
+
+    with wave.open(path, "rb") as f:
+        assert f.getsampwidth() == 2, f"{path}: only 16-bit wavs are supported"
+        audio = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+        audio = audio.reshape(-1, f.getnchannels()).mean(axis=1) / (1 << 15)
+        file_rate = f.getframerate()
+    audio = audio.astype(np.float32)
+    if file_rate != rate:
+        from ..resample import StreamingResampler
+
+        audio = StreamingResampler(file_rate, rate).resample(audio)
+    return audio
+
+
+def _read_partials(path):
+    """
+    Partial transcripts for a wav, one "<seconds> <text so far>" per line, in <name>.txt
+    """
+    partials = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                seconds, _, text = line.strip().partition(" ")
+                if seconds:
+                    partials.append((float(seconds), text))
+    return partials
+
+
+def evaluate(paths, vad, profile=None, baseline_ms=2000, rate=16000):
+    """
+    Replays recorded turns, each wav holding one user turn with its internal pauses, and
+    compares adaptive endpointing with a fixed baseline_ms pause.
+
+    The turn's true end is where its last speech stops. The adaptive endpointer cuts off
+    falsely when it ends the turn before that.
+
+    :return: dict with per-file results, mean latency saved and the false-cutoff rate
+    """
+    from .vad import FRAME_SAMPLES, StreamingVAD
+
+    results = []
+    for path in paths:
+        audio = _read_wav(path, rate)
+        tail = np.zeros(int(rate * (baseline_ms / 1000 + 1)), dtype=np.float32)
+        audio = np.concatenate((audio, tail))
+        partials = _read_partials(os.path.splitext(path)[0] + ".txt")
+
+        baseline = StreamingVAD(vad, min_silence_ms=baseline_ms, sampling_rate=rate)
+        ends = [e.sample for e in baseline.process(audio) if e.type == "end"]
+        if not ends:
+            print(f"{path}: no speech found, skipped")
+            continue
+        true_end = ends[-1]
+
+        endpointer = Endpointer(profile, max_silence_ms=baseline_ms)
+        adaptive = StreamingVAD(
+            vad, min_silence_ms=baseline_ms, sampling_rate=rate, endpointer=endpointer
+        )
+        decided = None
+        for i in range(len(audio) // FRAME_SAMPLES):
+            now = (i + 1) * FRAME_SAMPLES / rate
+            spoken = [text for seconds, text in partials if seconds <= now]
+            if spoken:
+                endpointer.update_transcript(spoken[-1])
+            events = adaptive.process(audio[i * FRAME_SAMPLES : (i + 1) * FRAME_SAMPLES])
+            if any(e.type == "end" for e in events):
+                decided = adaptive.position
+                break
+        cut_off = decided is None or decided < true_end
+        saved_ms = 0.0 if cut_off else (true_end + rate * baseline_ms / 1000 - decided) * 1000 / rate
+        results.append({"file": path, "cut_off": cut_off, "saved_ms": saved_ms})
+        print(f"{path}: {'FALSE CUTOFF' if cut_off else f'{saved_ms:.0f} ms saved'}")
+
+    kept = [r["saved_ms"] for r in results if not r["cut_off"]]
+    summary = {
+        "turns": len(results),
+        "false_cutoff_rate": sum(r["cut_off"] for r in results) / max(len(results), 1),
+        "mean_saved_ms": float(np.mean(kept)) if kept else 0.0,
+        "results": results,
+    }
+    print(
+        f"{summary['turns']} turns: {summary['mean_saved_ms']:.0f} ms saved per turn on average, "
+        f"false cutoff rate {summary['false_cutoff_rate']:.1%}"
+    )
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from .vad import VoiceActivityDetection
+
+    parser = argparse.ArgumentParser(description="Evaluate adaptive endpointing on recorded turns")
+    parser.add_argument("wavs", nargs="+", help="one user turn per wav, optional <name>.txt partial transcripts")
+    parser.add_argument("--profile", default=ENDPOINT_PROFILE, choices=sorted(PROFILES))
+    parser.add_argument("--baseline-ms", type=int, default=2000)
+    args = parser.parse_args()
+    evaluate(args.wavs, VoiceActivityDetection(), args.profile, args.baseline_ms)
@@ -0,0 +1,155 @@
+"""
+Deciding whether speech over the bot's audio is a barge-in. Each tier runs only when the
+cheaper ones before it could not decide:
+
+1. energy and duration: too quiet or too short is noise or echo, long continuous speech is
+   an interruption
+2. keyword spotting: a small local grammar recognizer (vosk) for backchannels like "yeah"
+3. the ear's full transcription, checked against not_interrupt_words
+"""
+
+import json
+import os
+import re
+from typing import NamedTuple
+
+import numpy as np
+
+INTERRUPT_MIN_RMS = float(os.environ.get("INTERRUPT_MIN_RMS", 0.01))
+INTERRUPT_MIN_SPEECH_MS = int(os.environ.get("INTERRUPT_MIN_SPEECH_MS", 200))
+INTERRUPT_SPEECH_MS = int(os.environ.get("INTERRUPT_SPEECH_MS", 800))
+# path of a vosk model for backchannel spotting, e.g. vosk-model-small-en-us-0.15
+INTERRUPT_KWS_MODEL = os.environ.get("INTERRUPT_KWS_MODEL")
+
+ANALYSIS_FRAME_MS = 20
+
+
+class InterruptionDecision(NamedTuple):
+    interrupt: bool
+    tier: str  # "energy", "keyword" or "stt"
+    text: str  # transcription, empty unless the stt tier ran
+
+
+def _load_keyword_model(path):
+    import vosk
+
+    return vosk.Model(path)
+
+
+class InterruptionDetector:
+    def __init__(
+        self,
+        transcribe,
+        not_interrupt_words,
+        sampling_rate=16000,
+        min_rms=INTERRUPT_MIN_RMS,
+        min_speech_ms=INTERRUPT_MIN_SPEECH_MS,
+        interrupt_speech_ms=INTERRUPT_SPEECH_MS,
+        keyword_model=INTERRUPT_KWS_MODEL,
+    ):
+        """
+        :param transcribe: The ear's transcribe(audio) -> str, the last tier
+        :param not_interrupt_words: Backchannels that do not interrupt the bot
+        :param min_rms: Frames quieter than this (float audio) do not count as speech
+        :param min_speech_ms: Less loud speech than this is noise
+        :param interrupt_speech_ms: This much loud speech is an interruption without transcribing
+        :param keyword_model: Path to a vosk model for backchannel spotting, None to skip the tier
+        """
+        self.transcribe = transcribe
+        self.not_interrupt_words = not_interrupt_words
+        self.sampling_rate = sampling_rate
+        self.min_rms = min_rms
+        self.min_speech_ms = min_speech_ms
+        self.interrupt_speech_ms = interrupt_speech_ms
+        self.calls = {"energy": 0, "keyword": 0, "stt": 0}
+        self._keywords = None
+        if keyword_model:
+            from ..model_pool import get_model_pool
+
+            self._keywords = get_model_pool().acquire(
+                ("vosk", keyword_model), lambda: _load_keyword_model(keyword_model)
+            )
+
+    def close(self):
+        if self._keywords is not None:
+            self._keywords.release()
+
+    def is_backchannel(self, text) -> bool:
+        text = re.sub(r"[^\w\s]", "", text).lower().strip()
+        return text in self.not_interrupt_words
+
+    def speech_ms(self, audio) -> float:
+        """
+        :param audio: float32 audio
+        :return: Milliseconds of frames loud enough to be speech
+        """
+        frame = self.sampling_rate * ANALYSIS_FRAME_MS // 1000
+        n_frames = len(audio) // frame
+        if n_frames == 0:
+            return 0.0
+        frames = audio[: n_frames * frame].reshape(n_frames, frame)
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1))
+        return float(np.count_nonzero(rms > self.min_rms) * ANALYSIS_FRAME_MS)
+
+    def gate(self, audio) -> str:
+        """
+        The energy and duration tier
+
+        :return: "noise", "interruption" or "unknown"
+        """
+        speech_ms = self.speech_ms(audio)
+        if speech_ms < self.min_speech_ms:
+            return "noise"
+        if speech_ms >= self.interrupt_speech_ms:
+            return "interruption"
+        return "unknown"
+
+    def spot_backchannel(self, audio) -> bool:
+        """
+        The keyword tier: recognizes the snippet against a grammar of just the backchannels.
+        Anything else comes out as [unk], so only a confident backchannel returns True.
+        """
+        if self._keywords is None:
+            return False
+        import vosk
+
+        grammar = json.dumps(list(self.not_interrupt_words) + ["[unk]"])
+        recognizer = vosk.KaldiRecognizer(self._keywords.model, self.sampling_rate, grammar)
+        recognizer.AcceptWaveform((np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes())
+        text = json.loads(recognizer.FinalResult()).get("text", "")
+        return bool(text) and "[unk]" not in text and self.is_backchannel(text)
+
+    def decide(self, audio) -> InterruptionDecision:
+        """
+        :param audio: float32 speech heard while the bot was talking
+        """
+        verdict = self.gate(audio)
+        if verdict != "unknown":
+            self.calls["energy"] += 1
+            return InterruptionDecision(verdict == "interruption", "energy", "")
+        if self.spot_backchannel(audio):
+            self.calls["keyword"] += 1
+            return InterruptionDecision(False, "keyword", "")
+        self.calls["stt"] += 1
+        text = self.transcribe(audio)
+        return InterruptionDecision(bool(text.strip()) and not self.is_backchannel(text), "stt", text)
+
+
+if __name__ == "__main__":
+    # how many snippets each tier settles, on synthetic noise, backchannel-length and long speech
+    rng = np.random.default_rng(0)
+    rate = 16000
+
+    def voiced(seconds, level=0.2):
+        t = np.arange(int(seconds * rate)) / rate
+        return (level * np.sin(2 * np.pi * 150 * t) * (1 + np.sin(2 * np.pi * 4 * t)) / 2).astype(np.float32)
+
+    snippets = (
+        [0.003 * rng.standard_normal(rate // 2).astype(np.float32) for _ in range(40)]
+        + [voiced(0.1) for _ in range(20)]
+        + [voiced(0.4) for _ in range(20)]
+        + [voiced(1.5) for _ in range(20)]
+    )
+    detector = InterruptionDetector(lambda audio: "yeah", ["yeah", "hmm"], keyword_model=None)
+    interrupts = sum(detector.decide(snippet).interrupt for snippet in snippets)
+    print(f"{len(snippets)} snippets, {interrupts} interruptions, decided by tier: {detector.calls}")
@@ -0,0 +1,220 @@
+"""
+Streaming decoding for models that only transcribe whole buffers, like whisper. The growing
+utterance is re-decoded while it is spoken, and words are committed once two consecutive
+decodes agree on them (LocalAgreement-2, from Machacek et al., "Turning Whisper into Real-Time
+Transcription System"). Committed text becomes the prompt of later decodes and the audio before
+it is dropped, so at the end of speech only the uncommitted tail is decoded.
+"""
+
+import re
+from concurrent.futures import Future
+from queue import Queue
+from threading import Thread
+from typing import Callable, List, NamedTuple
+
+import numpy as np
+
+
+class Word(NamedTuple):
+    start: float  # seconds from the start of the utterance
+    end: float
+    text: str
+
+
+def _normalize(text):
+    return re.sub(r"[^\w']", "", text.lower())
+
+
+def _repeated_words(committed, words, max_words=5) -> int:
+    """
+    :return: How many words at the start of words repeat the end of committed
+    """
+    for n in range(min(len(committed), len(words), max_words), 0, -1):
+        if [_normalize(w) for w in committed[-n:]] == [_normalize(w) for w in words[:n]]:
+            return n
+    return 0
+
+
+def merge_overlap(committed, text) -> str:
+    """
+    :param committed: Transcript so far
+    :param text: Transcript of audio that overlaps the end of committed
+    :return: text without the words that repeat the end of committed
+    """
+    words = text.split()
+    return " ".join(words[_repeated_words(committed.split(), words) :])
+
+
+class HypothesisBuffer:
+    def __init__(self):
+        """
+        LocalAgreement-2: the longest common prefix of the last two hypotheses is committed
+        """
+        self.committed: List[Word] = []
+        self._previous: List[Word] = []  # uncommitted words of the last hypothesis
+
+    @property
+    def committed_end(self) -> float:
+        return self.committed[-1].end if self.committed else 0.0
+
+    def insert(self, words: List[Word]) -> List[Word]:
+        """
+        :param words: The new hypothesis, with absolute timestamps
+        :return: The words committed by it
+        """
+        end = self.committed_end
+        # words the new hypothesis repeats from before the committed point are not new
+        words = [w for w in words if w.end > end + 0.05]
+        # whisper often repeats the last committed words at the start of a new window
+        words = words[_repeated_words([w.text for w in self.committed], [w.text for w in words]) :]
+        agreed = []
+        for new, old in zip(words, self._previous):
+            if _normalize(new.text) != _normalize(old.text):
+                break
+            agreed.append(new)
+        self.committed.extend(agreed)
+        self._previous = words[len(agreed) :]
+        return agreed
+
+    @property
+    def uncommitted(self) -> List[Word]:
+        return self._previous
+
+
+class OnlineTranscriber:
+    def __init__(
+        self,
+        decode: Callable[[np.ndarray, str], List[Word]],
+        sampling_rate=16000,
+        min_chunk_seconds=1.0,
+        max_buffer_seconds=15.0,
+        prompt_chars=200,
+    ):
+        """
+        :param decode: decode(audio, prompt) -> words with timestamps relative to the audio
+        :param min_chunk_seconds: New audio needed before the buffer is decoded again
+        :param max_buffer_seconds: Audio before the last committed word is dropped once the
+            buffer is this long, so decodes stay short on long turns
+        :param prompt_chars: Committed text passed as the prompt of each decode
+        """
+        self.decode = decode
+        self.sampling_rate = sampling_rate
+        self.min_chunk = int(min_chunk_seconds * sampling_rate)
+        self.max_buffer = int(max_buffer_seconds * sampling_rate)
+        self.prompt_chars = prompt_chars
+        self.reset()
+
+    def reset(self):
+        self.hypothesis = HypothesisBuffer()
+        self.audio = np.zeros(0, dtype=np.float32)
+        self.offset = 0.0  # seconds of audio dropped from the front of the buffer
+        self._decoded = 0  # buffer samples at the last decode
+        self.decodes = 0
+
+    @property
+    def committed_text(self) -> str:
+        return " ".join(w.text.strip() for w in self.hypothesis.committed)
+
+    @property
+    def text(self) -> str:
+        """
+        Committed text followed by the latest uncommitted hypothesis
+        """
+        words = self.hypothesis.committed + self.hypothesis.uncommitted
+        return " ".join(w.text.strip() for w in words)
+
+    def insert_audio(self, audio: np.ndarray):
+        """
+        :param audio: float32 audio
+        """
+        self.audio = np.concatenate((self.audio, audio))
+
+    @property
+    def ready(self) -> bool:
+        return len(self.audio) - self._decoded >= self.min_chunk
+
+    def _decode(self) -> List[Word]:
+        self.decodes += 1
+        self._decoded = len(self.audio)
+        prompt = self.committed_text[-self.prompt_chars :]
+        return [
+            Word(w.start + self.offset, w.end + self.offset, w.text)
+            for w in self.decode(self.audio, prompt)
+        ]
+
+    def process(self) -> List[Word]:
+        """
+        Decodes the buffer and commits the words the last two decodes agree on
+
+        :return: The newly committed words
+        """
+        committed = self.hypothesis.insert(self._decode())
+        if len(self.audio) > self.max_buffer and self.hypothesis.committed:
+            self._drop_until(self.hypothesis.committed_end)
+        return committed
+
+    def _drop_until(self, seconds):
+        cut = int((seconds - self.offset) * self.sampling_rate)
+        if cut > 0:
+            self.audio = self.audio[cut:]
+            self.offset += cut / self.sampling_rate
+            self._decoded = max(0, self._decoded - cut)
+
+    def finish(self) -> List[Word]:
+        """
+        Decodes only the audio after the last committed word and commits all of it
+
+        :return: The words committed by the final decode
+        """
+        if self.hypothesis.committed:
+            self._drop_until(self.hypothesis.committed_end)
+        if len(self.audio) == 0:
+            return []
+        end = self.hypothesis.committed_end
+        words = [w for w in self._decode() if w.end > end + 0.05]
+        self.hypothesis.committed.extend(words)
+        self.hypothesis._previous = []
+        return words
+
+
+class ThreadedTranscription:
+    def __init__(self, transcribe_stream, on_event=None):
+        """
+        Runs an ear's transcribe_stream on its own thread for one utterance, so the audio can
+        be fed while it is spoken without anything blocking on the decoding.
+
+        :param transcribe_stream: transcribe_stream(audio_queue, transcription_queue, on_event)
+        """
+        self._audio = Queue()
+        self._texts = Queue()
+        self._done = Future()
+        Thread(target=self._run, args=(transcribe_stream, on_event), daemon=True).start()
+
+    def _run(self, transcribe_stream, on_event):
+        try:
+            transcribe_stream(self._audio, self._texts, on_event)
+        except Exception as e:
+            print(f"Streaming transcription failed: {e}")
+            self._texts.put(None)
+        texts = []
+        while True:
+            text = self._texts.get()
+            if text is None:
+                break
+            texts.append(text)
+        self._done.set_result(" ".join(texts))
+
+    def feed(self, data):
+        """
+        :param data: int16 audio bytes
+        """
+        self._audio.put(bytes(data))
+
+    def finish(self) -> Future:
+        """
+        Ends the utterance
+
+        :return: A future of its whole transcription
+        """
+        self._audio.put(None)
+        return self._done
@@ -1,52 +1,364 @@
 if __name__ == '__main__':
-    from base import BaseEar
+    from base import BaseEar, TranscriptEvent
 else:
-    from .base import BaseEar
+    from .base import BaseEar, TranscriptEvent
 import os
+import threading
+from time import monotonic
+from urllib.parse import urlencode
 from dotenv import load_dotenv
 import websockets
 import json
 import asyncio
+from concurrent.futures import Future
+
+load_dotenv()
+
+# point at a stand-in server for testing, e.g. ws://localhost:8765/v1/listen
+DEEPGRAM_URL = os.environ.get("DEEPGRAM_URL", "wss://api.deepgram.com/v1/listen")
+# Deepgram closes connections that see no audio or KeepAlive for 10 s
+DEEPGRAM_KEEPALIVE_SECONDS = float(os.environ.get("DEEPGRAM_KEEPALIVE_SECONDS", 5))
+# longest wait for the transcript of an utterance after its last audio
+DEEPGRAM_FINALIZE_TIMEOUT = float(os.environ.get("DEEPGRAM_FINALIZE_TIMEOUT", 5))
+
+SAMPLE_RATE = 16000
+BYTES_PER_SECOND = SAMPLE_RATE * 2
+RECONNECT_DELAYS = (0, 0.25, 0.5, 1, 2, 4)
+
+_FINALIZE = object()
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_deepgram_loop() -> asyncio.AbstractEventLoop:
+    """
+    :return: The process-wide event loop every DeepgramConnection runs on, started on its own
+        thread on first use
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="deepgram", daemon=True).start()
+        return _loop
+
+
+class _Utterance:
+    def __init__(self, transcription_queue=None, on_event=None):
+        self.audio = bytearray()
+        self.sink = transcription_queue
+        self.on_event = on_event
+        self.finals = []  # final transcripts so far
+        self.origin = 0  # byte of the utterance at the current connection's time 0
+        self.confirmed = 0  # bytes covered by final results
+        self.finalize_requested = False
+        self.done = Future()  # the whole transcription
+
+
+class LiveTranscription:
+    def __init__(self, connection, utterance):
+        """
+        An utterance being streamed to Deepgram while it is spoken. Nothing blocks on it.
+        """
+        self._connection = connection
+        self._utterance = utterance
+
+    def feed(self, data):
+        """
+        :param data: int16 audio bytes
+        """
+        self._connection._put(bytes(data))
+
+    def finish(self) -> Future:
+        """
+        Ends the utterance
+
+        :return: A future of its whole transcription
+        """
+        self._connection._put(_FINALIZE)
+        return self._utterance.done
+
+
+class DeepgramConnection:
+    def __init__(
+        self,
+        api_key,
+        url=DEEPGRAM_URL,
+        model="nova-2",
+        interim_results=True,
+        utterance_end_ms=1000,
+        keepalive_seconds=DEEPGRAM_KEEPALIVE_SECONDS,
+        finalize_timeout=DEEPGRAM_FINALIZE_TIMEOUT,
+    ):
+        """
+        One long-lived Deepgram streaming connection, reused for every utterance of a session.
+        All connections of the process share one event loop thread, see get_deepgram_loop().
+
+        Each utterance's audio is followed by a Finalize message, and the Results that answer
+        it (from_finalize) close the utterance. KeepAlive messages hold the connection open
+        between turns. A dropped connection is reopened, and audio of the current utterance
+        that has no final transcript yet is sent again.
+
+        :param url: The listen endpoint; the query string is added here
+        :param interim_results: Ask for partial results while the audio streams
+        :param utterance_end_ms: Gap between words after which Deepgram sends UtteranceEnd.
+            Needs interim_results, and Deepgram accepts 1000 or more.
+        :param keepalive_seconds: Idle time after which a KeepAlive is sent
+        :param finalize_timeout: Seconds to wait for the finalized transcript of an utterance
+        """
+        self.api_key = api_key
+        params = {"encoding": "linear16", "sample_rate": SAMPLE_RATE, "channels": 1, "model": model}
+        if interim_results:
+            params.update(interim_results="true", utterance_end_ms=utterance_end_ms)
+        self.url = url + "?" + urlencode(params)
+        self.keepalive_seconds = keepalive_seconds
+        self.finalize_timeout = finalize_timeout
+        self.connects = 0
+        self._ws = None
+        self._receiver = None
+        self._sent = 0  # audio bytes sent on the current connection
+        self._last_send = monotonic()
+        self._current = None  # the _Utterance being transcribed
+        self._finalizes = 0  # Finalize messages not answered yet on the current connection
+        self._closed = False
+        self._loop = get_deepgram_loop()
+        self._connecting = None
+        self._outbox = None
+        self._writer = None
+        self._call(self._start()).result()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def _start(self):
+        self._connecting = asyncio.Lock()
+        self._outbox = asyncio.Queue()
+        self._writer = asyncio.create_task(self._write())
+
+    def _put(self, item):
+        self._loop.call_soon_threadsafe(self._outbox.put_nowait, item)
+
+    def connect(self):
+        """
+        Opens the connection in the background, so the first utterance does not wait for it
+        """
+        self._call(self._ensure_connected())
+
+    async def _ensure_connected(self):
+        async with self._connecting:
+            if self._ws is None or self._ws.closed:
+                await self._reconnect()
+        return self._ws
+
+    async def _reconnect(self):
+        last_error = None
+        for delay in RECONNECT_DELAYS:
+            await asyncio.sleep(delay)
+            try:
+                self._ws = await websockets.connect(
+                    self.url, extra_headers={"Authorization": "token " + self.api_key}
+                )
+                break
+            except (OSError, websockets.WebSocketException) as e:
+                last_error = e
+                print(f"Deepgram connection failed, retrying: {e}")
+        else:
+            raise ConnectionError(f"Could not connect to Deepgram: {last_error}")
+        self.connects += 1
+        self._sent = 0
+        self._finalizes = 0
+        self._receiver = asyncio.create_task(self._receive(self._ws))
+        utterance = self._current
+        if utterance is not None:
+            # resend what the lost connection had not transcribed yet
+            utterance.origin = utterance.confirmed
+            await self._send_audio(bytes(utterance.audio[utterance.confirmed :]))
+            if utterance.finalize_requested:
+                await self._send_finalize()
+
+    async def _send_finalize(self):
+        await self._ws.send(json.dumps({"type": "Finalize"}))
+        self._finalizes += 1
+        self._last_send = monotonic()
+
+    async def _send_audio(self, data):
+        await self._ws.send(data)
+        self._sent += len(data)
+        self._last_send = monotonic()
+
+    async def _begin(self, utterance):
+        if self._current is not None:
+            # the previous utterance's transcript is still on its way
+            try:
+                await asyncio.wait_for(asyncio.wrap_future(self._current.done), self.finalize_timeout)
+            except asyncio.TimeoutError:
+                print("Deepgram did not finalize the utterance in time")
+                self._end_utterance()
+        utterance.origin = -self._sent
+        self._current = utterance
+
+    async def _finalize(self):
+        utterance = self._current
+        if utterance is None:
+            return
+        utterance.finalize_requested = True
+        if not utterance.audio:
+            self._end_utterance()
+            return
+        self._loop.call_later(self.finalize_timeout, self._finalize_timed_out, utterance)
+        await self._ensure_connected()
+        await self._send_finalize()
+
+    def _finalize_timed_out(self, utterance):
+        if self._current is utterance:
+            print("Deepgram did not finalize the utterance in time")
+            self._end_utterance()
+
+    async def _write(self):
+        while not self._closed:
+            try:
+                item = await asyncio.wait_for(self._outbox.get(), self.keepalive_seconds)
+            except asyncio.TimeoutError:
+                item = None
+            try:
+                if item is None:
+                    idle = monotonic() - self._last_send >= self.keepalive_seconds
+                    if idle and self._ws is not None and not self._ws.closed:
+                        await self._ws.send(json.dumps({"type": "KeepAlive"}))
+                        self._last_send = monotonic()
+                elif isinstance(item, _Utterance):
+                    await self._begin(item)
+                elif item is _FINALIZE:
+                    await self._finalize()
+                elif self._current is not None:
+                    await self._ensure_connected()
+                    self._current.audio.extend(item)
+                    await self._send_audio(item)
+            except websockets.ConnectionClosed:
+                # the receiver reconnects when an utterance is in flight
+                self._ws = None
+            except ConnectionError as e:
+                print(f"Deepgram connection lost: {e}")
+                self._end_utterance()
+
+    async def _receive(self, ws):
+        try:
+            async for msg in ws:
+                msg = json.loads(msg)
+                utterance = self._current
+                if utterance is None:
+                    continue
+                if msg.get("type") == "UtteranceEnd":
+                    self._emit("speech_end", " ".join(utterance.finals))
+                if msg.get("type") != "Results":
+                    continue
+                transcript = msg["channel"]["alternatives"][0]["transcript"]
+                if msg.get("is_final"):
+                    end = utterance.origin + int((msg["start"] + msg["duration"]) * BYTES_PER_SECOND)
+                    utterance.confirmed = max(utterance.confirmed, end)
+                    if transcript:
+                        utterance.finals.append(transcript)
+                        if utterance.sink is not None:
+                            utterance.sink.put(transcript)
+                elif transcript:
+                    self._emit("partial", " ".join(utterance.finals + [transcript]))
+                if msg.get("from_finalize"):
+                    self._finalizes -= 1
+                    if utterance.finalize_requested and self._finalizes <= 0:
+                        self._end_utterance()
+        except websockets.ConnectionClosed:
+            pass
+        if self._ws is ws:
+            self._ws = None
+        if self._current is not None and not self._closed:
+            try:
+                await self._ensure_connected()
+            except ConnectionError as e:
+                print(f"Deepgram connection lost: {e}")
+                self._end_utterance()
+
+    def _emit(self, kind, text):
+        if self._current.on_event is not None:
+            self._current.on_event(TranscriptEvent(kind, text))
+
+    def _end_utterance(self):
+        utterance, self._current = self._current, None
+        if utterance is not None:
+            if utterance.sink is not None:
+                utterance.sink.put(None)
+            utterance.done.set_result(" ".join(utterance.finals))
+
+    def open(self, on_event=None, transcription_queue=None) -> LiveTranscription:
+        """
+        Starts an utterance. Its audio is fed in as it arrives and no thread waits on it.
+
+        :param on_event: Called from the Deepgram loop's thread with "partial" and "speech_end"
+            TranscriptEvents. It runs for every connection, so it must not block.
+        :param transcription_queue: Also gets each final transcript, then None
+        """
+        utterance = _Utterance(transcription_queue, on_event)
+        self._put(utterance)
+        return LiveTranscription(self, utterance)
+
+    def transcribe(self, audio_queue, transcription_queue, on_event=None):
+        """
+        Streams one utterance. Returns once its final transcripts are in transcription_queue,
+        followed by None.
+
+        :param audio_queue: int16 audio chunks, None after the last one
+        :param on_event: Called from the Deepgram loop's thread with "partial" and "speech_end"
+            TranscriptEvents. It runs for every connection, so it must not block.
+        """
+        live = self.open(on_event, transcription_queue)
+        while True:
+            data = audio_queue.get()
+            if data is None:
+                break
+            live.feed(data)
+        live.finish().result()
+
+    async def _close(self):
+        self._closed = True
+        self._end_utterance()
+        self._writer.cancel()
+        if self._ws is not None and not self._ws.closed:
+            try:
+                await self._ws.send(json.dumps({"type": "CloseStream"}))
+            except websockets.ConnectionClosed:
+                pass
+            await self._ws.close()
+        if self._receiver is not None:
+            self._receiver.cancel()
+
+    def close(self):
+        if not self._closed:
+            self._call(self._close()).result()
 
 
 class Ear_deepgram(BaseEar):
-    def __init__(self, silence_seconds=2, api_key='', listener=None):
-        super().__init__(silence_seconds, stream=True, listener=listener)
+    partial_results = True
+
+    def __init__(self, silence_seconds=2, api_key='', listener=None, vad=None, endpointing=None, url=DEEPGRAM_URL):
+        super().__init__(
+            silence_seconds, stream=True, listener=listener, vad=vad, endpointing=endpointing
+        )
         self.api_key = api_key
+        self.connection = DeepgramConnection(api_key, url=url)
+        self.connection.connect()
+
+    def transcribe_stream(self, audio_queue, transcription_queue, on_event=None):
+        self.connection.transcribe(audio_queue, transcription_queue, on_event)
+
+    def open_stream(self, on_event=None) -> LiveTranscription:
+        """
+        Starts transcribing an utterance while it is spoken, without a thread waiting on it
+        """
+        return self.connection.open(on_event)
 
-    def transcribe_stream(self, audio_queue, transcription_queue):
-        extra_headers = {
-           'Authorization': 'token ' + self.api_key
-        }
-        async def f():
-            async with websockets.connect('wss://api.deepgram.com/v1/listen?encoding=linear16&sample_rate=16000'
-                                          '&channels=1&model=nova-2',
-                                          extra_headers=extra_headers) as ws:
-                async def sender(ws):  # sends audio to websocket
-                    try:
-                        while True:
-                            data = audio_queue.get()
-                            if data is None:
-                                await ws.send(json.dumps({"type": "CloseStream"}))
-                                break
-                            await ws.send(data)
-                    except Exception as e:
-                        print('Error while sending: ', str(e))
-                        raise
-
-                async def receiver(ws):
-                    async for msg in ws:
-                        msg = json.loads(msg)
-                        if 'channel' not in msg:
-                            transcription_queue.put(None)
-                            break
-                        transcript = msg['channel']['alternatives'][0]['transcript']
-
-                        if transcript:
-                            transcription_queue.put(transcript)
-
-                await asyncio.gather(sender(ws), receiver(ws))
-        asyncio.run(f())
+    def close(self):
+        super().close()
+        self.connection.close()
 
 
 
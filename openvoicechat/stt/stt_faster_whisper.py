@@ -4,11 +4,20 @@ import os
 import time
 import numpy as np
 import torch
-from .base import BaseEar
+from .base import BaseEar, TranscriptEvent
+from .streaming import OnlineTranscriber, ThreadedTranscription, Word
+from .whisper_batch import get_whisper_batch_service, supports_batching
+from ..model_pool import get_model_pool
 
 from utils.logger import log_response_time, print_info, print_error, print_warning
 
+# decode through the process-wide batch service instead of calling the model per session. Opt-in:
+# it skips model.transcribe's temperature fallback and uses faster-whisper internals
+FASTER_WHISPER_BATCHED = int(os.environ.get("FASTER_WHISPER_BATCHED", 0))
+
 class Ear_faster_whisper(BaseEar):
+    partial_results = True
+
     def __init__(
         self,
         model_size="large-v3",
@@ -22,25 +31,58 @@ class Ear_faster_whisper(BaseEar):
         listener=None,
         stream=True,  # Default to stream mode for better timing measurements
         player=None,  # Added player parameter to match BaseEar
+        streaming=True,
+        min_chunk_seconds=1.0,
+        batched=FASTER_WHISPER_BATCHED,
     ):
+        """
+        :param streaming: Decode while the user speaks and commit the words two consecutive
+            decodes agree on, so only the last uncommitted words are left at the end of speech.
+            False decodes the whole utterance once it has ended.
+        :param min_chunk_seconds: New audio between streaming decodes
+        :param batched: Share one model and batch the decoding with the other sessions of the
+            process (WhisperBatchService). Decoding options other than beam_size and language
+            are not used in this mode, and there is no temperature fallback. Falls back to
+            model.transcribe when the installed faster-whisper lacks the internals it needs.
+        """
         super().__init__(silence_seconds=silence_seconds, listener=listener, stream=stream, player=player)  
         
         from faster_whisper import WhisperModel
         
-        # Initialize the faster whisper model
-        self.model = WhisperModel(
-            model_size, 
-            device=device, 
-            compute_type=compute_type
-        )
+        self.service = None
+        self._model_handle = None
+        if batched:
+            service = get_whisper_batch_service(model_size, device, compute_type, beam_size)
+            if supports_batching(service.model):
+                self.service = service
+                self.service.open_session()
+                self.model = self.service.model
+            else:
+                print_warning("This faster-whisper version cannot be batched, decoding per session")
+        if self.service is None:
+            # The faster whisper model is loaded once per process and shared between sessions
+            self._model_handle = get_model_pool().acquire(
+                ("faster_whisper", model_size, device, compute_type),
+                lambda: WhisperModel(model_size, device=device, compute_type=compute_type),
+            )
+            self.model = self._model_handle.model
         
         self.beam_size = beam_size
         self.language = language
         self.condition_on_previous_text = condition_on_previous_text
         self.word_timestamps = word_timestamps
+        self.streaming = streaming
+        self.min_chunk_seconds = min_chunk_seconds
         
         print(f"Initialized Faster Whisper with model {model_size} on {device}")
     
+    def close(self):
+        super().close()
+        if self.service is not None:
+            self.service.close_session()
+        if self._model_handle is not None:
+            self._model_handle.release()
+
     def transcribe(self, audio):
         """
         Transcribe audio using Faster Whisper
@@ -60,6 +102,12 @@ class Ear_faster_whisper(BaseEar):
             # Otherwise convert to numpy array
             audio_data = np.frombuffer(audio, np.float32)
         
+        if self.service is not None:
+            transcript = self.service.transcribe(audio_data, language=self.language).text
+            self.last_transcription_time = time.time() - start_time
+            print(f"Transcription completed in {self.last_transcription_time:.3f}s")
+            return transcript
+
         # Transcribe using faster whisper
         segments, info = self.model.transcribe(
             audio_data,
@@ -82,10 +130,73 @@ class Ear_faster_whisper(BaseEar):
         print(f"Transcription completed in {self.last_transcription_time:.3f}s")
         return transcript
     
-    def transcribe_stream(self, audio_queue, transcription_queue):
+    def _decode_words(self, audio, prompt):
+        """
+        :return: The words of audio with timestamps, decoded with the committed text as prompt
+        """
+        if self.service is not None:
+            return self.service.transcribe(audio, prompt, self.language, word_timestamps=True).words
+        segments, info = self.model.transcribe(
+            audio,
+            beam_size=self.beam_size,
+            language=self.language,
+            initial_prompt=prompt or None,
+            condition_on_previous_text=False,
+            word_timestamps=True,
+        )
+        return [Word(w.start, w.end, w.word) for segment in segments for w in segment.words]
+
+    def transcribe_stream(self, audio_queue, transcription_queue, on_event=None):
         """
         Transcribe audio stream using Faster Whisper
         
+        :param audio_queue: Queue containing audio chunks
+        :param transcription_queue: Queue to put transcriptions into
+        :param on_event: Called with "partial" TranscriptEvents while streaming
+        """
+        if not self.streaming:
+            return self._transcribe_stream_whole(audio_queue, transcription_queue)
+
+        online = OnlineTranscriber(self._decode_words, min_chunk_seconds=self.min_chunk_seconds)
+        ended = False
+        while not ended:
+            chunks = [audio_queue.get()]
+            # decoding can fall behind the audio, so take everything that arrived meanwhile
+            while not audio_queue.empty():
+                chunks.append(audio_queue.get())
+            if None in chunks:
+                chunks = chunks[: chunks.index(None)]
+                ended = True
+            for chunk in chunks:
+                online.insert_audio(np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32768.0)
+            if ended or not online.ready:
+                continue
+            committed = online.process()
+            if committed:
+                transcription_queue.put(" ".join(w.text.strip() for w in committed))
+            if on_event is not None and online.text:
+                on_event(TranscriptEvent("partial", online.text))
+
+        start_time = time.time()
+        tail = online.finish()
+        end_time = time.time()
+        log_response_time("STT Transcribed in Time", end_time - start_time)
+        self.last_transcription_time = end_time - start_time
+
+        if tail:
+            transcription_queue.put(" ".join(w.text.strip() for w in tail))
+        transcription_queue.put(None)  # Signal end of transcription
+
+    def open_stream(self, on_event=None) -> ThreadedTranscription:
+        """
+        Starts transcribing an utterance while it is spoken, without a thread waiting on it
+        """
+        return ThreadedTranscription(self.transcribe_stream, on_event)
+
+    def _transcribe_stream_whole(self, audio_queue, transcription_queue):
+        """
+        Decodes the whole utterance once its last chunk has arrived
+        
         :param audio_queue: Queue containing audio chunks
         :param transcription_queue: Queue to put transcriptions into
         """
@@ -99,6 +210,15 @@ class Ear_faster_whisper(BaseEar):
         
         # Convert to numpy array for processing
         audio_np = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
+
+        if self.service is not None:
+            start_time = time.time()
+            transcript = self.service.transcribe(audio_np, language=self.language).text
+            self.last_transcription_time = time.time() - start_time
+            log_response_time("STT Transcribed in Time", self.last_transcription_time)
+            transcription_queue.put(transcript)
+            transcription_queue.put(None)
+            return
         
         segments, info = self.model.transcribe(
             audio_np,
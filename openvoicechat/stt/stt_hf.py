@@ -3,8 +3,89 @@ if __name__ == "__main__":
     from base import BaseEar
 else:
     from .base import BaseEar
+import os
 import numpy as np
 
+# "pipeline" runs the model as published, "int8" a dynamically quantised copy, "onnx" an
+# onnxruntime export (needs optimum[onnxruntime])
+EAR_HF_BACKEND = os.environ.get("EAR_HF_BACKEND", "pipeline")
+EAR_HF_CACHE = os.environ.get(
+    "EAR_HF_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "openvoicechat", "hf")
+)
+
+
+def _artefact_dir(model_id, backend):
+    return os.path.join(EAR_HF_CACHE, model_id.replace("/", "--") + "-" + backend)
+
+
+def _load_int8(model_id):
+    """
+    Linear layers quantised to int8 with dynamic activation scales. The quantised weights are
+    saved once with the model's config and generation config; later loads rebuild the module
+    structure from those and read the weights back, so they decode like the first load.
+    """
+    import torch
+    from transformers import AutoConfig, AutoModelForSpeechSeq2Seq, GenerationConfig
+
+    directory = _artefact_dir(model_id, "int8")
+    path = os.path.join(directory, "model.pt")
+    cached = os.path.exists(path) and os.path.exists(os.path.join(directory, "generation_config.json"))
+    if cached:
+        model = AutoModelForSpeechSeq2Seq.from_config(AutoConfig.from_pretrained(directory))
+        # from_config only derives a bare generation config from the model config
+        model.generation_config = GenerationConfig.from_pretrained(directory)
+    else:
+        model = AutoModelForSpeechSeq2Seq.from_pretrained(model_id)
+    model.eval()
+    quantized = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if cached:
+        quantized.load_state_dict(torch.load(path))
+    else:
+        os.makedirs(directory, exist_ok=True)
+        model.config.save_pretrained(directory)
+        model.generation_config.save_pretrained(directory)
+        torch.save(quantized.state_dict(), path)
+    return quantized
+
+
+def _load_onnx(model_id):
+    """
+    Encoder, decoder and decoder-with-past exported to onnx once, so generation reuses the
+    key/value cache instead of re-running the decoder over every token so far
+    """
+    from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+
+    path = _artefact_dir(model_id, "onnx")
+    if os.path.exists(os.path.join(path, "config.json")):
+        return ORTModelForSpeechSeq2Seq.from_pretrained(path, use_cache=True)
+    model = ORTModelForSpeechSeq2Seq.from_pretrained(model_id, export=True, use_cache=True)
+    model.save_pretrained(path)
+    return model
+
+
+def load_pipeline(model_id, device="cpu", backend="pipeline"):
+    """
+    :param backend: "pipeline", "int8" or "onnx"; the last two run on the CPU
+    :return: An automatic-speech-recognition pipeline
+    """
+    from transformers import AutoProcessor, pipeline
+
+    if backend == "pipeline":
+        return pipeline("automatic-speech-recognition", model=model_id, device=device)
+    if backend == "int8":
+        model = _load_int8(model_id)
+    elif backend == "onnx":
+        model = _load_onnx(model_id)
+    else:
+        raise ValueError(f"Unknown Ear_hf backend {backend!r}, expected pipeline, int8 or onnx")
+    processor = AutoProcessor.from_pretrained(model_id)
+    return pipeline(
+        "automatic-speech-recognition",
+        model=model,
+        tokenizer=processor.tokenizer,
+        feature_extractor=processor.feature_extractor,
+    )
+
 
 class Ear_hf(BaseEar):
     def __init__(
@@ -14,21 +95,32 @@ class Ear_hf(BaseEar):
         silence_seconds=2,
         generate_kwargs=None,
         listener=None,
+        backend=EAR_HF_BACKEND,
     ):
+        """
+        :param backend: "pipeline", or "int8" / "onnx" for CPU nodes. The int8 and onnx
+            artefacts are built on first use and cached under EAR_HF_CACHE.
+        """
         super().__init__(silence_seconds, listener=listener)
-        from transformers import pipeline
+        from ..model_pool import get_model_pool
 
-        self.pipe = pipeline(
-            "automatic-speech-recognition", model=model_id, device=device
+        self._pipe_handle = get_model_pool().acquire(
+            ("hf", model_id, device, backend), lambda: load_pipeline(model_id, device, backend)
         )
+        self.pipe = self._pipe_handle.model
         self.device = device
+        self.backend = backend
         self.generate_kwargs = generate_kwargs
 
+    def close(self):
+        super().close()
+        self._pipe_handle.release()
+
     def transcribe(self, audio):
         from torch import no_grad
 
         with no_grad():
-            transcription = self.pipe(audio, generate_kwargs=self.generate_kwargs)
+            transcription = self.pipe(audio, generate_kwargs=self.generate_kwargs or {})
         return transcription["text"].strip()
 
 
@@ -0,0 +1,278 @@
+"""
+Routes each utterance to a local or a cloud ear. Short clips (a "yes", a digit of a zip code,
+speech over the bot checked for barge-in) are transcribed in process, where a cloud round trip
+would cost more than the recognition. Open-ended turns go to the cloud ear, streaming while
+they are spoken.
+"""
+
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import Future
+from queue import Queue
+from time import monotonic
+
+import numpy as np
+
+if __name__ == '__main__':
+    from base import BaseEar
+else:
+    from .base import BaseEar
+
+# utterances shorter than this go to the local ear
+ROUTER_SHORT_SECONDS = float(os.environ.get("ROUTER_SHORT_SECONDS", 1.5))
+# the local limit while the bot waits for a confirmation or digits
+ROUTER_EXPECTED_SECONDS = float(os.environ.get("ROUTER_EXPECTED_SECONDS", 4))
+
+RATE = 16000
+
+# questions answered with a short yes or no
+_YES_NO = re.compile(
+    r"^(is|are|am|was|were|do|does|did|can|could|would|will|should|shall|have|has|may)\b", re.I
+)
+_DIGITS = re.compile(r"\b(zip|postal|postcode|digits?|number|pin|extension|code)\b", re.I)
+
+
+def expected_answer(text):
+    """
+    :param text: What the bot just said
+    :return: "confirmation", "digits" or None for an open answer, judged by its last question
+    """
+    questions = re.findall(r"[^.?!]*\?", text)
+    if not questions:
+        return None
+    question = questions[-1].strip()
+    if _DIGITS.search(question):
+        return "digits"
+    if _YES_NO.match(question):
+        return "confirmation"
+    return None
+
+
+class _RouteStats:
+    def __init__(self, window=1000):
+        self.utterances = 0
+        self.latencies = deque(maxlen=window)  # seconds from the end of audio to the transcript
+        self.audio_seconds = deque(maxlen=window)
+
+    def record(self, latency, audio_seconds):
+        self.utterances += 1
+        self.latencies.append(latency)
+        self.audio_seconds.append(audio_seconds)
+
+    def summary(self) -> dict:
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "utterances": self.utterances,
+            "mean_ms": round(float(latencies.mean()), 1) if len(latencies) else None,
+            "p50_ms": round(float(np.percentile(latencies, 50)), 1) if len(latencies) else None,
+            "p95_ms": round(float(np.percentile(latencies, 95)), 1) if len(latencies) else None,
+            "mean_audio_seconds": round(float(np.mean(self.audio_seconds)), 2) if len(latencies) else None,
+        }
+
+
+class _RoutedStream:
+    def __init__(self, router, on_event):
+        """
+        Holds the start of an utterance until it is clearly not a short clip, then hands it to
+        the cloud ear's stream. An utterance that ends before that goes to the local ear.
+        """
+        self._router = router
+        self._on_event = on_event
+        self._limit = int(router.local_limit() * RATE) * 2
+        self._audio = bytearray()
+        self._cloud = None
+        self._bytes = 0
+
+    def feed(self, data):
+        """
+        :param data: int16 audio bytes
+        """
+        self._bytes += len(data)
+        if self._cloud is not None:
+            self._cloud.feed(data)
+            return
+        self._audio.extend(data)
+        if len(self._audio) >= self._limit:
+            self._cloud = self._router.cloud.open_stream(self._on_event)
+            self._cloud.feed(bytes(self._audio))
+            self._audio = None
+
+    def finish(self) -> Future:
+        """
+        :return: A future of the utterance's transcription
+        """
+        seconds = self._bytes / 2 / RATE
+        if self._cloud is not None:
+            return self._router._timed("cloud", seconds, self._cloud.finish())
+        audio = (np.frombuffer(bytes(self._audio), dtype=np.int16) / (1 << 15)).astype(np.float32)
+        future = Future()
+        threading.Thread(target=self._transcribe_local, args=(audio, future), daemon=True).start()
+        return future
+
+    def _transcribe_local(self, audio, future):
+        try:
+            future.set_result(self._router._transcribe_local(audio))
+        except Exception as e:
+            future.set_exception(e)
+
+
+class Ear_router(BaseEar):
+    def __init__(
+        self,
+        local,
+        cloud,
+        short_seconds=ROUTER_SHORT_SECONDS,
+        expected_seconds=ROUTER_EXPECTED_SECONDS,
+        silence_seconds=2,
+        listener=None,
+        player=None,
+        vad=None,
+        endpointing=None,
+    ):
+        """
+        :param local: An in-process ear, e.g. Ear_vosk or Ear_faster_whisper with a small model
+        :param cloud: A streaming cloud ear, e.g. Ear_deepgram
+        :param short_seconds: Utterances shorter than this are transcribed locally
+        :param expected_seconds: The local limit after the bot asked a yes/no question or for
+            digits, see expect() and expect_reply_to()
+        """
+        super().__init__(
+            silence_seconds,
+            listener=listener,
+            stream=cloud.stream,
+            player=player,
+            vad=vad,
+            endpointing=endpointing,
+        )
+        self.local = local
+        self.cloud = cloud
+        self.short_seconds = short_seconds
+        self.expected_seconds = expected_seconds
+        self.partial_results = cloud.partial_results
+        self.expected = None
+        self.stats = {route: _RouteStats() for route in ("local", "cloud", "interruption")}
+        # local recognizers keep decoding state, so one utterance at a time
+        self._local_lock = threading.Lock()
+
+    def close(self):
+        super().close()
+        self.local.close()
+        self.cloud.close()
+
+    def expect(self, answer_type):
+        """
+        :param answer_type: "confirmation", "digits", or None for an open answer
+        """
+        self.expected = answer_type
+
+    def expect_reply_to(self, text):
+        """
+        Sets the expected answer from what the bot just said
+        """
+        self.expect(expected_answer(text))
+
+    def local_limit(self) -> float:
+        return self.expected_seconds if self.expected is not None else self.short_seconds
+
+    def route(self, seconds) -> str:
+        """
+        :return: "local" or "cloud"
+        """
+        return "local" if seconds < self.local_limit() else "cloud"
+
+    def route_stats(self) -> dict:
+        """
+        :return: Utterance count, latency percentiles and mean audio length for each route
+        """
+        return {route: stats.summary() for route, stats in self.stats.items()}
+
+    def _timed(self, route, seconds, future) -> Future:
+        start = monotonic()
+        future.add_done_callback(lambda _: self.stats[route].record(monotonic() - start, seconds))
+        return future
+
+    def _transcribe_local(self, audio, route="local"):
+        start = monotonic()
+        with self._local_lock:
+            text = self.local.transcribe(audio)
+        self.stats[route].record(monotonic() - start, len(audio) / RATE)
+        return text
+
+    def _transcribe_cloud(self, audio):
+        start = monotonic()
+        if self.cloud.stream:
+            text = self.cloud._sim_transcribe_stream(audio)
+        else:
+            text = self.cloud.transcribe(audio)
+        self.stats["cloud"].record(monotonic() - start, len(audio) / RATE)
+        return text
+
+    def _transcribe_interruption(self, audio):
+        # barge-in checks are short by design and never worth a round trip
+        return self._transcribe_local(audio, "interruption")
+
+    def transcribe(self, audio):
+        if self.route(len(audio) / RATE) == "local":
+            return self._transcribe_local(audio)
+        return self._transcribe_cloud(audio)
+
+    def transcribe_stream(self, audio_queue, transcription_queue, on_event=None):
+        """
+        Waits for the local limit's worth of audio, then either transcribes the whole short
+        utterance locally or streams everything to the cloud ear
+        """
+        limit = int(self.local_limit() * RATE) * 2
+        head = []
+        size = 0
+        ended = False
+        while size < limit:
+            data = audio_queue.get()
+            if data is None:
+                ended = True
+                break
+            head.append(data)
+            size += len(data)
+        if ended:
+            audio = (np.frombuffer(b"".join(head), dtype=np.int16) / (1 << 15)).astype(np.float32)
+            transcription_queue.put(self._transcribe_local(audio))
+            transcription_queue.put(None)
+            return
+
+        cloud_queue = Queue()
+        for data in head:
+            cloud_queue.put(data)
+        kwargs = {"on_event": on_event} if self.cloud.partial_results else {}
+        transcription = threading.Thread(
+            target=self.cloud.transcribe_stream, args=(cloud_queue, transcription_queue), kwargs=kwargs
+        )
+        transcription.start()
+        while True:
+            data = audio_queue.get()
+            if data is None:
+                break
+            cloud_queue.put(data)
+            size += len(data)
+        start = monotonic()
+        cloud_queue.put(None)
+        transcription.join()
+        self.stats["cloud"].record(monotonic() - start, size / 2 / RATE)
+
+    def open_stream(self, on_event=None) -> _RoutedStream:
+        """
+        Starts transcribing an utterance while it is spoken. The cloud ear only sees it once it
+        is longer than the local limit.
+        """
+        return _RoutedStream(self, on_event)
+
+
+if __name__ == "__main__":
+    from stt_deepgram import Ear_deepgram
+    from stt_vosk import Ear_vosk
+
+    ear = Ear_router(Ear_vosk(), Ear_deepgram(api_key=os.environ.get("DEEPGRAM_API_KEY", "")))
+    ear.expect_reply_to("Can I book that table for you?")
+    text = ear.listen()
+    print(text)
+    print(ear.route_stats())
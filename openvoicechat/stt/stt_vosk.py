@@ -1,39 +1,150 @@
 import numpy as np
 import json
+import os
+import threading
 
 if __name__ == '__main__':
-    from base import BaseEar
+    from base import BaseEar, TranscriptEvent
+    from streaming import ThreadedTranscription
 else:
-    from .base import BaseEar
+    from .base import BaseEar, TranscriptEvent
+    from .streaming import ThreadedTranscription
 
-class Ear_vosk(BaseEar):
-    def __init__(self, model_path='models/vosk-model-en-us-0.22', device='cpu', silence_seconds=2):
-        super().__init__(silence_seconds)
+# recognizers kept ready per model once their sessions are done with them
+VOSK_POOL_IDLE = int(os.environ.get("VOSK_POOL_IDLE", 8))
+
+
+def _load_model(model_path):
+    import vosk
+
+    return vosk.Model(model_path)
+
+
+class RecognizerPool:
+    def __init__(self, model, sampling_rate=16000, max_idle=VOSK_POOL_IDLE):
+        """
+        KaldiRecognizers over one shared vosk.Model. Each utterance gets a recognizer of its own,
+        so sessions share the weights but not the decoder state.
+
+        :param max_idle: Recognizers kept for reuse, more are dropped when released
+        """
+        self.model = model
+        self.sampling_rate = sampling_rate
+        self.max_idle = max_idle
+        self.created = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.created += 1
         import vosk
-        self.model = vosk.Model(model_path)
-        self.recognizer = vosk.KaldiRecognizer(self.model, 16000)
+
+        return vosk.KaldiRecognizer(self.model, self.sampling_rate)
+
+    def release(self, recognizer):
+        recognizer.Reset()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(recognizer)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_recognizer_pool(model_path) -> RecognizerPool:
+    """
+    :return: The process-wide recognizer pool of the model, loading the model once
+    """
+    with _pools_lock:
+        if model_path not in _pools:
+            from ..model_pool import get_model_pool
+
+            # shared with the interruption detector's keyword spotting when it uses the same model
+            handle = get_model_pool().acquire(("vosk", model_path), lambda: _load_model(model_path), pinned=True)
+            _pools[model_path] = RecognizerPool(handle.model)
+        return _pools[model_path]
+
+
+class Ear_vosk(BaseEar):
+    partial_results = True
+
+    def __init__(
+        self,
+        model_path='models/vosk-model-en-us-0.22',
+        device='cpu',
+        silence_seconds=2,
+        listener=None,
+        stream=True,
+        player=None,
+        vad=None,
+        endpointing=None,
+    ):
+        super().__init__(
+            silence_seconds, listener=listener, stream=stream, player=player, vad=vad, endpointing=endpointing
+        )
+        self.pool = get_recognizer_pool(model_path)
+        self.model = self.pool.model
         self.device = device
 
     def transcribe(self, audio):
         # if audio is a tensor convert it to numpy array
         audio = audio.astype(np.float64) * (1 << 15)
         audio = audio.astype(np.int16).tobytes()
-        result_text = ''
-        i = 0
-        while True:
-            data = audio[i * 12000: (i + 1) * 12000]
-            i += 1
-            if len(data) == 0:
-                break
-            if self.recognizer.AcceptWaveform(data):
-                if result_text == '':
-                    result_text = json.loads(self.recognizer.Result())['text']
-                else:
-                    result_text += json.loads(self.recognizer.Result())['text']
-            else:
-                pass
-
-        return result_text
+        recognizer = self.pool.acquire()
+        try:
+            texts = []
+            for i in range(0, len(audio), 12000):
+                if recognizer.AcceptWaveform(audio[i: i + 12000]):
+                    texts.append(json.loads(recognizer.Result())['text'])
+            texts.append(json.loads(recognizer.FinalResult())['text'])
+        finally:
+            self.pool.release(recognizer)
+        return ' '.join(text for text in texts if text)
+
+    def transcribe_stream(self, audio_queue, transcription_queue, on_event=None):
+        """
+        Feeds each chunk to a recognizer as it arrives
+
+        :param audio_queue: int16 audio chunks, None after the last one
+        :param transcription_queue: Gets each final result, then None
+        :param on_event: Called with "partial" TranscriptEvents while the audio streams
+        """
+        recognizer = self.pool.acquire()
+        finals = []
+        partial = ''
+        try:
+            while True:
+                data = audio_queue.get()
+                if data is None:
+                    break
+                if recognizer.AcceptWaveform(bytes(data)):
+                    text = json.loads(recognizer.Result())['text']
+                    if text:
+                        finals.append(text)
+                        transcription_queue.put(text)
+                    partial = ''
+                elif on_event is not None:
+                    text = json.loads(recognizer.PartialResult())['partial']
+                    if text and text != partial:
+                        partial = text
+                        on_event(TranscriptEvent('partial', ' '.join(finals + [text])))
+            text = json.loads(recognizer.FinalResult())['text']
+            if text:
+                transcription_queue.put(text)
+        finally:
+            self.pool.release(recognizer)
+            transcription_queue.put(None)
+
+    def open_stream(self, on_event=None) -> ThreadedTranscription:
+        """
+        Starts transcribing an utterance while it is spoken, without a thread waiting on it
+        """
+        return ThreadedTranscription(self.transcribe_stream, on_event)
+
 
 if __name__ == "__main__":
     import torchaudio
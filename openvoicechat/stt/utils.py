@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 import pyaudio
 
@@ -6,6 +8,71 @@ FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RATE = 16000
 
+# longest utterance kept per call, older audio of a monologue is overwritten
+RECORD_MAX_SECONDS = float(os.environ.get("RECORD_MAX_SECONDS", 60))
+
+
+class AudioRingBuffer:
+    def __init__(self, max_seconds=RECORD_MAX_SECONDS, rate=RATE):
+        """
+        Preallocated int16 capture buffer. Writing a chunk copies it in place, reading the
+        recent audio gives a numpy view, and the float32 conversion happens once per utterance.
+
+        :param max_seconds: Capacity; once full the oldest audio is overwritten
+        :param rate: Sample rate of the audio written
+        """
+        self.capacity = int(max_seconds * rate)
+        self._buffer = np.zeros(self.capacity, dtype=np.int16)
+        self.cursor = 0  # samples written since clear()
+
+    def clear(self):
+        self.cursor = 0
+
+    def __len__(self):
+        return min(self.cursor, self.capacity)
+
+    def write(self, data):
+        """
+        :param data: int16 bytes or array
+        """
+        samples = np.frombuffer(data, dtype=np.int16)
+        if len(samples) > self.capacity:
+            self.cursor += len(samples) - self.capacity
+            samples = samples[-self.capacity :]
+        start = self.cursor % self.capacity
+        end = start + len(samples)
+        if end <= self.capacity:
+            self._buffer[start:end] = samples
+        else:
+            split = self.capacity - start
+            self._buffer[start:] = samples[:split]
+            self._buffer[: end - self.capacity] = samples[split:]
+        self.cursor += len(samples)
+
+    def last(self, n_samples) -> np.ndarray:
+        """
+        :return: The most recent n_samples as int16, a view unless they wrap around the buffer
+        """
+        n_samples = min(n_samples, len(self))
+        end = self.cursor % self.capacity or (self.capacity if self.cursor else 0)
+        if n_samples <= end:
+            return self._buffer[end - n_samples : end]
+        return np.concatenate((self._buffer[end - n_samples :], self._buffer[:end]))
+
+    def to_float32(self, n_samples=None) -> np.ndarray:
+        """
+        :return: A new float32 array in [-1, 1) of the most recent n_samples, all by default
+        """
+        n_samples = len(self) if n_samples is None else min(n_samples, len(self))
+        out = np.empty(n_samples, dtype=np.float32)
+        end = self.cursor % self.capacity or (self.capacity if self.cursor else 0)
+        head = min(n_samples, end)
+        # Normalization: https://discuss.pytorch.org/t/torchaudio-load-normalization-question/71470
+        np.multiply(self._buffer[end - head : end], 1 / (1 << 15), out=out[n_samples - head :])
+        if head < n_samples:
+            np.multiply(self._buffer[self.capacity - (n_samples - head) :], 1 / (1 << 15), out=out[: n_samples - head])
+        return out
+
 
 def make_stream():
     p = pyaudio.PyAudio()
@@ -14,28 +81,41 @@ def make_stream():
     )
 
 
-def record_interruption_parallel(vad, listen_queue):
-    frames = []
+def record_interruption_parallel(vad, listen_queue, buffer=None):
+    if buffer is None:
+        buffer = AudioRingBuffer()
+    buffer.clear()
     stream = make_stream()
     while True:
         a = listen_queue.get()
         if a is None:
             break
         data = stream.read(CHUNK)
-        frames.append(data)
-        contains_speech = vad.contains_speech(frames[int(RATE / CHUNK) * -2 :])
+        buffer.write(data)
+        window = int(RATE / CHUNK) * 2 * CHUNK
+        contains_speech = vad.contains_speech([buffer.last(window)])
         if contains_speech:
             stream.close()
-            frames = np.frombuffer(b"".join(frames), dtype=np.int16)
-            frames = frames / (1 << 15)
-            return frames.astype(np.float32)
+            return buffer.to_float32()
     stream.close()
     return None
 
 
-def record_interruption(vad, record_seconds=100, streamer=None):
+def record_interruption(vad, record_seconds=100, streamer=None, buffer=None, max_speech_ms=None):
+    """
+    Records until speech starts.
+
+    :param max_speech_ms: Instead keep recording until the speech stops or has lasted this long
+    :return: float32 audio from shortly before the speech started, None if there was no speech
+    """
+    from .vad import StreamingVAD
+
     print("*Recording for Interruption...")
-    frames = []
+    if buffer is None:
+        buffer = AudioRingBuffer()
+    buffer.clear()
+    speech = StreamingVAD(vad, min_silence_ms=300)
+    started = None
     if streamer is None:
         stream = make_stream()
         global CHUNK
@@ -48,19 +128,40 @@ def record_interruption(vad, record_seconds=100, streamer=None):
     for _ in range(0, int(RATE / CHUNK * record_seconds)):
         data = stream.read(CHUNK)
         assert len(data) == CHUNK * 2, "Chunk size does not match 2 bytes per sample."
-        frames.append(data)
-        contains_speech = vad.contains_speech(frames[int(RATE / CHUNK) * -2 :])
-        if contains_speech:
+        buffer.write(data)
+        events = speech.process(data)
+        ended = any(event.type == "end" for event in events)
+        for event in events:
+            if event.type == "start":
+                started = event.sample
+        if started is None:
+            continue
+        spoken = speech.position - started
+        if max_speech_ms is None or ended or spoken * 1000 >= max_speech_ms * RATE:
             stream.close()
-            frames = np.frombuffer(b"".join(frames), dtype=np.int16)
-            frames = frames / (1 << 15)
-            return frames.astype(np.float32)
+            return buffer.to_float32(buffer.cursor - started + int(0.3 * RATE))
     stream.close()
     return None
 
 
-def record_user(silence_seconds, vad, streamer=None, started=False):
-    frames = []
+def record_user(silence_seconds, vad, streamer=None, started=False, buffer=None, endpointer=None):
+    """
+    Records until silence_seconds of silence after speech.
+
+    :param buffer: AudioRingBuffer to record into. When started, the recording continues the
+        audio already in it and the returned array includes that audio.
+    :param endpointer: An endpointing.Endpointer to end the turn before silence_seconds
+    :return: float32 audio of the utterance
+    """
+    from .vad import StreamingVAD
+
+    if buffer is None:
+        buffer = AudioRingBuffer()
+    if not started:
+        buffer.clear()
+    speech = StreamingVAD(
+        vad, min_silence_ms=silence_seconds * 1000, triggered=started, endpointer=endpointer
+    )
 
     if streamer is None:
         stream = make_stream()
@@ -70,40 +171,28 @@ def record_user(silence_seconds, vad, streamer=None, started=False):
         stream = streamer.make_stream()
         CHUNK = streamer.CHUNK
         RATE = streamer.RATE
-    one_second_iters = int(RATE / CHUNK)
     print("*Recording...")
 
     while True:
         data = stream.read(CHUNK)
         assert len(data) == CHUNK * 2, "Chunk size does not match 2 bytes per sample."
-        frames.append(data)
-        if len(frames) < one_second_iters * silence_seconds:
-            continue
-        contains_speech = vad.contains_speech(
-            frames[int(-one_second_iters * silence_seconds) :]
-        )
-        if not started and contains_speech:
-            started = True
+        buffer.write(data)
+        events = speech.process(data)
+        if any(event.type == "start" for event in events):
             print("*Listening to Speech...")
-        if started and contains_speech is False:
+        if any(event.type == "end" for event in events):
             break
     stream.close()
 
     print("*Done Recording.")
 
-    frames = np.frombuffer(
-        b"".join(frames), dtype=np.int16
-    )  # Creating a np array from buffer
+    return buffer.to_float32()
 
-    # Normalization: https://discuss.pytorch.org/t/torchaudio-load-normalization-question/71470
-    frames = frames / (1 << 15)
 
-    return frames.astype(np.float32)
+def record_user_stream(silence_seconds, vad, audio_queue, streamer=None, player=None, endpointer=None):
+    from .vad import StreamingVAD
 
-
-def record_user_stream(silence_seconds, vad, audio_queue, streamer=None, player=None):
-    frames = []
-    started = False
+    speech = StreamingVAD(vad, min_silence_ms=silence_seconds * 1000, endpointer=endpointer)
     if streamer is None:
         stream = make_stream()
         global CHUNK
@@ -113,28 +202,28 @@ def record_user_stream(silence_seconds, vad, audio_queue, streamer=None, player=
         CHUNK = streamer.CHUNK
         RATE = streamer.RATE
     
-    one_second_iters = int(RATE / CHUNK)
     print("*Recording...")
     
-    while True:
-        data = stream.read(CHUNK)
-        frames.append(data)
-        audio_queue.put(data)
-        
-        contains_speech = vad.contains_speech(
-            frames[int(-one_second_iters * silence_seconds) :]
-        )
-        
-        if not started and contains_speech:
-            started = True
-            print("*Listening to Speech...")
-            # Add None check before calling stop()
-            if player is not None:
-                player.stop()
-        
-        if started and contains_speech is False:
-            break
-    
-    audio_queue.put(None)
+    try:
+        while True:
+            data = stream.read(CHUNK)
+            audio_queue.put(data)
+
+            events = speech.process(data)
+
+            if any(event.type == "start" for event in events):
+                print("*Listening to Speech...")
+                # Add None check before calling stop()
+                if player is not None:
+                    player.stop()
+
+            if any(event.type == "end" for event in events):
+                break
+    except EOFError:
+        # the websocket closed mid-recording, the audio so far is transcribed
+        print("*Stream closed.")
+    finally:
+        # the transcription thread waits for the end of the audio, also when the stream fails
+        audio_queue.put(None)
     stream.close()
     print("*Done Recording.")
\ No newline at end of file
@@ -1,4 +1,9 @@
-import torch
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from time import monotonic
+from typing import List, NamedTuple
 import numpy as np
 import warnings
 
@@ -6,18 +11,128 @@ warnings.filterwarnings("ignore")
 
 if __name__ == "__main__":
     from utils import record_user
+    from openvoicechat.model_pool import get_model_pool
 else:
-    from .utils import record_user
+    from ..model_pool import get_model_pool
 
+FRAME_SAMPLES = 512  # silero scores 32 ms frames at 16 kHz
+CONTEXT_SAMPLES = 64  # and sees the end of the previous frame with each one
+STATE_SHAPE = (2, 128)  # recurrent state per stream: [2, batch, 128]
 
-class VoiceActivityDetection:
-    def __init__(self, sampling_rate=16000):
-        self.model, utils = torch.hub.load(
-            repo_or_dir="snakers4/silero-vad",
-            model="silero_vad",
-            force_reload=False,
-            verbose=False,
+# "onnx" runs a local silero_vad.onnx with onnxruntime, "torch" loads silero through torch.hub,
+# "auto" picks onnx when onnxruntime and the model file are available. setup.sh downloads the
+# model to SILERO_VAD_ONNX_PATH's default; the silero-vad pip package ships it as well.
+VAD_BACKEND = os.environ.get("VAD_BACKEND", "auto")
+SILERO_VAD_ONNX_PATH = os.environ.get(
+    "SILERO_VAD_ONNX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "silero_vad.onnx"),
+)
+
+VAD_BATCH_WAIT_MS = float(os.environ.get("VAD_BATCH_WAIT_MS", 10))
+VAD_MAX_BATCH = int(os.environ.get("VAD_MAX_BATCH", 256))
+
+
+def _load_silero():
+    import torch
+
+    model, utils = torch.hub.load(
+        repo_or_dir="snakers4/silero-vad",
+        model="silero_vad",
+        force_reload=False,
+        verbose=False,
+    )
+    # model() keeps its recurrent state on the module, so get_speech_timestamps callers take turns;
+    # predict() passes the state explicitly and needs no lock
+    return model, utils, threading.Lock()
+
+
+def _onnx_model_path():
+    if os.path.exists(SILERO_VAD_ONNX_PATH):
+        return SILERO_VAD_ONNX_PATH
+    try:
+        # the silero-vad pip package ships the same model
+        from importlib.resources import files
+
+        path = str(files("silero_vad").joinpath("data", "silero_vad.onnx"))
+        if os.path.exists(path):
+            return path
+    except ImportError:
+        pass
+    return None
+
+
+def _load_silero_onnx():
+    import onnxruntime
+
+    path = _onnx_model_path()
+    if path is None:
+        raise FileNotFoundError(
+            f"silero_vad.onnx not found at {SILERO_VAD_ONNX_PATH}. Run the silero step of setup.sh, "
+            "download it from https://github.com/snakers4/silero-vad/tree/master/src/silero_vad/data "
+            "or set SILERO_VAD_ONNX_PATH"
+        )
+    # inputs are a few hundred samples, so thread handoffs would cost more than the math;
+    # the batch scheduler and the worker pools give parallelism across calls
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = 1
+    options.inter_op_num_threads = 1
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(
+        path, sess_options=options, providers=["CPUExecutionProvider"]
+    )
+
+
+_warned_fallback = False
+
+
+def _warn_fallback(reason):
+    # printed, not warnings.warn: this module ignores warnings
+    global _warned_fallback
+    if not _warned_fallback:
+        _warned_fallback = True
+        print(
+            f"WARNING: VAD_BACKEND=auto falls back to silero through torch.hub: {reason}. "
+            "torch.hub downloads the model from GitHub on first use. "
+            "Run the silero step of setup.sh or set SILERO_VAD_ONNX_PATH."
         )
+
+
+def resolve_vad_backend(backend=None):
+    """
+    :param backend: "onnx", "torch" or "auto", defaults to VAD_BACKEND
+    :return: "onnx" or "torch"
+    """
+    backend = backend or VAD_BACKEND
+    if backend != "auto":
+        return backend
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        _warn_fallback("onnxruntime is not installed")
+        return "torch"
+    if _onnx_model_path() is None:
+        _warn_fallback(f"silero_vad.onnx not found at {SILERO_VAD_ONNX_PATH}")
+        return "torch"
+    return "onnx"
+
+
+class VoiceActivityDetection:
+    def __init__(self, sampling_rate=16000, backend=None):
+        """
+        :param backend: "onnx", "torch" or "auto", defaults to the VAD_BACKEND env var.
+            Both run the same silero v5 model; only torch provides the hub utilities
+            (get_speech_timestamps, VADIterator, ...).
+        """
+        self.backend = resolve_vad_backend(backend)
+        self.sampling_rate = sampling_rate
+        if self.backend == "onnx":
+            self._handle = get_model_pool().acquire("silero_vad_onnx", _load_silero_onnx)
+            self.session = self._handle.model
+            self._sr = np.array(sampling_rate, dtype=np.int64)
+            return
+        self._handle = get_model_pool().acquire("silero_vad", _load_silero)
+        self.model, utils, self._lock = self._handle.model
         (
             self.get_speech_timestamps,
             self.save_audio,
@@ -25,7 +140,16 @@ class VoiceActivityDetection:
             self.VADIterator,
             self.collect_chunks,
         ) = utils
-        self.sampling_rate = sampling_rate
+
+    @staticmethod
+    def preload(backend=None):
+        """
+        Loads silero into the process-wide model pool and pins it there.
+        """
+        if resolve_vad_backend(backend) == "onnx":
+            get_model_pool().preload("silero_vad_onnx", _load_silero_onnx)
+        else:
+            get_model_pool().preload("silero_vad", _load_silero)
 
     def contains_speech(self, audio):
         frames = np.frombuffer(b"".join(audio), dtype=np.int16)
@@ -33,12 +157,322 @@ class VoiceActivityDetection:
         # Normalization: https://discuss.pytorch.org/t/torchaudio-load-normalization-question/71470
         frames = frames / (1 << 15)
 
+        if self.backend == "onnx":
+            n_frames = len(frames) // FRAME_SAMPLES
+            frames = frames[: n_frames * FRAME_SAMPLES].astype(np.float32).reshape(n_frames, 1, FRAME_SAMPLES)
+            state = context = None
+            probabilities = []
+            for frame in frames:
+                probability, state, context = self.predict(frame, state, context)
+                probabilities.append(probability[0])
+            return self._has_speech_segment(probabilities)
+
+        import torch
+
         audio = torch.tensor(frames.astype(np.float32))
-        speech_timestamps = self.get_speech_timestamps(
-            audio, self.model, sampling_rate=self.sampling_rate, threshold=0.5
-        )  # threshold=0.5
+        with self._lock:
+            speech_timestamps = self.get_speech_timestamps(
+                audio, self.model, sampling_rate=self.sampling_rate, threshold=0.5
+            )  # threshold=0.5
         return len(speech_timestamps) > 0
 
+    def _has_speech_segment(self, probabilities, threshold=0.5, min_speech_ms=250, min_silence_ms=100):
+        """
+        get_speech_timestamps' segmentation rule over frame probabilities: speech starts at the
+        threshold, ends after min_silence_ms below threshold - 0.15, and counts if it lasted
+        longer than min_speech_ms.
+        """
+        neg_threshold = threshold - 0.15
+        min_speech = self.sampling_rate * min_speech_ms / 1000
+        min_silence = self.sampling_rate * min_silence_ms / 1000
+        triggered = False
+        start = temp_end = 0
+        for i, probability in enumerate(probabilities):
+            position = i * FRAME_SAMPLES
+            if probability >= threshold:
+                temp_end = 0
+                if not triggered:
+                    triggered, start = True, position
+            elif probability < neg_threshold and triggered:
+                if not temp_end:
+                    temp_end = position
+                if position - temp_end >= min_silence:
+                    if temp_end - start > min_speech:
+                        return True
+                    triggered, temp_end = False, 0
+        return triggered and len(probabilities) * FRAME_SAMPLES - start > min_speech
+
+    def predict(self, frames, state=None, context=None):
+        """
+        Scores one frame of each of a batch of streams. The recurrent state is passed in and
+        returned instead of living on the shared model, so any number of streams can use the
+        model at once. Uses silero v5's inner 16 kHz model, or the onnx export of it.
+
+        :param frames: float32 [batch, FRAME_SAMPLES]
+        :param state: float32 [2, batch, 128] from the previous call, None for new streams
+        :param context: float32 [batch, CONTEXT_SAMPLES] from the previous call, None for new streams
+        :return: (speech probabilities [batch], state, context)
+        """
+        frames = np.asarray(frames, dtype=np.float32)
+        batch = frames.shape[0]
+        if state is None:
+            state = np.zeros((STATE_SHAPE[0], batch, STATE_SHAPE[1]), dtype=np.float32)
+        if context is None:
+            context = np.zeros((batch, CONTEXT_SAMPLES), dtype=np.float32)
+        x = np.concatenate((context, frames), axis=1)
+        if self.backend == "onnx":
+            out, new_state = self.session.run(None, {"input": x, "state": state, "sr": self._sr})
+            return out[:, 0], new_state, x[:, -CONTEXT_SAMPLES:]
+
+        import torch
+
+        with torch.no_grad():
+            out, new_state = self.model._model(torch.from_numpy(x), torch.from_numpy(state))
+        return out[:, 0].numpy(), new_state.numpy(), x[:, -CONTEXT_SAMPLES:]
+
+    def predict_batch(self, requests):
+        """
+        Scores frames from different streams in one forward pass
+
+        :param requests: (frames [1, FRAME_SAMPLES], state or None, context or None) per stream
+        :return: (probability [1], state, context) per stream, in the same order
+        """
+        zero_state = np.zeros((STATE_SHAPE[0], 1, STATE_SHAPE[1]), dtype=np.float32)
+        zero_context = np.zeros((1, CONTEXT_SAMPLES), dtype=np.float32)
+        frames = np.concatenate([r[0] for r in requests])
+        state = np.concatenate([zero_state if r[1] is None else r[1] for r in requests], axis=1)
+        context = np.concatenate([zero_context if r[2] is None else r[2] for r in requests])
+        probabilities, state, context = self.predict(frames, state, context)
+        return [
+            (probabilities[i : i + 1], state[:, i : i + 1], context[i : i + 1])
+            for i in range(len(requests))
+        ]
+
+    def close(self):
+        self._handle.release()
+
+
+class _VADRequest(NamedTuple):
+    frames: np.ndarray
+    state: np.ndarray
+    context: np.ndarray
+    future: Future
+    arrival: float
+
+
+class VADBatchScheduler:
+    def __init__(self, vad=None, max_wait_ms=VAD_BATCH_WAIT_MS, max_batch=VAD_MAX_BATCH):
+        """
+        Scores the frames of all sessions together. Frames submitted within max_wait_ms of the
+        oldest pending one go through the model as one batch, on the scheduler's own thread.
+        A batch is cut early once every open stream has a frame waiting.
+
+        :param vad: The VoiceActivityDetection to run. The scheduler creates its own by default.
+        :param max_wait_ms: Longest a frame waits for others to join its batch
+        :param max_batch: Most frames per forward pass
+        """
+        self.vad = vad if vad is not None else VoiceActivityDetection()
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self.batches = 0
+        self.frames = 0
+        self._pending = []
+        self._streams = 0
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def open_stream(self):
+        with self._cond:
+            self._streams += 1
+
+    def close_stream(self):
+        with self._cond:
+            self._streams = max(0, self._streams - 1)
+            self._cond.notify()
+
+    def submit(self, frames, state=None, context=None) -> Future:
+        """
+        :param frames: float32 [1, FRAME_SAMPLES], one frame of one stream
+        :return: A future of (probability [1], state, context), like predict()
+        """
+        future = Future()
+        with self._cond:
+            self._pending.append(_VADRequest(frames, state, context, future, monotonic()))
+            self._cond.notify()
+        return future
+
+    def predict(self, frames, state=None, context=None):
+        """
+        Blocking submit(), so the scheduler can stand in for a VoiceActivityDetection
+        """
+        return self.submit(frames, state, context).result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = self._pending[0].arrival + self.max_wait
+                while len(self._pending) < min(self.max_batch, max(self._streams, 1)):
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[: self.max_batch]
+                del self._pending[: self.max_batch]
+            self._score(batch)
+
+    def _score(self, batch):
+        try:
+            results = self.vad.predict_batch([(r.frames, r.state, r.context) for r in batch])
+        except Exception as e:
+            for r in batch:
+                r.future.set_exception(e)
+            return
+        self.batches += 1
+        self.frames += len(batch)
+        for r, result in zip(batch, results):
+            r.future.set_result(result)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_vad_scheduler() -> VADBatchScheduler:
+    """
+    :return: The process-wide VAD batch scheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = VADBatchScheduler()
+        return _scheduler
+
+
+class SpeechEvent(NamedTuple):
+    type: str  # "start" or "end"
+    sample: int  # position in the stream where speech started or ended
+
+
+class StreamingVAD:
+    def __init__(
+        self,
+        vad,
+        threshold=0.5,
+        neg_threshold=None,
+        min_speech_ms=250,
+        min_silence_ms=2000,
+        sampling_rate=16000,
+        triggered=False,
+        endpointer=None,
+    ):
+        """
+        Frame-by-frame speech detector for one audio stream, with the same semantics as silero's
+        VADIterator. Every sample is scored once and the model state is carried across calls.
+
+        :param vad: A VoiceActivityDetection (or anything with its predict())
+        :param threshold: Probability at or above which a frame is speech
+        :param neg_threshold: Probability below which a frame is silence. Defaults to threshold - 0.15.
+            Frames in between extend neither speech nor silence.
+        :param min_speech_ms: Speech needed before a "start" event
+        :param min_silence_ms: Silence (hangover) needed before an "end" event
+        :param triggered: Start inside speech, e.g. to continue a recording
+        :param endpointer: An endpointing.Endpointer that picks the silence ending each turn,
+            capped by min_silence_ms
+        """
+        self.vad = vad
+        self.threshold = threshold
+        self.neg_threshold = neg_threshold if neg_threshold is not None else max(threshold - 0.15, 0.01)
+        self.min_speech_samples = int(sampling_rate * min_speech_ms / 1000)
+        self.min_silence_samples = int(sampling_rate * min_silence_ms / 1000)
+        self.sampling_rate = sampling_rate
+        self.endpointer = endpointer
+        self.reset(triggered)
+
+    def reset(self, triggered=False):
+        self.triggered = triggered
+        self.probability = 0.0
+        self.position = 0  # samples scored so far
+        self._state = None
+        self._context = None
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._speech = 0
+        self._silence = 0
+        if self.endpointer is not None:
+            self.endpointer.reset()
+
+    def _frames(self, audio):
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            audio = np.frombuffer(audio, dtype=np.int16).astype(np.float32) / (1 << 15)
+        if len(self._pending):
+            audio = np.concatenate((self._pending, audio))
+        n_frames = len(audio) // FRAME_SAMPLES
+        self._pending = audio[n_frames * FRAME_SAMPLES :]
+        return [audio[i * FRAME_SAMPLES : (i + 1) * FRAME_SAMPLES][None] for i in range(n_frames)]
+
+    def process(self, audio) -> List[SpeechEvent]:
+        """
+        :param audio: int16 bytes or a float32 array of any length
+        :return: The speech start and end events completed by this audio
+        """
+        events = []
+        for frame in self._frames(audio):
+            probability, self._state, self._context = self.vad.predict(frame, self._state, self._context)
+            event = self.update(float(probability[0]))
+            if event is not None:
+                events.append(event)
+        return events
+
+    async def process_async(self, audio) -> List[SpeechEvent]:
+        """
+        process() for a VAD with submit(), e.g. a VADBatchScheduler. The event loop stays free
+        while the frame waits for its batch.
+        """
+        events = []
+        for frame in self._frames(audio):
+            future = self.vad.submit(frame, self._state, self._context)
+            probability, self._state, self._context = await asyncio.wrap_future(future)
+            event = self.update(float(probability[0]))
+            if event is not None:
+                events.append(event)
+        return events
+
+    def _min_silence(self):
+        if self.endpointer is None:
+            return self.min_silence_samples
+        silence = int(self.sampling_rate * self.endpointer.silence_ms() / 1000)
+        return min(silence, self.min_silence_samples)
+
+    def update(self, probability) -> SpeechEvent:
+        """
+        Advances the state machine by one frame scored elsewhere, e.g. in a batch
+        """
+        self.probability = probability
+        self.position += FRAME_SAMPLES
+        if self.triggered and self.endpointer is not None:
+            self.endpointer.observe(probability)
+        if probability >= self.threshold:
+            self._silence = 0
+            if not self.triggered:
+                self._speech += FRAME_SAMPLES
+                if self._speech >= self.min_speech_samples:
+                    self.triggered = True
+                    return SpeechEvent("start", self.position - self._speech)
+        elif probability < self.neg_threshold:
+            if not self.triggered:
+                self._speech = 0
+            else:
+                self._silence += FRAME_SAMPLES
+                if self._silence >= self._min_silence():
+                    if self.endpointer is not None:
+                        self.endpointer.reset()
+                    self.triggered = False
+                    self._speech = 0
+                    silence, self._silence = self._silence, 0
+                    return SpeechEvent("end", self.position - silence)
+        return None
+
 
 if __name__ == "__main__":
     from transformers import pipeline
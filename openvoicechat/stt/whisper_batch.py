@@ -0,0 +1,353 @@
+"""
+One faster-whisper model serving every session of the process. Utterances from all sessions
+are queued and decoded together as one batched ctranslate2 call, so throughput grows with the
+batch size instead of with the number of model copies fighting over the cores.
+"""
+
+import os
+import threading
+from concurrent.futures import Future
+from math import ceil
+from time import monotonic
+from typing import List, NamedTuple
+
+import numpy as np
+
+from .streaming import Word
+
+WHISPER_BATCH_WAIT_MS = int(os.environ.get("WHISPER_BATCH_WAIT_MS", 50))
+WHISPER_MAX_BATCH = int(os.environ.get("WHISPER_MAX_BATCH", 8))
+# print the service's stats at most this often while it decodes, 0 to never
+WHISPER_BATCH_STATS_SECONDS = float(os.environ.get("WHISPER_BATCH_STATS_SECONDS", 300))
+
+SAMPLE_RATE = 16000
+CHUNK_SAMPLES = 30 * SAMPLE_RATE  # whisper's input window
+PREPEND_PUNCTUATIONS = "\"'“¿([{-"
+APPEND_PUNCTUATIONS = "\"'.。,，!！?？:：”)]}、"
+
+
+# WhisperModel internals decode_batch relies on; they are not public API and change between
+# faster-whisper releases
+_MODEL_INTERNALS = (
+    "encode",
+    "get_prompt",
+    "add_word_timestamps",
+    "feature_extractor",
+    "hf_tokenizer",
+    "max_length",
+    "frames_per_second",
+)
+
+
+def supports_batching(model) -> bool:
+    """
+    :param model: A faster_whisper.WhisperModel
+    :return: Whether the installed faster-whisper has everything WhisperBatchService calls
+    """
+    try:
+        from faster_whisper.audio import pad_or_trim  # noqa: F401
+        from faster_whisper.tokenizer import Tokenizer  # noqa: F401
+        from faster_whisper.transcribe import get_suppressed_tokens  # noqa: F401
+    except ImportError:
+        return False
+    return all(hasattr(model, name) for name in _MODEL_INTERNALS) and hasattr(model.model, "generate")
+
+
+class WhisperResult(NamedTuple):
+    text: str
+    words: List[Word]  # empty unless word timestamps were asked for
+
+
+class _WhisperRequest(NamedTuple):
+    audio: np.ndarray  # at most CHUNK_SAMPLES
+    prompt: str
+    language: str
+    word_timestamps: bool
+    future: Future
+    arrival: float
+
+
+class WhisperBatchService:
+    def __init__(
+        self,
+        model,
+        beam_size=5,
+        max_wait_ms=WHISPER_BATCH_WAIT_MS,
+        max_batch=WHISPER_MAX_BATCH,
+        no_speech_threshold=0.6,
+        stats_seconds=WHISPER_BATCH_STATS_SECONDS,
+    ):
+        """
+        Decodes the utterances of all sessions together. Utterances submitted within
+        max_wait_ms of the oldest pending one are decoded as one batch on the service's
+        own thread. A batch is cut early once every open session has an utterance waiting.
+        Utterances longer than 30 s are split and decoded in the same batch.
+
+        :param model: A faster_whisper.WhisperModel
+        :param max_wait_ms: Longest an utterance waits for others to join its batch
+        :param max_batch: Most 30 s windows per batch
+        :param no_speech_threshold: Windows whisper scores as silence above this come out empty
+        :param stats_seconds: Print stats() at most this often while decoding, 0 to never
+        """
+        self.model = model
+        self.beam_size = beam_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self.no_speech_threshold = no_speech_threshold
+        self.stats_seconds = stats_seconds
+        self.batches = 0
+        self.utterances = 0
+        self.windows = 0
+        self.max_queue_depth = 0
+        self._tokenizers = {}
+        self._pending = []
+        self._sessions = 0
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def open_session(self):
+        with self._cond:
+            self._sessions += 1
+
+    def close_session(self):
+        with self._cond:
+            self._sessions = max(0, self._sessions - 1)
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queue_depth": len(self._pending),
+                "max_queue_depth": self.max_queue_depth,
+                "batches": self.batches,
+                "utterances": self.utterances,
+                "mean_batch_size": round(self.windows / max(self.batches, 1), 2),
+            }
+
+    def submit(self, audio, prompt="", language="en", word_timestamps=False) -> Future:
+        """
+        :param audio: float32 16 kHz audio of one utterance
+        :param prompt: Text that came before the utterance, e.g. its committed words
+        :return: A future of its WhisperResult, with word times relative to the audio
+        """
+        audio = np.asarray(audio, dtype=np.float32)
+        futures = []
+        with self._cond:
+            for start in range(0, max(len(audio), 1), CHUNK_SAMPLES):
+                future = Future()
+                self._pending.append(
+                    _WhisperRequest(
+                        audio[start : start + CHUNK_SAMPLES], prompt, language, word_timestamps, future, monotonic()
+                    )
+                )
+                futures.append(future)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._pending))
+            self.utterances += 1
+            self._cond.notify()
+        if len(futures) == 1:
+            return futures[0]
+        return _join(futures)
+
+    def transcribe(self, audio, prompt="", language="en", word_timestamps=False) -> WhisperResult:
+        """
+        Blocking submit()
+        """
+        return self.submit(audio, prompt, language, word_timestamps).result()
+
+    def _run(self):
+        stats_at = monotonic() + self.stats_seconds
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = self._pending[0].arrival + self.max_wait
+                while len(self._pending) < min(self.max_batch, max(self._sessions, 1)):
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                # a batch shares one tokenizer, so it holds a single language
+                language = self._pending[0].language
+                batch = [r for r in self._pending if r.language == language][: self.max_batch]
+                self._pending = [r for r in self._pending if not any(r is b for b in batch)]
+            self._decode(batch, language)
+            if self.stats_seconds and monotonic() >= stats_at:
+                stats_at = monotonic() + self.stats_seconds
+                print(f"Whisper batch service: {self.stats()}")
+
+    def _tokenizer(self, language):
+        if language not in self._tokenizers:
+            from faster_whisper.tokenizer import Tokenizer
+
+            self._tokenizers[language] = Tokenizer(
+                self.model.hf_tokenizer,
+                self.model.model.is_multilingual,
+                task="transcribe",
+                language=language if self.model.model.is_multilingual else "en",
+            )
+        return self._tokenizers[language]
+
+    def _decode(self, batch, language):
+        try:
+            results = self.decode_batch(batch, language)
+        except Exception as e:
+            for r in batch:
+                r.future.set_exception(e)
+            return
+        with self._cond:
+            self.batches += 1
+            self.windows += len(batch)
+        for r, result in zip(batch, results):
+            r.future.set_result(result)
+
+    def decode_batch(self, batch, language) -> List[WhisperResult]:
+        from faster_whisper.audio import pad_or_trim
+        from faster_whisper.transcribe import get_suppressed_tokens
+
+        model = self.model
+        tokenizer = self._tokenizer(language)
+        features = np.stack(
+            [pad_or_trim(model.feature_extractor(r.audio)[..., :-1]) for r in batch]
+        )
+        encoder_output = model.encode(features)
+        prompts = [
+            model.get_prompt(
+                tokenizer,
+                previous_tokens=tokenizer.encode(" " + r.prompt.strip()) if r.prompt.strip() else [],
+                without_timestamps=True,
+            )
+            for r in batch
+        ]
+        outputs = model.model.generate(
+            encoder_output,
+            prompts,
+            beam_size=self.beam_size,
+            max_length=model.max_length,
+            suppress_blank=True,
+            suppress_tokens=get_suppressed_tokens(tokenizer, [-1]),
+            return_scores=True,
+            return_no_speech_prob=True,
+        )
+        tokens = []
+        for output in outputs:
+            sequence = [t for t in output.sequences_ids[0] if t < tokenizer.eot]
+            avg_logprob = output.scores[0] * len(output.sequences_ids[0]) / (len(output.sequences_ids[0]) + 1)
+            if output.no_speech_prob > self.no_speech_threshold and avg_logprob < -1:
+                sequence = []
+            tokens.append(sequence)
+
+        words = [[] for _ in batch]
+        if any(r.word_timestamps for r in batch):
+            # alignment runs over the whole encoder batch, so every window gets its words
+            durations = [len(r.audio) / SAMPLE_RATE for r in batch]
+            segments = [
+                [dict(tokens=sequence, start=0.0, end=duration, seek=0)]
+                for sequence, duration in zip(tokens, durations)
+            ]
+            model.add_word_timestamps(
+                segments,
+                tokenizer,
+                encoder_output,
+                [int(ceil(d) * model.frames_per_second) for d in durations],
+                PREPEND_PUNCTUATIONS,
+                APPEND_PUNCTUATIONS,
+                0.0,
+            )
+            words = [
+                [Word(w["start"], w["end"], w["word"]) for w in segment[0].get("words", [])]
+                for segment in segments
+            ]
+        return [
+            WhisperResult(tokenizer.decode(sequence).strip(), item_words if r.word_timestamps else [])
+            for r, sequence, item_words in zip(batch, tokens, words)
+        ]
+
+
+def _join(futures) -> Future:
+    """
+    :return: A future of the 30 s windows of one utterance joined back together
+    """
+    joined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            results = [f.result() for f in futures]
+        except Exception as e:
+            joined.set_exception(e)
+            return
+        words = [
+            Word(w.start + i * 30, w.end + i * 30, w.text)
+            for i, result in enumerate(results)
+            for w in result.words
+        ]
+        joined.set_result(WhisperResult(" ".join(r.text for r in results if r.text), words))
+
+    for future in futures:
+        future.add_done_callback(done)
+    return joined
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_whisper_batch_service(model_size, device="cpu", compute_type="int8", beam_size=5) -> WhisperBatchService:
+    """
+    :return: The process-wide batch service for the model, loading the model once
+    """
+    key = (model_size, device, compute_type, beam_size)
+    with _services_lock:
+        if key not in _services:
+            from faster_whisper import WhisperModel
+
+            from ..model_pool import get_model_pool
+
+            # pinned: the service keeps the model for the life of the process
+            handle = get_model_pool().acquire(
+                ("faster_whisper", model_size, device, compute_type),
+                lambda: WhisperModel(model_size, device=device, compute_type=compute_type),
+                pinned=True,
+            )
+            _services[key] = WhisperBatchService(handle.model, beam_size=beam_size)
+        return _services[key]
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from faster_whisper import WhisperModel
+
+    parser = argparse.ArgumentParser(description="Utterance throughput, one at a time against batched")
+    parser.add_argument("model", help="a faster-whisper model size or path")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--compute-type", default="int8")
+    args = parser.parse_args()
+
+    service = WhisperBatchService(
+        WhisperModel(args.model, device=args.device, compute_type=args.compute_type), beam_size=1
+    )
+    rng = np.random.default_rng(0)
+    for sessions in args.sessions:
+        utterances = [(0.1 * rng.standard_normal(3 * SAMPLE_RATE)).astype(np.float32) for _ in range(sessions)]
+        start = time.perf_counter()
+        for audio in utterances:
+            service.transcribe(audio)
+        sequential = sessions / (time.perf_counter() - start)
+        for _ in range(sessions):
+            service.open_session()
+        start = time.perf_counter()
+        for future in [service.submit(audio) for audio in utterances]:
+            future.result()
+        batched = sessions / (time.perf_counter() - start)
+        for _ in range(sessions):
+            service.close_session()
+        print(f"{sessions:>3} sessions: {sequential:.2f} utterances/s one at a time, {batched:.2f} batched")
+    print(service.stats())
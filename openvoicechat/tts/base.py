@@ -45,6 +45,11 @@ class BaseMouth:
         self.timing_path = timing_path
         self.wait = wait
 
+    def close(self):
+        """
+        Releases any pooled models held by this mouth
+        """
+
     def run_tts(self, text: str) -> np.ndarray:
         """
         :param text: The text to synthesize speech for
@@ -2,20 +2,47 @@ import sounddevice as sd
 import numpy as np
 if __name__ == '__main__':
     from base import BaseMouth
+    from openvoicechat.model_pool import get_model_pool, file_size
 else:
     from .base import BaseMouth
+    from ..model_pool import get_model_pool, file_size
+
+
+DEFAULT_MODEL_PATH = '/home/salman/Desktop/AutoEngageFYP/en_US-ryan-high.onnx'
+DEFAULT_CONFIG_PATH = '/home/salman/Desktop/AutoEngageFYP/en_US-ryan-high.onnx.json'
+
+
+def _voice_pool_args(model_path, config_path, device):
+    import piper
+    return (
+        ('piper', model_path, device),
+        lambda: piper.PiperVoice.load(model_path=model_path,
+                                      config_path=config_path,
+                                      use_cuda=True if device == 'cuda' else False),
+    )
 
 
 class Mouth_piper(BaseMouth):
-    def __init__(self, device='cpu', model_path='/home/salman/Desktop/AutoEngageFYP/en_US-ryan-high.onnx',
-                 config_path='/home/salman/Desktop/AutoEngageFYP/en_US-ryan-high.onnx.json',
+    def __init__(self, device='cpu', model_path=DEFAULT_MODEL_PATH,
+                 config_path=DEFAULT_CONFIG_PATH,
                  player=sd):
-        import piper
-        self.model = piper.PiperVoice.load(model_path=model_path,
-                                           config_path=config_path,
-                                           use_cuda=True if device == 'cuda' else False)
+        # The voice is loaded once per process; each mouth only keeps its own player and interruption state
+        key, loader = _voice_pool_args(model_path, config_path, device)
+        self._model_handle = get_model_pool().acquire(key, loader, size_bytes=file_size(model_path))
+        self.model = self._model_handle.model
         super().__init__(sample_rate=self.model.config.sample_rate, player=player)
 
+    @staticmethod
+    def preload(device='cpu', model_path=DEFAULT_MODEL_PATH, config_path=DEFAULT_CONFIG_PATH):
+        """
+        Loads the voice into the process-wide model pool and pins it there.
+        """
+        key, loader = _voice_pool_args(model_path, config_path, device)
+        get_model_pool().preload(key, loader, size_bytes=file_size(model_path))
+
+    def close(self):
+        self._model_handle.release()
+
     def run_tts(self, text):
         audio = b''
         for i in self.model.synthesize_stream_raw(text):
@@ -26,8 +53,7 @@ class Mouth_piper(BaseMouth):
 if __name__ == '__main__':
     import torch
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    mouth = Mouth_piper(device=device, model_path='/home/salman/Desktop/AutoEngageFYP/en_US-ryan-high.onnx',
-                        config_path='/home/salman/Desktop/AutoEngageFYP/en_US-ryan-high.onnx.json')
+    mouth = Mouth_piper(device=device, model_path=DEFAULT_MODEL_PATH, config_path=DEFAULT_CONFIG_PATH)
 
     text = ("If there's one thing that makes me nervous about the future of self-driving cars, it's that they'll "
             "replace human drivers.\nI think there's a huge opportunity to make human-driven cars safer and more "
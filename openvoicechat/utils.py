@@ -1,14 +1,23 @@
-import multiprocessing
+import collections
 import os
 import queue
 import random
 import threading
 import time
-import librosa
 import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 
+from .protocol import (
+    MessageType,
+    SampleFormat,
+    decode,
+    decode_audio,
+    encode,
+    encode_audio,
+)
+from .resample import StreamingResampler
+
 load_dotenv()
 
 TIMING = int(os.environ.get("TIMING", 0))
@@ -44,6 +53,24 @@ def clean_text_for_tts(text):
     
     return cleaned
 
+
+def random_greeting(minibot_args):
+    """
+    :return: One of the opening lines the agent starts a call with
+    """
+    agent_name = minibot_args.get("agent_name", "Agent")
+    organization_name = minibot_args.get("organization_name", "Our Company")
+    return random.choice(
+        [
+            f"Hello, I am {agent_name} from {organization_name}. How can I help you?",
+            f"Hello! This is {agent_name} from {organization_name}. How can I be of assistance?",
+            f"Hi! This is {organization_name}'s representative {agent_name}. What can I do for you?",
+            f"Hi! You're speaking with {agent_name} from {organization_name}. What can I do for you?",
+            f"Hey, there! You're speaking with {agent_name} from {organization_name}. How can I assist you?",
+        ]
+    )
+
+
 def run_chat_original(
     mouth,
     ear,
@@ -71,18 +98,7 @@ def run_chat_original(
         pd.DataFrame(columns=["Model", "Time Taken"]).to_csv(timing_path, index=False)
 
     if starting_message:
-        agent_name = minibot_args.get("agent_name")
-        organization_name = minibot_args.get("organization_name")
-        initial_message = random.choice(
-            [
-                f"Hello, I am {agent_name} from {organization_name}. How can I help you?",
-                f"Hello! This is {agent_name} from {organization_name}. How can I be of assistance?",
-                f"Hi! This is {organization_name}'s representative {agent_name}. What can I do for you?",
-                f"Hi! You're speaking with {agent_name} from {organization_name}. What can I do for you?",
-                f"Hey, there! You're speaking with {agent_name} from {organization_name}. How can I assist you?",
-            ]
-        )
-        mouth.say_text(initial_message)
+        mouth.say_text(random_greeting(minibot_args))
 
     pre_interruption_text = ""
     while True:
@@ -208,14 +224,7 @@ def run_chat_langchain(
         
         # Initial message
         if starting_message:
-            initial_message = random.choice([
-                f"Hello, I am {agent_name} from {organization_name}. How can I help you?",
-                f"Hello! This is {agent_name} from {organization_name}. How can I be of assistance?",
-                f"Hi! This is {organization_name}'s representative {agent_name}. What can I do for you?",
-                f"Hi! You're speaking with {agent_name} from {organization_name}. What can I do for you?",
-                f"Hey, there! You're speaking with {agent_name} from {organization_name}. How can I assist you?",
-            ])
-            mouth.say_text(initial_message)
+            mouth.say_text(random_greeting(minibot_args))
 
         pre_interruption_text = ""
         
@@ -299,70 +308,237 @@ def run_chat_langchain(
         run_chat_original(mouth, ear, chatbot, minibot_args, verbose, stopping_criteria, starting_message, logging_path)
 
 
+def _drain_queue(q):
+    while not q.empty():
+        q.get_nowait()
+
+
+class PlaybackClock:
+    def __init__(self, clock=time.monotonic):
+        """
+        Estimates when the audio sent to a client finishes playing. Frames play back to back,
+        so each one ends its duration after the previous one (or after it was sent, if the
+        client was idle). Playback acks from the client re-anchor the estimate.
+
+        :param clock: Monotonic time source in seconds
+        """
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._pending = collections.deque()  # (seq, duration) sent but not acked
+        self._start = None
+        self._end = 0.0
+
+    def add(self, seq, duration):
+        with self._cond:
+            now = self._clock()
+            if self._end <= now:
+                # the client went idle, so nothing sent before can still be playing
+                self._pending.clear()
+                self._start = now
+                self._end = now
+            self._end += duration
+            self._pending.append((seq, duration))
+
+    def ack(self, seq):
+        """
+        The client finished playing frame seq and started on the next one
+        """
+        with self._cond:
+            if not self._pending or self._pending[0][0] > seq:
+                return
+            while self._pending and self._pending[0][0] <= seq:
+                self._pending.popleft()
+            self._end = self._clock() + sum(duration for _, duration in self._pending)
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._pending.clear()
+            self._end = self._clock()
+            self._cond.notify_all()
+
+    @property
+    def remaining(self) -> float:
+        """
+        Seconds of sent audio left to play
+        """
+        return max(0.0, self._end - self._clock())
+
+    @property
+    def elapsed(self) -> float:
+        """
+        Seconds since the client started playing the current run of audio
+        """
+        if self._start is None:
+            return 0.0
+        now = self._clock()
+        return min(now, self._end) - self._start
+
+    @property
+    def playing(self) -> bool:
+        return self.remaining > 0
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Blocks until the sent audio has played or stop() is called.
+
+        :return: False if timeout ran out first
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        with self._cond:
+            while True:
+                remaining = self.remaining
+                if remaining <= 0:
+                    return True
+                if deadline is not None:
+                    if deadline <= self._clock():
+                        return False
+                    remaining = min(remaining, deadline - self._clock())
+                # woken early by ack() and stop(), which move the end of playback
+                self._cond.wait(remaining)
+
+
 class Player_ws:
-    def __init__(self, q):
+    def __init__(self, q, loop=None):
+        """
+        :param q: The queue the websocket sender reads audio from.
+        :param loop: The event loop owning q when it is an asyncio.Queue. Audio is then handed to
+            the loop thread-safely so the sender can push it as soon as it is synthesized.
+        """
         self.output_queue = q
-        self.playing = False
-        self._timer_thread = None
+        self.loop = loop
+        self.clock = PlaybackClock()
         self.interrupted = False
+        # Negotiated with the client; by default int16 at the TTS engine's native rate
+        self.sample_format = SampleFormat.INT16
+        self.sample_rate = None
+        self.seq = 0
+        self.acked_seq = 0
+        self._resamplers = {}
+
+    @property
+    def playing(self) -> bool:
+        return self.clock.playing
+
+    def configure(self, sample_format=SampleFormat.INT16, sample_rate=None):
+        """
+        :param sample_format: The sample format the client plays
+        :param sample_rate: The rate the client needs audio in. None sends the TTS engine's native rate.
+        """
+        self.sample_format = sample_format
+        self.sample_rate = sample_rate
 
     def play(self, audio_array, samplerate):
-        self.playing = True
         self.interrupted = False
         duration = len(audio_array) / samplerate
-        if audio_array.dtype == np.int16:
-            audio_array = audio_array / (1 << 15)
-        audio_array = audio_array.astype(np.float32)
-        audio_array = librosa.resample(
-            y=audio_array, orig_sr=samplerate, target_sr=44100
-        )
-        audio_array = audio_array.tobytes()
-        
+        if self.sample_rate is not None and self.sample_rate != samplerate:
+            key = (samplerate, self.sample_rate)
+            if key not in self._resamplers:
+                self._resamplers[key] = StreamingResampler(samplerate, self.sample_rate)
+            audio_array = self._resamplers[key].resample(audio_array)
+            samplerate = self.sample_rate
+        self.seq += 1
+        frame = encode_audio(audio_array, samplerate, self.seq, self.sample_format)
+
         if not self.interrupted:
-            self.output_queue.put(audio_array)
-            
-        if self._timer_thread is not None:
-            if self._timer_thread.is_alive():
-                self._timer_thread.terminate()
-        self._timer_thread = multiprocessing.Process(
-            target=time.sleep, args=(duration,)
-        )
-        self._timer_thread.start()
+            self._put(frame)
+            self.clock.add(self.seq, duration)
 
     def stop(self):
-        self.playing = False
         self.interrupted = True
-        self.output_queue.queue.clear()
-        self.output_queue.put("stop".encode())
-        if self._timer_thread and self._timer_thread.is_alive():
-            self._timer_thread.terminate()
+        self._clear()
+        self._put(encode(MessageType.BARGE_IN, seq=self.seq))
+        self.clock.stop()
+
+    def end_of_utterance(self):
+        self._put(encode(MessageType.END_OF_UTTERANCE, seq=self.seq))
+
+    def ack(self, seq):
+        """
+        Called when the client reports that the audio frame seq finished playing
+        """
+        self.acked_seq = max(self.acked_seq, seq)
+        self.clock.ack(seq)
+
+    def _put(self, data):
+        if self.loop is None:
+            self.output_queue.put(data)
+        else:
+            self.loop.call_soon_threadsafe(self.output_queue.put_nowait, data)
+
+    def _clear(self):
+        if self.loop is None:
+            self.output_queue.queue.clear()
+        else:
+            # runs on the loop before the next _put, so queued audio is dropped ahead of "stop"
+            self.loop.call_soon_threadsafe(_drain_queue, self.output_queue)
 
     def wait(self):
-        if self._timer_thread:
-            self._timer_thread.join()
-        self.playing = False
+        self.clock.wait()
 
         
 class Listener_ws:
-    def __init__(self, q):
+    def __init__(self, q, on_close=None):
+        """
+        :param q: Queue of AUDIO frames received from the websocket
+        :param on_close: Called when a recording finishes, e.g. to tell the client its utterance was captured
+        """
         self.input_queue = q
+        self.on_close = on_close
         self.listening = False
-        self.CHUNK = 5945
+        self.shut_down = False
+        self.CHUNK = 512  # one VAD frame
         self.RATE = 16_000
+        self._buffer = bytearray()
+        # one per client rate, carrying filter state across frames so chunk edges stay continuous
+        self._resamplers = {}
+
+    def decode(self, data) -> bytes:
+        """
+        :param data: An AUDIO frame in any negotiated format
+        :return: The frame's samples as 16 kHz int16 bytes
+        """
+        frame = decode(data)
+        if frame.sample_rate == self.RATE and frame.sample_format == SampleFormat.INT16:
+            # frames captured by the AudioWorklet are already 16 kHz int16
+            return frame.payload
+        audio = decode_audio(frame)
+        if frame.sample_rate != self.RATE:
+            if frame.sample_rate not in self._resamplers:
+                self._resamplers[frame.sample_rate] = StreamingResampler(frame.sample_rate, self.RATE)
+            audio = self._resamplers[frame.sample_rate].process(audio)
+        if audio.dtype != np.int16:
+            audio = (np.clip(audio, -1.0, 1.0) * ((1 << 15) - 1)).astype(np.int16)
+        return audio.tobytes()
 
     def read(self, x):
-        data = self.input_queue.get()
-        data = np.frombuffer(data, dtype=np.float32)
-        data = librosa.resample(y=data, orig_sr=44100, target_sr=16_000)
-        data = data * (1 << 15)
-        data = data.astype(np.int16)
-        data = data.tobytes()
+        # client frames can have any length, so hand out fixed CHUNK sized blocks
+        n_bytes = self.CHUNK * 2
+        while len(self._buffer) < n_bytes:
+            data = None if self.shut_down else self.input_queue.get()
+            if data is None:
+                raise EOFError("The websocket is closed")
+            self._buffer.extend(self.decode(data))
+        data = bytes(self._buffer[:n_bytes])
+        del self._buffer[:n_bytes]
         return data
 
     def close(self):
-        pass
+        if self.on_close is not None:
+            self.on_close()
+
+    def shutdown(self):
+        """
+        Ends the stream for good once the websocket is gone. A read waiting for audio and every
+        later read raise EOFError.
+        """
+        self.shut_down = True
+        self.input_queue.put(None)
 
     def make_stream(self):
         self.listening = True
         self.input_queue.queue.clear()
+        self._buffer.clear()
+        for resampler in self._resamplers.values():
+            resampler.reset()
         return self
@@ -26,6 +26,11 @@ pip install -r requirements.txt
 # Install pyaudio using conda
 conda install -c anaconda pyaudio=0.2.14 -y
 
+# Fetch the silero VAD model for the onnxruntime backend (openvoicechat/stt/vad.py); the same
+# model torch.hub loads, without the fallback to torch
+mkdir -p openvoicechat/stt/models
+curl -fsSL -o openvoicechat/stt/models/silero_vad.onnx https://raw.githubusercontent.com/snakers4/silero-vad/master/src/silero_vad/data/silero_vad.onnx
+
 # Install Ollama and Llama 3
 curl -fsSL https://ollama.com/install.sh | sh
 ollama serve & ollama pull mxbai-embed-large
@@ -364,6 +364,23 @@ def get_chat_history_by_organization_team_agent(
     )
 
 
+def save_chat_histories(db: Session, updates: dict):
+    """
+    Writes the chat data and response times of several live chats in a single transaction.
+    updates maps a chat history id to a dict of the columns to set.
+    """
+    chat_histories = (
+        db.query(models.ChatHistory)
+        .filter(models.ChatHistory.id.in_(list(updates)))
+        .all()
+    )
+    for chat_history in chat_histories:
+        for column, value in updates[chat_history.id].items():
+            setattr(chat_history, column, value)
+    db.commit()
+    return chat_histories
+
+
 def update_chat_history(
     db: Session, chat_history_id: int, chat_history: schemas.ChatHistoryUpdate
 ):
@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+
+from . import crud
+from .database import SessionLocal
+
+
+class RunningMean:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class _LiveChat:
+    def __init__(self, chat_history_id, get_context):
+        self.chat_history_id = chat_history_id
+        self.get_context = get_context
+        self.timings = {
+            "stt": RunningMean(),
+            "llm": RunningMean(),
+            "tts": RunningMean(),
+            "total_cycle": RunningMean(),
+        }
+        self.flushed_length = -1
+        self.dirty = True
+
+
+class ChatPersistenceBuffer:
+    def __init__(self, session_factory=SessionLocal, flush_interval=10.0, poll_interval=0.5):
+        """
+        Keeps the chat data and latency statistics of live calls in memory and writes them
+        to the database at turn boundaries, every flush_interval seconds and on disconnect,
+        batching all pending calls into one transaction.
+
+        :param session_factory: Creates the database sessions used for flushing
+        :param flush_interval: Seconds between flushes of calls with pending changes
+        :param poll_interval: Seconds between checks for finished turns
+        """
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self._chats = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def register(self, key, chat_history_id, get_context):
+        """
+        :param key: Unique id of the call
+        :param chat_history_id: Id of the ChatHistory row the call is saved to
+        :param get_context: Returns the current list of chat messages
+        """
+        with self._lock:
+            self._chats[key] = _LiveChat(chat_history_id, get_context)
+
+    def record_timing(self, key, phase, duration):
+        """
+        Adds a timing sample to the running statistics. Safe to call from the chat thread.
+        """
+        with self._lock:
+            chat = self._chats.get(key)
+            if chat is None or phase not in chat.timings:
+                return
+            chat.timings[phase].add(duration)
+            chat.dirty = True
+
+    def _pending(self, keys, turns_only):
+        pending = {}
+        for key in keys:
+            chat = self._chats.get(key)
+            if chat is None:
+                continue
+            turn_finished = len(chat.get_context()) != chat.flushed_length
+            if turn_finished or (chat.dirty and not turns_only):
+                pending[key] = chat
+        return pending
+
+    def flush(self, keys=None, turns_only=False) -> int:
+        """
+        Writes pending calls to the database in one transaction.
+
+        :param keys: Calls to consider. Defaults to all registered calls.
+        :param turns_only: Only write calls whose conversation gained messages since the last write.
+        :return: The number of calls written
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending(list(self._chats) if keys is None else keys, turns_only)
+                updates = {}
+                lengths = {}
+                for key, chat in pending.items():
+                    # copy so the JSON column sees a new value and the chat thread can keep appending
+                    context = [dict(message) for message in chat.get_context()]
+                    lengths[key] = len(context)
+                    update = {"chat_data": context}
+                    if chat.timings["total_cycle"].count:
+                        update["response_time"] = chat.timings["total_cycle"].mean
+                    updates[chat.chat_history_id] = update
+                    chat.dirty = False
+            if not updates:
+                return 0
+
+            db = self.session_factory()
+            try:
+                crud.save_chat_histories(db, updates)
+            except Exception:
+                db.rollback()
+                with self._lock:
+                    for key in pending:
+                        if key in self._chats:
+                            self._chats[key].dirty = True
+                raise
+            finally:
+                db.close()
+
+            with self._lock:
+                for key, length in lengths.items():
+                    if key in self._chats:
+                        self._chats[key].flushed_length = length
+            return len(updates)
+
+    async def unregister(self, key):
+        """
+        Writes the final state of a call and forgets it.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.flush, [key])
+        finally:
+            with self._lock:
+                self._chats.pop(key, None)
+
+    async def run(self):
+        """
+        Flushes finished turns every poll_interval and all pending changes every flush_interval
+        seconds. The writes run in an executor so SQLite locks never stall the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        last_full_flush = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            full_flush = time.monotonic() - last_full_flush >= self.flush_interval
+            if full_flush:
+                last_full_flush = time.monotonic()
+            try:
+                await loop.run_in_executor(None, self.flush, None, not full_flush)
+            except Exception as e:
+                print(f"Error while saving chat histories: {e}")
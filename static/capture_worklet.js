@@ -0,0 +1,123 @@
+// Microphone capture for streaming_audio.js. Runs on the audio rendering thread, resamples the
+// input to the rate the server's VAD and STT expect, converts it to int16 and posts fixed-size frames.
+
+function gcd(a, b) {
+    while (b) {
+        [a, b] = [b, a % b];
+    }
+    return a;
+}
+
+// zeroth order modified Bessel function of the first kind, for the Kaiser window
+function besselI0(x) {
+    let sum = 1;
+    let term = 1;
+    for (let k = 1; k < 50; k++) {
+        term *= (x / (2 * k)) * (x / (2 * k));
+        sum += term;
+        if (term < sum * 1e-12) {
+            break;
+        }
+    }
+    return sum;
+}
+
+// Kaiser-windowed sinc low-pass split into its polyphase components, designed like
+// openvoicechat/resample.py's StreamingResampler so the browser and the server filter alike
+function designPhases(up, down, zeroCrossings = 16, rolloff = 0.945, beta = 8.0) {
+    // prototype low-pass at the input rate * up, cutoff in cycles per upsampled sample
+    const cutoff = rolloff * 0.5 / Math.max(up, down);
+    const halfLength = Math.ceil(zeroCrossings / (2 * cutoff));
+    const length = 2 * halfLength + 1;
+    const taps = Math.ceil(length / up);
+    const h = new Float32Array(taps * up);
+    const i0Beta = besselI0(beta);
+    for (let i = 0; i < length; i++) {
+        const n = i - halfLength;
+        const x = 2 * cutoff * n;
+        const sinc = n === 0 ? 1 : Math.sin(Math.PI * x) / (Math.PI * x);
+        const r = 2 * i / (length - 1) - 1;
+        const window = besselI0(beta * Math.sqrt(Math.max(0, 1 - r * r))) / i0Beta;
+        h[i] = 2 * cutoff * sinc * window * up;
+    }
+    // phase p holds h[p], h[p + up], ... reversed so it lines up with a window of past inputs
+    const phases = [];
+    for (let p = 0; p < up; p++) {
+        const phase = new Float32Array(taps);
+        for (let k = 0; k < taps; k++) {
+            phase[taps - 1 - k] = h[p + k * up];
+        }
+        phases.push(phase);
+    }
+    return { phases, taps, halfLength };
+}
+
+class CaptureProcessor extends AudioWorkletProcessor {
+    constructor(options) {
+        super();
+        const { targetRate = 16000, frameSamples = 512 } = options.processorOptions || {};
+        // `sampleRate` is the AudioContext rate, provided by the worklet global scope
+        const inputRate = Math.round(sampleRate);
+        const g = gcd(inputRate, targetRate);
+        this.up = targetRate / g;
+        this.down = inputRate / g;
+        this.frameSamples = frameSamples;
+        this.frame = new Int16Array(frameSamples);
+        this.frameIndex = 0;
+        if (this.up !== this.down) {
+            const { phases, taps, halfLength } = designPhases(this.up, this.down);
+            this.phases = phases;
+            this.taps = taps;
+            // the last taps inputs, written twice so every window is one contiguous run
+            this.history = new Float32Array(2 * taps);
+            this.historyIndex = 0;
+            // time of the next output on the upsampled grid, relative to the newest input
+            this.t = halfLength;
+        }
+    }
+
+    emit(s) {
+        s = Math.max(-1, Math.min(1, s));
+        this.frame[this.frameIndex++] = s < 0 ? s * 0x8000 : s * 0x7FFF;
+        if (this.frameIndex === this.frameSamples) {
+            this.port.postMessage(this.frame.buffer, [this.frame.buffer]);
+            this.frame = new Int16Array(this.frameSamples);
+            this.frameIndex = 0;
+        }
+    }
+
+    process(inputs) {
+        const channel = inputs[0][0];
+        if (!channel) {
+            return true;
+        }
+        if (this.up === this.down) {
+            for (let i = 0; i < channel.length; i++) {
+                this.emit(channel[i]);
+            }
+            return true;
+        }
+        const { history, taps, up, down } = this;
+        for (let i = 0; i < channel.length; i++) {
+            history[this.historyIndex] = channel[i];
+            history[this.historyIndex + taps] = channel[i];
+            this.historyIndex = (this.historyIndex + 1) % taps;
+            // window of the last taps inputs, oldest first
+            const start = this.historyIndex;
+            // every output whose newest input is this one
+            while (this.t < up) {
+                const phase = this.phases[this.t];
+                let s = 0;
+                for (let k = 0; k < taps; k++) {
+                    s += phase[k] * history[start + k];
+                }
+                this.emit(s);
+                this.t += down;
+            }
+            this.t -= up;
+        }
+        return true;
+    }
+}
+
+registerProcessor('capture-processor', CaptureProcessor);
@@ -10,6 +10,66 @@ let audioQueue = [];
 let isPlaying = false;
 let currentSourceNode = null;
 
+// Binary framing shared with openvoicechat/protocol.py:
+// version | type | sample format | flags (uint8 each) | sequence | sample rate (uint32 each), little-endian
+const PROTOCOL_VERSION = 1;
+const HEADER_BYTES = 12;
+const MessageType = { AUDIO: 1, HELLO: 2, BARGE_IN: 3, END_OF_UTTERANCE: 4, PLAYBACK_ACK: 5 };
+const SampleFormat = { NONE: 0, INT16: 1, FLOAT32: 2 };
+
+// The server's VAD and STT run at 16 kHz; 512 samples are 32 ms frames
+const CAPTURE_RATE = 16000;
+const CAPTURE_FRAME_SAMPLES = 512;
+
+function encodeFrame(type, payload = null, seq = 0, sampleRate = 0, sampleFormat = SampleFormat.NONE) {
+    const payloadBytes = payload ? payload.byteLength : 0;
+    const frame = new ArrayBuffer(HEADER_BYTES + payloadBytes);
+    const view = new DataView(frame);
+    view.setUint8(0, PROTOCOL_VERSION);
+    view.setUint8(1, type);
+    view.setUint8(2, sampleFormat);
+    view.setUint8(3, 0);
+    view.setUint32(4, seq, true);
+    view.setUint32(8, sampleRate, true);
+    if (payload) {
+        new Uint8Array(frame, HEADER_BYTES).set(new Uint8Array(payload.buffer, payload.byteOffset, payloadBytes));
+    }
+    return frame;
+}
+
+function decodeFrame(frame) {
+    const view = new DataView(frame);
+    return {
+        version: view.getUint8(0),
+        type: view.getUint8(1),
+        sampleFormat: view.getUint8(2),
+        seq: view.getUint32(4, true),
+        sampleRate: view.getUint32(8, true),
+        payload: frame.slice(HEADER_BYTES),
+    };
+}
+
+function floatToInt16(samples) {
+    const int16 = new Int16Array(samples.length);
+    for (let i = 0; i < samples.length; i++) {
+        const s = Math.max(-1, Math.min(1, samples[i]));
+        int16[i] = s < 0 ? s * 0x8000 : s * 0x7FFF;
+    }
+    return int16;
+}
+
+function payloadToFloat32(frame) {
+    if (frame.sampleFormat === SampleFormat.FLOAT32) {
+        return new Float32Array(frame.payload);
+    }
+    const int16 = new Int16Array(frame.payload);
+    const float32 = new Float32Array(int16.length);
+    for (let i = 0; i < int16.length; i++) {
+        float32[i] = int16[i] / 0x8000;
+    }
+    return float32;
+}
+
 document.getElementById('startButton').addEventListener('click', function() {
     logElement.innerText = 'starting... could take a minute';
     start();
@@ -18,12 +78,19 @@ document.getElementById('startButton').addEventListener('click', function() {
 
 function start() {
     let socket = new WebSocket(window.location.href + 'ws');
+    socket.binaryType = 'arraybuffer';
     let audioCtx;
+    let sendSeq = 0;
 
     socket.onopen = () => {
         logElement.innerText = 'Connection opened';
         audioCtx = new AudioContext();
         context = audioCtx;
+        const hello = new TextEncoder().encode(JSON.stringify({
+            formats: ['int16', 'float32'],
+            sample_rate: audioCtx.sampleRate,
+        }));
+        socket.send(encodeFrame(MessageType.HELLO, hello));
         analyser = context.createAnalyser();
         freqs = new Uint8Array(analyser.frequencyBinCount);
 
@@ -41,14 +108,35 @@ function start() {
         console.log('WebSocket connection closed');
     };
 
-    function setupAudioProcessors(stream) {
+    async function setupAudioProcessors(stream) {
         const audioSource = audioCtx.createMediaStreamSource(stream);
+        if (audioCtx.audioWorklet) {
+            await audioCtx.audioWorklet.addModule('/static/capture_worklet.js');
+            const captureNode = new AudioWorkletNode(audioCtx, 'capture-processor', {
+                processorOptions: { targetRate: CAPTURE_RATE, frameSamples: CAPTURE_FRAME_SAMPLES },
+            });
+            captureNode.port.onmessage = (event) => {
+                sendSeq += 1;
+                socket.send(encodeFrame(
+                    MessageType.AUDIO, new Int16Array(event.data), sendSeq, CAPTURE_RATE, SampleFormat.INT16
+                ));
+            };
+            audioSource.connect(captureNode);
+            // the node outputs silence; connecting it keeps it rendering
+            captureNode.connect(audioCtx.destination);
+            visualize();
+            return;
+        }
+
+        // Fallback for browsers without AudioWorklet: the server resamples these frames
         const audioProcessor = audioCtx.createScriptProcessor(16384, 1, 1);
 
         audioProcessor.onaudioprocess = (event) => {
             const audioData = event.inputBuffer.getChannelData(0);
-            const buffer = new Float32Array(audioData);
-            socket.send(buffer);
+            sendSeq += 1;
+            socket.send(encodeFrame(
+                MessageType.AUDIO, floatToInt16(audioData), sendSeq, audioCtx.sampleRate, SampleFormat.INT16
+            ));
         };
 
         audioSource.connect(audioProcessor);
@@ -57,25 +145,41 @@ function start() {
         visualize();
     }
 
-    socket.onmessage = async (event) => {
-        const receivedData = new TextDecoder().decode(await event.data.arrayBuffer());
-        if (receivedData === 'stop') {
-            logElement.innerText = 'Interruption';
-            if (currentSourceNode) {
-                currentSourceNode.stop();
-                currentSourceNode = null;
-            }
-            isPlaying = false;
-            audioQueue = [];
-        } else if (receivedData === 'none') {
-        } else {
-            const float32Array = new Float32Array(await event.data.arrayBuffer());
-            const audioBuffer = audioCtx.createBuffer(1, float32Array.length, 44100);
-            audioBuffer.getChannelData(0).set(float32Array);
-            audioQueue.push(audioBuffer);
-            if (audioQueue.length === 1 && !isPlaying) {
-                playAudioFromQueue();
+    socket.onmessage = (event) => {
+        const frame = decodeFrame(event.data);
+        if (frame.version !== PROTOCOL_VERSION) {
+            console.error('Unsupported protocol version:', frame.version);
+            return;
+        }
+        switch (frame.type) {
+            case MessageType.BARGE_IN:
+                logElement.innerText = 'Interruption';
+                if (currentSourceNode) {
+                    currentSourceNode.onended = null;
+                    currentSourceNode.stop();
+                    currentSourceNode = null;
+                }
+                isPlaying = false;
+                audioQueue = [];
+                break;
+            case MessageType.END_OF_UTTERANCE:
+                if (!isPlaying) {
+                    logElement.innerText = 'Thinking...';
+                }
+                break;
+            case MessageType.AUDIO: {
+                // the browser resamples from the engine's native rate when playing the buffer
+                const samples = payloadToFloat32(frame);
+                const audioBuffer = audioCtx.createBuffer(1, samples.length, frame.sampleRate);
+                audioBuffer.getChannelData(0).set(samples);
+                audioQueue.push({ buffer: audioBuffer, seq: frame.seq });
+                if (audioQueue.length === 1 && !isPlaying) {
+                    playAudioFromQueue();
+                }
+                break;
             }
+            default:
+                break;
         }
     };
 
@@ -83,14 +187,15 @@ function start() {
         if (audioQueue.length > 0 && !isPlaying) {
             isPlaying = true;
             logElement.innerText = 'Speaking...';
-            const audioBuffer = audioQueue.shift();
+            const { buffer, seq } = audioQueue.shift();
             currentSourceNode = audioCtx.createBufferSource();
-            currentSourceNode.buffer = audioBuffer;
+            currentSourceNode.buffer = buffer;
             currentSourceNode.connect(analyser);
             currentSourceNode.connect(audioCtx.destination);
             currentSourceNode.start();
             currentSourceNode.onended = () => {
                 isPlaying = false;
+                socket.send(encodeFrame(MessageType.PLAYBACK_ACK, null, seq));
                 logElement.innerText = 'Listening...';
                 playAudioFromQueue();
             };